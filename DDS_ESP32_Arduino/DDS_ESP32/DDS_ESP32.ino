@@ -26,6 +26,7 @@
  
 #include <SPI.h>
 #include <WiFi.h>
+#include <esp_heap_caps.h>
 #include "Webserver.h"
 
 String currentline = "";                     // temporal String to retain incoming data from the client
@@ -38,6 +39,10 @@ static uint32_t cycletime = 0;               // variable to count time.
 volatile unsigned long maxcycletime = 120000;// max time the system will be in list mode, can be changed.
 volatile int n_items = 0;                    // number of items to iterate trough.
 unsigned long long spi_memory[listdim];      // setin the memory list, (64bits per item max).
+# define indexdim 32768                      // max number of elements in the index list (dictionary format).
+uint16_t *spi_index = NULL;                  // index list, element i of the list is spi_memory[spi_index[i]].
+                                             // 64 KB allocated with the first 'D', so only in dictionary format.
+volatile bool dict_mode = false;             // true once an index list is stored, the list goes through it.
 
 //SPI parameters
 //pins definitions
@@ -66,14 +71,22 @@ void reset_DDS(void);
 void reset_comm(void);
 void IO_update(void);
 void direct_spi(String);
+void batch_spi(String);
+void spi_write(String);
 void memory_spi(unsigned long long);
 void memory_storage(String);
+String read_line(WiFiClient &);
+bool read_bytes(WiFiClient &, uint8_t *, size_t);
+void memory_binary(WiFiClient &);
+void memory_ack(WiFiClient &, char, uint32_t);
+void memory_index(WiFiClient &);
+unsigned long long list_command(int);
 
 // interrupt function
 void IRAM_ATTR isr() {
 //  each time pulse arrives to PIN INT will execute
   list_ele += 1;
-  memory_spi(spi_memory[list_ele]);
+  memory_spi(list_command(list_ele));
   }
 
 void setup() {
@@ -110,6 +123,7 @@ void loop() {
    WiFiClient client = server.available();   // Listen for incoming clients
 
    if (client) {                             // If a new client connects,
+    client.setNoDelay(true);                 // replies are tiny, send them straight away
      
     while (client.connected()) {             // loop while the client's connected
       
@@ -130,6 +144,14 @@ void loop() {
           Serial.println("DDS");
           }
 
+        // acknowledge, "q<seq>\n" replied "a<seq>", the commands are executed in order so the reply
+        // means all the previous commands (and their SPI writes) are done-------------------
+        if(ch == 'q'){
+          currentline = read_line(client);             // read line
+          client.print("a" + currentline);
+          currentline = ""; 
+          }
+
         // sofware reset DDS----------------------------------------------------------------
         if(ch == 'r'){
           reset_DDS();
@@ -148,11 +170,18 @@ void loop() {
           Serial.println("update registers");
           }
         
+        // batch writing of SPI, comma separated commands and one IO_update at the end------
+        if(ch == 'b'){
+          currentline = read_line(client);             // read line
+          if (currentline.length() > 0 ){ 
+            batch_spi(currentline);                     // parse the strings and transfer via SPI       
+            currentline = ""; 
+            }
+          }
+
         // direct writing of SPI-------------------------------------------------------------
         if(ch == 'd'){
-          while((ch = client.read()) != '\n'){
-            currentline += ch; // read line
-            }
+          currentline = read_line(client);             // read line
           if (currentline.length() > 0 ){ 
             direct_spi(currentline);                    // parse the string and transfer via SPI       
             currentline = ""; 
@@ -161,36 +190,47 @@ void loop() {
                     
          // set number of commands in the list memory-------------------------------------
          if(ch == 'n'){
-           while((ch = client.read()) != '\n'){
-             currentline += ch; // read line
-             }
+           currentline = read_line(client);            // read line
           n_items = currentline.toInt();
           currentline = ""; 
           }
          
          // set max cycle time------------------------------------------------------------
          if(ch == 't'){
-           while((ch = client.read()) != '\n'){
-             currentline += ch; // read line
-             }
+           currentline = read_line(client);            // read line
           maxcycletime = currentline.toInt();
           currentline = ""; 
           }
           
         // storage command in the list memory -------------------------------------------------  
         if(ch == 'm'){
-          while((ch = client.read()) != '\n'){
-            currentline += ch; // read line
-            }
+          currentline = read_line(client);             // read line
           if (currentline.length() > 0 ){  
             memory_storage(currentline);                  // storage into the memory list
             currentline = ""; 
             }
           }
         
+        // storage commands in the list memory, binary format --------------------------------  
+        // 12 bytes header: 'M', version, flags, pad, start index (uint32), n records (uint32), little-endian
+        // followed by the records, 8 bytes (uint64 little-endian) per command
+        // if flags bit 0 is set replies 'A' (or 'E' if rejected) + start index (uint32) once stored
+        if(ch == 'M'){
+          memory_binary(client);
+          }
+
+        // storage the index list, dictionary format -----------------------------------------
+        // same 12 bytes header with 'D', followed by 2 bytes (uint16 little-endian) per element: the position
+        // of its command in the memory list (the table of unique commands, stored with 'M')
+        if(ch == 'D'){
+          memory_index(client);
+          }
+
         // clean the list memory -------------------------------------------------------------  
         if(ch == 'k'){
           for(int i = 0; i<listdim; i++){spi_memory[i] = 0;}
+          if(spi_index != NULL){memset(spi_index, 0, indexdim*sizeof(uint16_t));}
+          dict_mode = false;
           n_items = 0;
           }
           
@@ -199,7 +239,7 @@ void loop() {
           list_ele = 0;                                     // set list element counter to zero
           pinMode(UPD, INPUT_PULLUP);                       // set UPD PIN as an input with pullup resistor (the INT PIN will control the update of the registers )
           digitalWrite(CS, LOW);                            
-          memory_spi(spi_memory[list_ele]);                 // write into the registers the 1st element of the list(It won't be updated till a pulse arrives to INT PIN
+          memory_spi(list_command(list_ele));               // write into the registers the 1st element of the list(It won't be updated till a pulse arrives to INT PIN
           attachInterrupt(INT, isr, FALLING);               // enable interrupts, each pulse (falling edge) will trigger the isr function
           cycletime = millis();                             // start the time counter 
           while(1){
@@ -232,6 +272,94 @@ void loop() {
 
 
 // functions --------------------------------------------------------------------------------------------
+bool read_bytes(WiFiClient &client, uint8_t *buffer, size_t n){
+  // read exactly n bytes from the client, false if the client disconnects before
+  size_t got = 0;
+  while(got < n){
+    if(!client.connected()){return false;}
+    int r = client.read(buffer + got, n - got);
+    if(r > 0){got += r;}
+    }
+  return true;
+  }
+
+void memory_binary(WiFiClient &client){
+  // storage into the memory list the records of a binary 'M' message (opcode already read)
+  uint8_t header[11];
+  if(!read_bytes(client, header, 11)){return;}
+  uint8_t version = header[0];
+  bool ack = header[1] & 0x01;
+  uint32_t start = header[3] | (header[4] << 8) | (header[5] << 16) | ((uint32_t)header[6] << 24);
+  uint32_t count = header[7] | (header[8] << 8) | (header[9] << 16) | ((uint32_t)header[10] << 24);
+  if(version != 1 or start > listdim or count > listdim - start){
+    // unknown version or out of the list, drop the records
+    Serial.println("wrong binary memory message");
+    uint8_t dump[8];
+    for(uint32_t i = 0; i < count; i++){ if(!read_bytes(client, dump, 8)){return;} }
+    if(ack){memory_ack(client, 'E', start);}
+    return;
+    }
+  // the ESP32 is little-endian, the records go straight into the list
+  if(read_bytes(client, (uint8_t *)&spi_memory[start], 8*count) and ack){memory_ack(client, 'A', start);}
+  }
+
+void memory_index(WiFiClient &client){
+  // storage into the index list the elements of a binary 'D' message (opcode already read)
+  uint8_t header[11];
+  if(!read_bytes(client, header, 11)){return;}
+  uint8_t version = header[0];
+  bool ack = header[1] & 0x01;
+  uint32_t start = header[3] | (header[4] << 8) | (header[5] << 16) | ((uint32_t)header[6] << 24);
+  uint32_t count = header[7] | (header[8] << 8) | (header[9] << 16) | ((uint32_t)header[10] << 24);
+  if(spi_index == NULL){
+    // internal RAM, the isr() reads it (list_command), zeroed like a cleaned list
+    spi_index = (uint16_t *)heap_caps_calloc(indexdim, sizeof(uint16_t), MALLOC_CAP_INTERNAL | MALLOC_CAP_8BIT);
+    }
+  if(spi_index == NULL or version != 1 or start > indexdim or count > indexdim - start){
+    // no memory for the index list, unknown version or out of the list, drop the elements
+    Serial.println("wrong binary index message");
+    uint8_t dump[2];
+    for(uint32_t i = 0; i < count; i++){ if(!read_bytes(client, dump, 2)){return;} }
+    if(ack){memory_ack(client, 'E', start);}
+    return;
+    }
+  if(read_bytes(client, (uint8_t *)&spi_index[start], 2*count)){
+    dict_mode = true;
+    if(ack){memory_ack(client, 'A', start);}
+    }
+  }
+
+unsigned long long IRAM_ATTR list_command(int i){
+  // command of the element i of the list, through the index list in dictionary format
+  if(dict_mode){
+    if(i >= n_items or i >= indexdim or spi_index[i] >= listdim){return 0;}   // nothing past the list
+    return spi_memory[spi_index[i]];
+    }
+  if(i >= listdim){return 0;}
+  return spi_memory[i];
+  }
+
+void memory_ack(WiFiClient &client, char status, uint32_t start){
+  // acknowledge a binary memory message: status + start index (uint32 little-endian)
+  uint8_t reply[5] = {(uint8_t)status, (uint8_t)start, (uint8_t)(start >> 8), (uint8_t)(start >> 16), (uint8_t)(start >> 24)};
+  client.write(reply, 5);
+  }
+
+String read_line(WiFiClient &client){
+  // read the client till the end of line, waiting for the bytes still on the way
+  // (on a persistent connection a command can arrive split in several packets)
+  String line = "";
+  char ch;
+  while(client.connected()){
+    if(client.available()){
+      ch = client.read();
+      if(ch == '\n'){break;}
+      line += ch;
+      }
+    }
+  return line;
+  }
+
 void reset_DDS(){ 
   // pulse the reset pin to reset the board
   digitalWrite(RST, HIGH); //pulse the update pin
@@ -283,6 +411,26 @@ void init_DDS() {
 
 void direct_spi(String input){
   // transfer and parsed the string received from the WiFi to the SPi channel
+  spi_write(input);
+  IO_update();
+  digitalWrite(CS, HIGH);    
+  }
+
+void batch_spi(String input){
+  // transfer a comma separated list of commands one after the other, the registers are updated once at the end
+  int start = 0;
+  int sep;
+  while((sep = input.indexOf(',', start)) >= 0){
+    spi_write(input.substring(start, sep));
+    start = sep + 1;
+    }
+  if(start < input.length()){spi_write(input.substring(start));}
+  IO_update();
+  digitalWrite(CS, HIGH);    
+  }
+
+void spi_write(String input){
+  // parse a hexadecimal string and transfer it via SPI, without updating the registers
   unsigned int l = input.length();
   unsigned long long spi_mem = strtoll(input.c_str(),NULL,0);
   int spi_out;
@@ -294,8 +442,6 @@ void direct_spi(String input){
     if( i == l and spi_out > 0x18){spi_out = 0x00;}
     hspi->transfer(spi_out);
     }
-    IO_update();
-    digitalWrite(CS, HIGH);    
   }
   
 void memory_spi(unsigned long long input){
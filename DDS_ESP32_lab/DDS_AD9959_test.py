@@ -99,28 +99,13 @@ AnalogIn(name='Test_AI_0',                 parent_device=ni_pxi_6361_0, connecti
 AnalogIn(name='Test_AI_1',                 parent_device=ni_pxi_6361_0, connection='ai1')
 # DDS_ESP32
 DDS_ESP32(name='DDS_0', IP="192.168.20.103", port=80, clock=25E6, pll=20)#Aliexpress
-DDS_ESP32(name='DDS_1', IP="192.168.20.105", port=80, clock=50E6, pll=10)#AD eval board
+DDS_ESP32(name='DDS_1', IP="192.168.20.105", port=80, clock=50E6, pll=10, trigger_line=Fast_Trig)#AD eval board
 
 # Auxiliary functions
 def print_time(t, desc): # time label
     print('t = %9.6f s : ' % t, desc)
 t = 0
 
-#definition funtion to store a command in the ESP32_DDS and trigger it
-def DDS0memory_amplitude(time, channel, amplitude):
-	DDS_command = DDS_0.set_amplitude(channel, amplitude)
-	DDS_0.to_memory(DDS_command)
-	Fast_Trig.go_high(time)
-	Fast_Trig.go_low(time + 2E-6)
-	return( 15E-6)
-
-#definition funtion to store a command in the ESP32_DDS and trigger it
-def DDS1memory_amplitude(time, channel, amplitude):
-	DDS_command = DDS_1.set_amplitude(channel, amplitude)
-	DDS_1.to_memory(DDS_command)
-	Fast_Trig.go_high(time)
-	Fast_Trig.go_low(time + 2E-6)
-
 #-----DDS Aliexpress AD9959 set start commands--------------------------------------------------------------
 DDS_command = DDS_0.set_amplitude(0, amplitude_0)
 DDS_0.to_start(DDS_command)
@@ -171,25 +156,19 @@ t += Free1.ramp(t, 0.1, 0, 1, 100e3 )
 
 t += Test_AI_0.acquire(label='Test_AI_0', start_time= t, end_time=t+3)
 
-# send to list memory of DDS_ESP32 1
+# timed events of DDS_ESP32 1, the trigger pulses (Fast_Trig) are added by each call, the memory list when compiling
 for i, j in enumerate(np.arange(0,1023,10)):
 	# add_time_marker(t, "Toggle DDS %d)"%i, verbose=True)
-	DDS1memory_amplitude(t,channel= 0, amplitude= j)
-	# Wait more than 20E-6 s between commands (max rate of SPI transmission)
+	DDS_1.ch[0].setamp(t, j)
 	t += 0.1
 t += 1E-3
 
-DDS1memory_amplitude(t,channel= 0, amplitude= 0)
+DDS_1.ch[0].setamp(t, 0)
 t += 1E-3
 
 # composition of 2 level modulation on channel 0 with 1st freq the former one and set the 2nd
-DDS_command = DDS_1.set_2mod_amplitude(ch=0, amp_2nd= 1023)
-#its a composition of commands, we need to send one by one
-for c in DDS_command:
-	DDS_1.to_memory(c)
-	Fast_Trig.go_high(t)
-	Fast_Trig.go_low(t + 2E-6)
-	t += 20E-6 # Wait more than 20E-6 s between commands (max rate of SPI transmission)
+# (a window of several commands, triggered one after the other ending at t)
+DDS_1.add_commands(t, DDS_1.set_2mod_amplitude(ch=0, amp_2nd= 1023))
 
 t += 100E-6
 
@@ -200,15 +179,11 @@ RF_Switch_Trigger.go_low(t)
 
 t += 100E-6
 
-DDS1memory_amplitude(t,channel= 0, amplitude= 1023)
+DDS_1.ch[0].setamp(t, 1023)
 t += 1E-3
 
 # set a single memory command
-DDS_command = DDS_1.set_frequency(ch=0, freq=10E6)
-DDS_1.to_memory(DDS_command)
-Fast_Trig.go_high(t)
-t += 2E-6
-Fast_Trig.go_low(t)
+DDS_1.ch[0].setfreq(t, 10E6)
 t += 100E-6
 
 n = 5
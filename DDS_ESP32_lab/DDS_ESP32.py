@@ -24,59 +24,326 @@
 # Settings
 
 # Packages importation
+import select
 import socket
 import time
+from collections import OrderedDict
+from functools import wraps, partial
 import numpy as np
 
+from .registers import ShadowRegisters, CW
+from .ramp_planner import (plan_ramp, sweep_commands, word_command, to_words, OK, OUT_OF_RANGE, STATUS_MESSAGES, WORD_MASK,
+                           AMPLITUDE, FREQUENCY, PHASE)
+from .modulation import mod_level, default_PPC, profile_pins
+from .optimizer import broadcast
+from .protocol import (encode_memory_ascii, encode_memory_binary, encode_memory_index, ChunkedUpload, dictionary_encode,
+                       dictionary_size, table_hash, MEMORY_ACK, LIST_DIM, INDEX_DIM, LIST_MAXTIME)
+
+def register_cache(method):
+    """Memoize the output of a register function in the LRU cache of the instance (see DDS_ESP32.cache_info).
+    The key is the register, its arguments and AFP_select (the global modulation selected), always included although
+    only CW_register depends on it. The cache is cleared when clock or pll change, so the outputs are
+    always the ones for the current core clock. Unhashable arguments (arrays...) are not cached.
+    The outputs are shared by all the calls, so the cached functions return immutable values (integers, tuples)
+    or copies."""
+    name = method.__name__
+
+    @wraps(method)
+    def cached(self, *args, **kwargs):
+        if self.cache_size <= 0:
+            return(method(self, *args, **kwargs))
+        key = (name, AFP_select, args, tuple(kwargs.items()))
+        try:
+            out = self._cache[key]
+        except KeyError:
+            self.cache_misses += 1
+            out = method(self, *args, **kwargs)
+            self._cache[key] = out
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.cache_evictions += 1
+            return(out)
+        except TypeError:
+            return(method(self, *args, **kwargs))
+        self.cache_hits += 1
+        self._cache.move_to_end(key)
+        return(out)
+    return(cached)
+
+
 # DDS Class
 class DDS_ESP32():
 
-    def __init__(self, IP, port=80, clock=50E6, pll=10):
+    def __init__(self, IP, port=80, clock=50E6, pll=10, session=False, timeout=2, binary=True, ack=False, cache_size=4096,
+                 shadow=False):
+        self._cache = OrderedDict()# LRU cache of register words, see register_cache
+        self.cache_size = cache_size # max number of words in the cache, 0 disables it
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
         self.IP= IP                # IP and port of the ESP32
         self.port = port 
         self.clock = clock         # Reference clock of the DDS
         self.pll = pll             # PPL multiplier
-        self.ESP32timeout = 5000   # Timeout time for the comunications with the ucontroller
+        self.ESP32timeout = timeout# Timeout time (s) for the comunications with the ucontroller
+        self.session = session     # if true keep one TCP connection open and reuse it for every command
+        self._sock = None          # socket of the persistent connection (session mode)
+        self.binary = binary       # memory list uploaded in the binary format, if false the ASCII one (older firmware)
+        self.ack = ack             # if true wait after each command till the ESP32 acknowledges it is done
+        self._seq = 0              # sequence number of the last acknowledged command
+        self.shadow = ShadowRegisters() if shadow else None # if true the writes that would not change the DDS are not sent
+        self.memory_hash = None    # hash of the list stored in the ESP32 by store_list, None if unknown
+        self.maxtime = LIST_MAXTIME/1E3 # max time (s) in list mode set in the ESP32
+        self.list_end = None       # time.monotonic() the ESP32 leaves the list mode at the latest, None if not in it
         
         global AFP_select
         AFP_select = 0b00       
+        self.templates = self.register_templates()
+
+    @property
+    def clock(self):
+        """Reference clock of the DDS (Hz), changing it clears the register cache"""
+        return(self._clock)
+
+    @clock.setter
+    def clock(self, clock):
+        self._clock = clock
+        self.cache_clear()
+
+    @property
+    def pll(self):
+        """PLL multiplier, changing it clears the register cache"""
+        return(self._pll)
+
+    @pll.setter
+    def pll(self, pll):
+        self._pll = pll
+        self.cache_clear()
+
+    def cache_clear(self):
+        """empty the register cache (the stats are kept)"""
+        self._cache.clear()
+
+    def cache_info(self):
+        """stats of the register cache: hits, misses, evictions, size and maxsize"""
+        return({"hits": self.cache_hits, "misses": self.cache_misses, "evictions": self.cache_evictions,
+                "size": len(self._cache), "maxsize": self.cache_size})
+
+    def register_templates(self):
+        """Return the table of constant register words, used in the hot paths instead of rebuilding the bit fields:
+        "CSR": the 16 channel selections, index ch_3 ch_2 ch_1 ch_0 bits (0b1001 = channels 3 and 0)
+        "FR1": {(PLL_div, Mod_level): word} for every PLL_div (5 bits) and modulation level
+        "FR2": word
+        "CFR": {(AFP_select, Sweep_nodwell, Sweep_enable, SRR_IOupdate): word} for every combination
+        None of them depends on clock or pll, so the table is built once per instance.
+        """
+        CSR_register = DDS_ESP32.CSR_register.__wrapped__ # not the cached version, the table is the cache here
+        return({"CSR": [CSR_register(self, mask & 1, (mask >> 1) & 1, (mask >> 2) & 1, (mask >> 3) & 1) for mask in range(16)],
+                "FR1": {(PLL_div, Mod_level): self.FR1_register(PLL_div, Mod_level) for PLL_div in range(32) for Mod_level in range(4)},
+                "FR2": self.FR2_register(),
+                "CFR": {(AFP, nodwell, sweep, SRR): self.CFR_register(AFP, nodwell, sweep, SRR)
+                        for AFP in range(4) for nodwell in range(2) for sweep in range(2) for SRR in range(2)}})
+
+    def CSR_channel(self, ch):
+        """Return the CSR word (from the templates) that selects only the channel ch, no channel if ch is not 0-3"""
+        return(self.templates["CSR"][1 << int(ch)] if ch in (0, 1, 2, 3) else self.templates["CSR"][0])
+
+    def __enter__(self):
+        """use the device as a context manager, all the commands inside share one connection"""
+        self.session = True
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect()
     
     # Communications functions with the ESP32: 
-    
-    def transfer_ESP32(self, out):
-        """Transfer the data to the ESP32 via socket"""
+
+    def open_socket(self):
+        """Open a new TCP connection with the ESP32.
+        Nagle is disabled (the commands are tiny and latency bound) and keepalive is enabled
+        so a dead WiFi link is detected on a long-lived connection.
+        """
+        s = socket.create_connection((str(self.IP),int(self.port)), timeout=self.ESP32timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return(s)
+
+    def connect(self):
+        """Open the persistent connection used in session mode (reconnects if it was dropped).
+        The ESP32 only serves one client at a time, while the session is open other clients will wait.
+        """
+        if self._sock is not None and not self.connected():
+            self.disconnect()
+        if self._sock is None:
+            self._sock = self.open_socket()
+        return(self._sock)
+
+    def disconnect(self):
+        """Close the persistent connection, if any"""
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+
+    def connected(self):
+        """True if the persistent connection is open and the ESP32 has not closed it"""
+        if self._sock is None:
+            return(False)
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            if readable:
+                # the ESP32 never talks unless asked, readable here means closed (b"") or reset
+                return(len(self._sock.recv(1, socket.MSG_PEEK)) > 0)
+            return(True)
+        except (OSError, ValueError):
+            return(False)
+
+    @staticmethod
+    def _recv_exact(s, n):
+        """read exactly n bytes from the socket"""
+        msg = b""
+        while len(msg) < n:
+            chunk = s.recv(n - len(msg))
+            if not chunk:
+                raise ConnectionError("connection closed by the ESP32")
+            msg += chunk
+        return(msg)
+
+    def list_left(self):
+        """time (s) the ESP32 may still be in list mode after list_mode, it reads no command till it leaves it
+        (all the triggers received or the max time passed, e.g. after an aborted shot)"""
+        if self.list_end is None:
+            return(0.0)
+        left = self.list_end - time.monotonic()
+        if left <= 0:
+            self.list_end = None
+        return(max(left, 0.0))
+
+    def _timeout(self):
+        """timeout (s) of a command, it covers as well the time the ESP32 may still be in list mode (see list_left)"""
+        return(self.ESP32timeout + self.list_left())
+
+    def _frame(self, out, reply=0, ack=None):
+        """data sent for a command and the sequence number of its acknowledge (None if not acknowledged),
+        see transfer_ESP32"""
+        data = out if type(out) is bytes else bytes(out,"utf-8")
+        seq = None
+        if (self.ack if ack is None else ack) and not reply:
+            self._seq = (self._seq + 1) & 0xFFFF
+            seq = self._seq
+            data += bytes("q%04x\n" % seq, "utf-8")
+        return(data, seq)
+
+    def _replied(self, msg, seq=None):
+        """check a reply of the ESP32 (the acknowledge "a<seq>" if seq is given), it answered so it is out of
+        the list mode"""
+        if seq is not None and msg != bytes("a%04x" % seq, "utf-8"):
+            raise ConnectionError("wrong acknowledge from the ESP32: %s" % msg)
+        self.list_end = None
+        return(msg)
+
+    @staticmethod
+    def _run(steps):
+        """run a sequence of calls to the ESP32 (generator yielding the calls and getting their results, see
+        _store_list), the asyncio version awaits them so both classes share the sequences"""
+        try:
+            call = next(steps)
+            while True:
+                call = steps.send(call())
+        except StopIteration as stop:
+            return(stop.value)
+
+    def _send(self, s, data):
+        """send data"""
+        s.settimeout(self._timeout())
+        s.sendall(data)
+
+    def _receive(self, s, reply, seq):
+        """read the reply and/or the acknowledge of the sequence number seq of the data sent"""
+        if reply:
+            return(self._replied(self._recv_exact(s, reply)))
+        if seq is not None:
+            self._replied(self._recv_exact(s, 5), seq)
+
+    def _lost(self):
+        """forget the connection and the state of the ESP32 after a communication error"""
+        self.disconnect()
+        self.invalidate_shadow()
+        self.memory_hash = None         # the ESP32 may have been reset, its memory lost
+
+    def transfer_ESP32(self, out, reply=0, ack=None):
+        """Transfer the data to the ESP32 via socket.
+        reply: number of bytes to read back from the ESP32 after sending, returned as bytes.
+        ack: wait till the ESP32 has executed the command, self.ack if None. The command is followed by
+             "q<seq>" with a sequence number, the ESP32 replies "a<seq>" once all the previous commands are done.
+        In session mode the persistent connection is reused, if it fails before the data is sent it is reopened
+        once and the data sent again. Once sent the data is never resent, the ESP32 may have executed it: a failed
+        reply or acknowledge raises the error and the connection is reopened by the next command.
+        """
         if len(out) > 0:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(1000)
-                s.connect((str(self.IP),int(self.port)))
-                s.send(bytes(out,"utf-8"))
+            data, seq = self._frame(out, reply, ack)
+            if self.session:
+                try:
+                    s = self.connect()
+                    self._send(s, data)
+                except OSError:
+                    # connection lost (ESP32 reset, WiFi drop...) before sending, reconnect and send again
+                    self._lost()
+                    s = self.connect()
+                    self._send(s, data)
+                try:
+                    return(self._receive(s, reply, seq))
+                except OSError:
+                    # no reply after sending, the connection is dropped so a late one is not read by the next command
+                    self._lost()
+                    raise
+            else:
+                with self.open_socket() as s:
+                    self._send(s, data)
+                    return(self._receive(s, reply, seq))
         else:
             print("empty data input")
         #print(out)
             
+    def invalidate_shadow(self):
+        """forget the state of the shadow registers, the next writes are sent in full"""
+        if self.shadow is not None: self.shadow.invalidate()
+
+    def _filter_spi(self, spi_list):
+        """drop the register writes that would not change the DDS (shadow registers), returns the hexadecimal strings to send"""
+        if self.shadow is None:
+            return(spi_list)
+        out = []
+        for spi_data in spi_list:
+            command = int(spi_data, 16)
+            filtered = self.shadow.filter_command(command)
+            if filtered == command: out.append(spi_data)
+            elif filtered != 0: out.append(hex(filtered))
+        return(out)
+
     def initialise(self):
         """initilise the DDS with the default values stored in the ESP32 non-volatile memory"""
+        self.invalidate_shadow()
         self.transfer_ESP32("i")
         
     def check(self):
         """check if the DDS its online """
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(self.ESP32timeout)
-                s.connect((str(self.IP),int(self.port)))
-                s.send(bytes("?","utf-8"))
-                msg = s.recv(1024)
-                msg = msg.decode("utf-8")
-                if (msg != "O"):
-                    raise socket.error("Device not responding correctly")
-                if (msg == "O"):
-                    print("Device responding correctly")
+            msg = self.transfer_ESP32("?", reply=1)
+            msg = msg.decode("utf-8")
+            if (msg != "O"):
+                raise socket.error("Device not responding correctly")
+            if (msg == "O"):
+                print("Device responding correctly")
         except (TimeoutError, socket.timeout, socket.error):
             print("Device not responding, check WiFi connections")
             time.sleep(0.5)
         
     def reset(self):
         """pulse the reset pin of the DDS, this completly reset DDS to default values"""
+        self.invalidate_shadow()
         self.transfer_ESP32("r") 
         
     def syncronise(self):
@@ -85,58 +352,195 @@ class DDS_ESP32():
 
     def update(self):
         """update the register by pulsing the IO_update pin"""
-        self.transfer_ESP32(self, "u")  
+        self.transfer_ESP32("u")  
         
     def direct_spi(self, spi_data):
         """ send data to the ESP32 that will be imediatly transmited to the DDS via SPi
             64bit MAX length.
         """
         if type(spi_data) is str and spi_data[1]=="x" : # command must be a hexadecimal string
-            out = "d{}\n".format(spi_data)
+            spi_list = self._filter_spi([spi_data])
+            if len(spi_list) == 0: return # nothing would change in the DDS
+            out = "d{}\n".format(spi_list[0])
+        else:
+            out = ""
+        self.transfer_ESP32(out)
+
+    def direct_spi_batch(self, spi_list):
+        """ send a list of commands to the ESP32 in a single message, they will be transmited to the DDS via SPI
+            back to back and the registers updated (IO_update) only once at the end.
+            spi_list: list of commands, integers or hexadecimal strings, 64bit MAX length each.
+        """
+        spi_list = [i if type(i) is str else hex(i) for i in spi_list]
+        if len(spi_list) > 0 and all([i[1]=="x" for i in spi_list]): # all command must be a hexadecimal string
+            spi_list = self._filter_spi(spi_list)
+            if len(spi_list) == 0: return # nothing would change in the DDS
+            out = "b" + ",".join(spi_list) + "\n"
         else:
             out = ""
         self.transfer_ESP32(out)
     
+    def _list_length(self, list_length):
+        self.memory_hash = None
+        if list_length <= INDEX_DIM:
+            yield(partial(self.transfer_ESP32, "n{}\n".format(int(list_length))))
+        else:
+            print("list lenght has to be less or equal to {} (dictionary format, {} otherwise)".format(INDEX_DIM, LIST_DIM))
+
     def list_length(self, list_length):
         """sets the length of the list to go through"""
-        if list_length <+ 10000:
-            out = "n{}\n".format(int(list_length))
-            self.transfer_ESP32(out)
+        self._run(self._list_length(list_length))
+
+    def _list_maxtime(self, list_maxtime):
+        self.memory_hash = None
+        if list_maxtime > 0 :
+            yield(partial(self.transfer_ESP32, "t{}\n".format(int(list_maxtime))))
+            self.maxtime = int(list_maxtime)/1E3
         else:
-            print("list lenght has to be less or equal to 1000")
-            
+            print("max time must be an integer larger than zero")
+
     def list_maxtime(self, list_maxtime):
         """sets the maximun time the ucontroller will be in list mode, in milisenconds"""
-        if (type(list_length) == type(120000)) and (list_length > 0) :
-            out = "t{}\n".format(int(list_maxtime))
-            self.transfer_ESP32(out)
-        else:
-            print("max time must be an integer larger than zero")
+        self._run(self._list_maxtime(list_maxtime))
+
+    list_time = list_maxtime
+
+    def memory_message(self, list_spic, binary=None):
+        """ build the message to store a list of spi commands in the memory of the ESP32
+            list_spic: list of commands, integers or hexadecimal strings.
+            binary: binary format (8 bytes per command) or ASCII one, self.binary if None.
+        """
+        binary = self.binary if binary is None else binary
+        try:
+            if binary:
+                out = encode_memory_binary(list_spic)
+            else:
+                out = encode_memory_ascii(list_spic)
+        except (ValueError, TypeError):
+            print("input list in the wrong format, each command must be an integer or a hexadeciaml string")
+            out = ""
+        return(out)
             
-    def memory_storage(self, list_spic):     
-        """ storing a list of spi commands in to the memory of the ESP332 """
-        if all([type(i) is str for i in list_spic]) and all([i[1]=="x" for i in list_spic]) : # all command must be a hexadecimal string
-            list = [str(i)+"n"+j +"w" for i,j in enumerate(list_spic)]
-            list = "".join(list)
-            out = "m" + list + "\n"
+    def memory_storage(self, list_spic, binary=None, progress=None, dictionary=False):     
+        """ storing a list of spi commands in to the memory of the ESP332
+            In binary format the list is streamed in acknowledged chunks (see memory_upload).
+            progress: function called as progress(stored, total) after each chunk stored (binary format).
+            dictionary: store the unique commands and the list as indices of them (binary format, see protocol.py),
+                        None to use it only when it is smaller or the list is longer than the memory list.
+        """
+        binary = self.binary if binary is None else binary
+        self.memory_hash = None
+        if binary and self.use_dictionary(list_spic, dictionary):
+            self.dictionary_upload(list_spic, progress=progress)
+        elif binary:
+            self.memory_upload(list_spic, progress=progress)
         else:
-            print("input list in the wrong format, each command must be a hexadeciaml string")
-            out = ""
-        self.transfer_ESP32(out)
-        time.sleep(0.05)
+            self.transfer_ESP32(self.memory_message(list_spic, binary))
+            if not self.ack: time.sleep(0.05)
+
+    @staticmethod
+    def use_dictionary(list_spic, dictionary=None):
+        """ whether a list is stored in dictionary format: dictionary if it is True or False,
+            if None when the dictionary format is smaller or the list does not fit in the memory list
+        """
+        if dictionary is not None:
+            return(dictionary)
+        if len(list_spic) > LIST_DIM:
+            return(True)
+        dictionary_bytes, memory_bytes = dictionary_size(list_spic)
+        return(dictionary_bytes < memory_bytes)
+
+    def _dictionary_upload(self, list_spic, progress=None):
+        table, indices = dictionary_encode(list_spic)
+        if len(indices) > INDEX_DIM:
+            raise ValueError("list of %d elements, the index list holds %d" % (len(indices), INDEX_DIM))
+        yield(partial(self.memory_upload, table))
+        return((yield(partial(self.memory_upload, indices, progress=progress, encode=encode_memory_index))))
+
+    def dictionary_upload(self, list_spic, progress=None):
+        """ store a list of spi commands in dictionary format: the unique commands in the memory list ('M')
+            and the list as indices of them in the index list ('D'), both streamed as in memory_upload.
+            progress: function called as progress(stored, total) after each chunk of indices stored.
+            Returns the number of elements of the list stored.
+        """
+        return(self._run(self._dictionary_upload(list_spic, progress)))
+
+    def memory_upload(self, list_spic, chunk=512, window=4, retries=3, progress=None, encode=encode_memory_binary):
+        """ stream a list of spi commands into the memory of the ESP32 in chunks (binary format).
+            Up to window chunks are in flight, the ESP32 acknowledges each one once stored, a rejected or lost
+            chunk is sent again, so the list is never silently truncated and no fixed sleeps are needed.
+            chunk: commands per chunk. window: chunks sent before waiting for an acknowledge.
+            retries: max number of times a chunk is resent before giving up (ConnectionError).
+            progress: function called as progress(stored, total) after each chunk stored.
+            encode: encoder of the chunks, encode_memory_index for the index list (dictionary format).
+            Returns the number of commands stored.
+        """
+        upload = ChunkedUpload(list_spic, chunk, window, retries, encode)
+        s = self.connect() if self.session else self.open_socket()
+        try:
+            while not upload.done:
+                try:
+                    for message in upload.messages(): self._send(s, message)
+                    stored = upload.acknowledge(self._replied(self._recv_exact(s, MEMORY_ACK.size)))
+                except (OSError, ValueError):
+                    # acknowledge lost or connection broken, reconnect and resend everything in flight
+                    upload.lost()
+                    if self.session:
+                        self.disconnect()
+                        s = self.connect()
+                    else:
+                        s.close()
+                        s = self.open_socket()
+                    continue
+                if stored and progress is not None: progress(upload.stored, upload.total)
+        finally:
+            if not self.session: s.close()
+        return(upload.stored)
                     
     def list_reset(self):
         """ clear the list and set the variable number or list elements to zero
         """
+        self.memory_hash = None
         self.transfer_ESP32("k")
+
+    def _store_list(self, memory_commands, list_maxtime=None, fresh=False):
+        key = table_hash(memory_commands, [] if list_maxtime is None else [int(list_maxtime)])
+        if key == self.memory_hash and not fresh:
+            return(False)
+        yield(self.list_reset)
+        if list_maxtime is not None:
+            yield(partial(self.list_maxtime, list_maxtime))
+        yield(partial(self.list_length, len(memory_commands)))
+        yield(partial(self.memory_storage, memory_commands, dictionary=None))
+        self.memory_hash = key
+        return(True)
+
+    def store_list(self, memory_commands, list_maxtime=None, fresh=False):
+        """ clear the list and store a new one (max time, length and commands), skipped if the same list is already
+            stored in the ESP32 (smart programming, see memory_hash). The ESP32 keeps it after the list mode.
+            memory_commands: list of commands, integers or hexadecimal strings.
+            list_maxtime: max time in list mode in miliseconds, if None the value in the ESP32 is kept.
+            fresh: store it even if it is the same one.
+            Returns True if the list was stored.
+        """
+        return(self._run(self._store_list(memory_commands, list_maxtime, fresh)))
             
+    def _list_mode(self):
+        self.invalidate_shadow()
+        yield(partial(self.transfer_ESP32, "l", ack=False))
+        self.list_end = time.monotonic() + self.maxtime
+
     def list_mode(self):
         """ sets the ESP32 in list mode, listen to the io_update pin to iterate througth the list.
+            Never acknowledged, the ESP32 does not read commands till it leaves list mode, so the next command
+            waits up to the max time in list mode (see list_left).
+            The shadow registers are invalidated, the state after the list depends on the triggers received.
         """
-        self.transfer_ESP32("l")
+        self._run(self._list_mode())
     
     # AD9959 register functions
     
+    @register_cache
     def CSR_register(self, ch_0=0b0, ch_1=0b0, ch_2=0b0, ch_3=0b0):
         """Return a number to write into the Channel Select Register (CSR) register.
         The CSR determines if channels are enabled or disabled by the status of the four channel enable bits. 
@@ -174,9 +578,10 @@ class DDS_ESP32():
         out_CSR = CSR | ch_3 | ch_2 | ch_1 | ch_0 | Open |singlebit_2wire | MSB   
         return(out_CSR)
 
-    def FR1_register(self, PLL_div, Mod_level=0b00):
+    def FR1_register(self, PLL_div, Mod_level=0b00, PPC=0b000):
         """Return a number to write into the Function Register 1 (FR1) register.
         Three bytes are assigned to this register. FR1 is used to control the mode of operation of the chip.
+        Mod_level: 2, 4, 8 or 16 levels modulation (0b00 to 0b11), PPC: profile pin configuration (see modulation.py).
         
         """
         
@@ -190,10 +595,10 @@ class DDS_ESP32():
         Pump_125uA = 0b10 << 16              # 10 (default) = the charge pump current is 125 μA
         Pump_150uA = 0b11 << 16              # 11 (default) = the charge pump current is 150 μA
         Open1 = 0b0 << 15                    # open
-        PPC_conf = 0b000  << 12              # The profile pin configuration bits control the configuration of the data and SDIO_x pins for the
+        PPC_conf = (PPC & 0b111) << 12       # The profile pin configuration bits control the configuration of the data and SDIO_x pins for the
                                              # different modulation modes. 
         RU_RD = 0b00 << 10                   # The RU/RD bits control the amplitude ramp-up/ramp-down time of a channel.
-        Mod_level = (Mod_level & 0b00) << 8  # 00 = 2-level modulation
+        Mod_level = (Mod_level & 0b11) << 8  # 00 = 2-level modulation
                                              # 01 = 4-level modulation
                                              # 10 = 8-level modulation
                                              # 11 = 16-level modulation
@@ -321,6 +726,7 @@ class DDS_ESP32():
         return(out_CFR)
 
 
+    @register_cache
     def CFTW_register(self, frequency):
         """Return a number to write into the Channel Frequency Tuning Word (CFTW0) register.
         Four bytes are assigned to this register, the frequency word its calculated in function of
@@ -337,6 +743,7 @@ class DDS_ESP32():
         out_CFRW = CFTW | CFTW_value
         return(out_CFRW)
     
+    @register_cache
     def CPOW_register(self, phase):
         """Return a number to write into the Channel Phase Offset Word (CFTW0) register.
         Two bytes are assigned to this register.
@@ -352,6 +759,7 @@ class DDS_ESP32():
         out_CPOW = CPOW | Open | CPOW_value
         return(out_CPOW)
 
+    @register_cache
     def ACR_register(self, Mul_enable=0b1, amplitude=0):
         """Return a number to write into the Amplitude Control Register (ACR) register.
         Three bytes are assigned to this register.
@@ -482,6 +890,7 @@ class DDS_ESP32():
         out_FDW = FDW | FDW_value
         return(out_FDW)
     
+    @register_cache
     def CW_register(self, N_mem, word):
         """Return a number to write into the Channel word (CW) register. This sets a word in the memory of a selected channel
         for diferent types of modulations or linear sweeps. 15 memory slots for each channel.
@@ -540,13 +949,12 @@ class DDS_ESP32():
               if not true is not sending .
         """
         # composition of the command.
-        CSR_spi = self.CSR_register(1, 1, 1, 1) 
-        FR1_spi = self.FR1_register(PLL_div) 
-        FR2_spi = self.FR2_register() 
-        CFR_spi = self.CFR_register(AFP_select)
+        CSR_spi = self.templates["CSR"][0b1111]
+        FR1_spi = self.templates["FR1"].get((PLL_div, Mod_level & 0b11)) or self.FR1_register(PLL_div, Mod_level)
+        FR2_spi = self.templates["FR2"]
+        CFR_spi = self.templates["CFR"][(AFP_select & 0b11, 0b0, 0b0, 0b0)]
         out = [CSR_spi ,FR1_spi ,FR2_spi ,CFR_spi ]
-        if send: 
-            for i in out: self.direct_spi(hex(i))
+        if send: self.direct_spi_batch(out)
         return(out)
     
     # Waveform channel setting functions 
@@ -559,7 +967,7 @@ class DDS_ESP32():
               if not true is not sending. 
         """
         
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1) << 40
+        CSR_spi = self.CSR_channel(ch) << 40
         CFTW_spi = self.CFTW_register(freq)
         
         # composition of the command.
@@ -575,7 +983,7 @@ class DDS_ESP32():
               if not true is not sending. 
         """
         
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1) << 32
+        CSR_spi = self.CSR_channel(ch) << 32
         if amp > 1023: print("max amplitude 1023, clamped")
         ACR_spi = self.ACR_register(Mul_enable=0b1, amplitude=amp)
         
@@ -592,7 +1000,7 @@ class DDS_ESP32():
               if not true is not sending. 
         """
         
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1) << 24
+        CSR_spi = self.CSR_channel(ch) << 24
         if phase > 360: print("max phase 360, clamped")
         CPOW_spi = self.CPOW_register(phase)
         
@@ -600,7 +1008,44 @@ class DDS_ESP32():
         set_phase = CSR_spi | CPOW_spi
         if send: self.direct_spi(hex(set_phase))
         return(set_phase)
-    
+
+    # Vectorised channel setting functions, array in, array out (uint64), for scan tables and memory lists.
+    # The words are bit-exact with the ones of set_frequency/set_amplitude/set_phase, same float64 calculation
+    # of the tuning word truncated to an integer, then masked and composed with integer operations.
+
+    def set_frequency_array(self, ch, freqs):
+        """Return the commands (uint64 array) to set the frequency of a channel to each value of freqs
+        ch: channel to be changed
+        freqs:  array of frequencies in Hz, max=clock x PLL, min = (clock x PLL)/ (2^32)
+        """
+        CSR_spi = np.uint64(self.CSR_channel(ch) << 40)
+        core_clock = self.pll*self.clock
+        CFTW_value = np.trunc((0xFFFFFFFF+1)*np.asarray(freqs, dtype=np.float64)/core_clock)
+        CFTW_value = CFTW_value.astype(np.int64).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+        return(CSR_spi | np.uint64(0x04 << 32) | CFTW_value)
+
+    def set_amplitude_array(self, ch, amps):
+        """Return the commands (uint64 array) to set the amplitude of a channel to each value of amps
+        ch: channel to be changed
+        amps: array of amplitudes, max 1023, 10bit word
+        """
+        amps = np.asarray(amps)
+        CSR_spi = np.uint64(self.CSR_channel(ch) << 32)
+        if np.any(amps > 1023): print("max amplitude 1023, clamped")
+        ACR_value = np.trunc(amps).astype(np.int64).astype(np.uint64) & np.uint64(0x3FF)
+        return(CSR_spi | np.uint64(self.ACR_register(Mul_enable=0b1, amplitude=0)) | ACR_value)
+
+    def set_phase_array(self, ch, phases):
+        """Return the commands (uint64 array) to set the phase of a channel to each value of phases
+        ch: channel to be changed
+        phases: array of phases in degree, max=360, min = (360)/ (2^14)
+        """
+        phases = np.asarray(phases, dtype=np.float64)
+        CSR_spi = np.uint64(self.CSR_channel(ch) << 24)
+        if np.any(phases > 360): print("max phase 360, clamped")
+        CPOW_value = np.trunc((0x3FFF+1)*phases/360).astype(np.int64).astype(np.uint64) & np.uint64(0x3FFF)
+        return(CSR_spi | np.uint64(0x05 << 16) | CPOW_value)
+
     # Modulation and ramps functions
     
     def set_2mod_frequency(self, ch, freq_2nd, send=False):
@@ -615,18 +1060,17 @@ class DDS_ESP32():
         """
         global AFP_select
         # channel selectio.n
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
+        CSR_spi = self.CSR_channel(ch)
         # select frequency modulation.
         AFP_select = 0b10
-        CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b0, SRR_IOupdate=0b0)
+        CFR_spi = self.templates["CFR"][(AFP_select, 0b0, 0b0, 0b0)]
         # save the 2nd value of frequency into the memory register number 1
         CW_spi = self.CW_register(1, freq_2nd)
        
         # composition of the command.
         out = [CSR_spi, CFR_spi, CW_spi]
        
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        if send: self.direct_spi_batch(out)     
         return(out)
     
     def set_2mod_amplitude(self, ch, amp_2nd, send=False):
@@ -641,18 +1085,17 @@ class DDS_ESP32():
         """
         global AFP_select
         # channel selection
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
+        CSR_spi = self.CSR_channel(ch)
         # select frequency modulation.
         AFP_select = 0b01
-        CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b0, SRR_IOupdate=0b0)
+        CFR_spi = self.templates["CFR"][(AFP_select, 0b0, 0b0, 0b0)]
         # save the 2nd value of frequency into the memory register number 1
         CW_spi = self.CW_register(1, amp_2nd)
 
         # composition of the command.
         out = [CSR_spi, CFR_spi, CW_spi]
        
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        if send: self.direct_spi_batch(out)     
         return(out)
     
     def set_2mod_phase(self, ch, phase_2nd, send=False):
@@ -667,26 +1110,99 @@ class DDS_ESP32():
         """
         global AFP_select
         # channel selectio.n
-        CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
+        CSR_spi = self.CSR_channel(ch)
         # select frequency modulation.
         AFP_select = 0b11
-        CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b0, SRR_IOupdate=0b0)
+        CFR_spi = self.templates["CFR"][(AFP_select, 0b0, 0b0, 0b0)]
         # save the 2nd value of frequency into the memory register number 1
         CW_spi = self.CW_register(1, phase_2nd)
 
         # composition of the command.
         out = [CSR_spi, CFR_spi, CW_spi]
        
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        if send: self.direct_spi_batch(out)     
+        return(out)
+
+    def set_mod(self, ch, AFP_select, levels, PPC=None, send=False):
+        """Generate the spi code to set a channel into a 2, 4, 8 or 16-level modulation (see modulation.py) in one batch:
+        FR1 with the number of levels and the profile pin configuration, channel selection, CFR, the level 0 in the
+        channel register (CFTW0, ACR or CPOW0) and the levels 1 to n-1 in CW1 to CW(n-1).
+        Change between levels is made via profile pins, profile_pins() gives the ones of the channel.
+        FR1 is shared by the 4 channels, with 4 levels two channels are modulated (PPC, see FOUR_LEVEL_PPC).
+        ch: channel to be changed
+        AFP_select: AMPLITUDE, FREQUENCY or PHASE
+        levels: values of the levels (Hz, amplitude or degree), 2, 4, 8 or 16 of them
+        PPC: profile pin configuration, if None the first one modulating the channel
+        send: if true send directly the command to the ESP32 and will be executed directly
+              if not true is not sending.
+        """
+        Mod_level = mod_level(len(levels))
+        PPC = default_PPC(ch, len(levels)) if PPC is None else PPC
+        profile_pins(ch, len(levels), PPC)                  # the channel has to be modulated with that PPC
+        core_clock = self.pll*self.clock
+        words = to_words(AFP_select, levels, core_clock)
+        if words.min() < 0 or words.max() > WORD_MASK[AFP_select]:
+            raise ValueError(STATUS_MESSAGES[OUT_OF_RANGE])
+        FR1_spi = self.FR1_register(self.pll, Mod_level, PPC)
+        CSR_spi = self.CSR_channel(ch)
+        CFR_spi = self.templates["CFR"][(AFP_select, 0b0, 0b0, 0b0)]
+        if AFP_select == AMPLITUDE: base_spi = self.ACR_register(Mul_enable=0b1, amplitude=levels[0])
+        elif AFP_select == FREQUENCY: base_spi = self.CFTW_register(levels[0])
+        else: base_spi = self.CPOW_register(levels[0])
+        CW_spi = [word_command(CW + level - 1, AFP_select, words[level]) for level in range(1, len(levels))]
+
+        # composition of the command.
+        out = [FR1_spi, CSR_spi, CFR_spi, base_spi] + CW_spi
+        if send: self.direct_spi_batch(out)
         return(out)
 
+    def set_mod_frequency(self, ch, freqs, PPC=None, send=False):
+        """set_mod of frequency, freqs: 2, 4, 8 or 16 frequencies in Hz"""
+        return(self.set_mod(ch, FREQUENCY, freqs, PPC, send))
+
+    def set_mod_amplitude(self, ch, amps, PPC=None, send=False):
+        """set_mod of amplitude, amps: 2, 4, 8 or 16 amplitudes, max 1023"""
+        return(self.set_mod(ch, AMPLITUDE, amps, PPC, send))
+
+    def set_mod_phase(self, ch, phases, PPC=None, send=False):
+        """set_mod of phase, phases: 2, 4, 8 or 16 phases in degree"""
+        return(self.set_mod(ch, PHASE, phases, PPC, send))
+
+    @register_cache
+    def _ramp_plan(self, AFP_select, r_time, start, stop):
+        return(plan_ramp(AFP_select, r_time, start, stop, self.pll*self.clock))
+
+    def ramp_plan(self, AFP_select, r_time, start, stop):
+        """Plan of a linear sweep (see ramp_planner.plan_ramp), cached. A copy is returned, changing it does not
+        change the cached plan.
+        AFP_select: 0b01 amplitude, 0b10 frequency, 0b11 phase
+        r_time: ramp time in sec
+        start, stop: end points of the ramp, in Hz, amplitude (max 1023) or degree
+        """
+        return(dict(self._ramp_plan(AFP_select, r_time, start, stop)))
+
+    def _ramp(self, ch, sweep_type, r_time, start, stop):
+        """channel selection, LSRR, RDW, FDW and CFR commands of a linear sweep, raises ValueError if it can not be done"""
+        global AFP_select
+        plan = self.ramp_plan(sweep_type, r_time, start, stop)
+        if plan["status"] != OK:
+            raise ValueError(STATUS_MESSAGES[plan["status"]])
+        # select the modulation
+        AFP_select = sweep_type
+        #channel selection
+        CSR_spi = self.CSR_channel(ch)
+        # set the delta time and delta value for the ramp
+        LSRR_spi, RDW_spi, FDW_spi = sweep_commands(sweep_type, plan["rate"], plan["delta"])
+        # set the modulation with linear sweep
+        CFR_spi = self.templates["CFR"][(AFP_select, 0b0, 0b1, 0b0)]
+        return(CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi)
+
     def ramp_frequency(self, ch, r_time, f_init, f_final, send=False):
         """"
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
+        (sweep ramp rate word) at each step, chosen by the ramp planner (see ramp_plan) to get the closest ramp time.
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
         f_init: start of the ramp, frequency in Hz, max=clock x PLL, min = (clock x PLL)/ (2^32)
@@ -694,70 +1210,15 @@ class DDS_ESP32():
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_f_min = core_clock/(2**32)
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_fmin = int(abs(f_final-f_init)/delta_f_min)
-        
-        try:
-            if  f_init > f_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  f_init > core_clock or f_final > core_clock:
-                print("Max freq value %s"%core_clock)
-                raise ValueError
-            if  abs(f_final-f_init) < delta_f_min:
-                print("Ramp too short, min step: ",delta_f_min, " Hz" )
-                raise ValueError
-            if (r_time)/n_points_fmin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_fmin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(f_final-f_init)/n_points_tmin < delta_f_min and (r_time)/n_points_fmin > t_RR_min:
-                    delta_f = delta_f_min
-                    t_RR = r_time/n_points_fmin
-                    n_points = n_points_fmin
-                if (r_time)/n_points_fmin < t_RR_min and abs(f_final-f_init)/n_points_tmin > delta_f_min:
-                    delta_f = abs(f_final-f_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_f)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_f )
-                
-                # select frequency modulation.
-                AFP_select = 0b10
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta freq for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_f)
-                RDW_spi = self.RDW_register(delta_f)
-                # set frequency modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of frequency into the memory register number 0
-                CFTW_spi = self.CFTW_register(frequency=f_init)
-                # save the 2nd value of frequency into the memory register number 1
-                CW_spi = self.CW_register(1, f_final)
-
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CFTW_spi,  CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi = self._ramp(ch, FREQUENCY, r_time, f_init, f_final)
+        #set 1st value of frequency into the memory register number 0
+        CFTW_spi = self.CFTW_register(frequency=f_init)
+        # save the 2nd value of frequency into the memory register number 1
+        CW_spi = self.CW_register(1, f_final)
+
+        # composition of the command.
+        out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CFTW_spi,  CW_spi]
+        if send: self.direct_spi_batch(out)     
         return(out)
     
     def ramp_amplitude(self, ch, r_time, a_init, a_final, send=False):
@@ -765,7 +1226,7 @@ class DDS_ESP32():
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
+        (sweep ramp rate word) at each step, chosen by the ramp planner (see ramp_plan) to get the closest ramp time.
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
         a_init: start of the ramp, amplitude,  max 1023, 10bit word
@@ -773,69 +1234,15 @@ class DDS_ESP32():
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_a_min = 1
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_amin = int(abs(a_final-a_init)/delta_a_min)
-        
-        try:
-            if  a_init > a_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  a_init > core_clock or a_final > core_clock:
-                print("Max amplitude value 1023" )
-                raise ValueError
-            if  abs(a_final-a_init) < delta_a_min:
-                print("Ramp too short, min step: ",delta_a_min, "" )
-                raise ValueError
-            if (r_time)/n_points_amin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_amin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(a_final-a_init)/n_points_tmin < delta_a_min and (r_time)/n_points_amin > t_RR_min:
-                    delta_a = delta_a_min
-                    t_RR = r_time/n_points_amin
-                    n_points = n_points_amin
-                if (r_time)/n_points_amin < t_RR_min and abs(a_final-a_init)/n_points_tmin > delta_a_min:
-                    delta_a = abs(a_final-a_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_a)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_a)
-                
-                # select amplitude modulation.
-                AFP_select = 0b01
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta amplitude for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_a)
-                RDW_spi = self.RDW_register(delta_a)
-                # set amplitude modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of amplitude into the memory register number 0
-                ACR_spi = self.ACR_register(Mul_enable=0b0, amplitude=a_init)
-                # save the 2nd value of amplitude into the memory register number 1
-                CW_spi = self.CW_register(1, a_final)
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi, ACR_spi, CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi = self._ramp(ch, AMPLITUDE, r_time, a_init, a_final)
+        #set 1st value of amplitude into the memory register number 0
+        ACR_spi = self.ACR_register(Mul_enable=0b0, amplitude=a_init)
+        # save the 2nd value of amplitude into the memory register number 1
+        CW_spi = self.CW_register(1, a_final)
+
+        # composition of the command.
+        out = [CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi, ACR_spi, CW_spi]
+        if send: self.direct_spi_batch(out)     
         return(out)
     
     def ramp_phase(self, ch, r_time, p_init, p_final, send=False):
@@ -843,8 +1250,7 @@ class DDS_ESP32():
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
-       
+        (sweep ramp rate word) at each step, chosen by the ramp planner (see ramp_plan) to get the closest ramp time.
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
         p_init: start of the ramp, phase in degree, max=360, min = (360)/ (2^14)
@@ -852,70 +1258,83 @@ class DDS_ESP32():
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_p_min = (360)/ (2**14)
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_pmin = int(abs(p_final-p_init)/delta_p_min)
-        
-        try:
-            if  p_init > p_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  p_init > 360 or p_final > 360:
-                print("Max phase value 360 degree" )
-                raise ValueError
-            if  abs(p_final-p_init) < delta_p_min:
-                print("Ramp too short, min step: ",delta_p_min, " degree" )
-                raise ValueError
-            if (r_time)/n_points_pmin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_pmin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(p_final-p_init)/n_points_tmin < delta_p_min and (r_time)/n_points_pmin > t_RR_min:
-                    delta_p = delta_p_min
-                    t_RR = r_time/n_points_pmin
-                    n_points = n_points_pmin
-                if (r_time)/n_points_pmin < t_RR_min and abs(p_final-p_init)/n_points_tmin > delta_p_min:
-                    delta_p = abs(p_final-p_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_p)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_p)
-                
-                # select phase modulation.
-                AFP_select = 0b11
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta phase for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_p)
-                RDW_spi = self.RDW_register(delta_p)
-                # set phase modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of phase into the memory register number 0
-                CPOW_spi = self.CPOW_register(phase=p_init)
-                # save the 2nd value of phase into the memory register number 1
-                CW_spi = self.CW_register(1, p_final)
-
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CPOW_spi, CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
+        CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi = self._ramp(ch, PHASE, r_time, p_init, p_final)
+        #set 1st value of phase into the memory register number 0
+        CPOW_spi = self.CPOW_register(phase=p_init)
+        # save the 2nd value of phase into the memory register number 1
+        CW_spi = self.CW_register(1, p_final)
+
+        # composition of the command.
+        out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CPOW_spi, CW_spi]
+        if send: self.direct_spi_batch(out)     
+        return(out)
+
+    # Broadcast functions, several channels changed at once (one IO_update)
+
+    def _broadcast(self, method, channels, *args):
+        """commands of method(ch, *args) for each channel in one IO_update window, the same writes of several channels
+        merged under one CSR mask (see optimizer.broadcast).
+        args: scalars (the same for all the channels) or one value per channel."""
+        channels = list(channels)
+        args = [np.broadcast_to(np.asarray(arg), (len(channels),)) for arg in args]
+        commands = []
+        for i, ch in enumerate(channels):
+            out = method(ch, *[arg[i].item() for arg in args])
+            commands += list(out) if isinstance(out, (list, tuple)) else [out]
+        return(broadcast(commands))
+
+    def set_frequencies(self, channels, freqs, send=False):
+        """Generate the spi code to change the frequency of several channels at once (one IO_update)
+        channels: channels to be changed
+        freqs: frequency in Hz, the same for all the channels or one per channel
+        send: if true send directly the command to the ESP32 and will be executed directly
+              if not true is not sending.
+        """
+        out = self._broadcast(self.set_frequency, channels, freqs)
+        if send: self.direct_spi_batch(out)
+        return(out)
+
+    def set_amplitudes(self, channels, amps, send=False):
+        """Generate the spi code to change the amplitude of several channels at once (one IO_update)
+        channels: channels to be changed
+        amps: amplitude, max 1023, the same for all the channels or one per channel
+        send: if true send directly the command to the ESP32 and will be executed directly
+              if not true is not sending.
+        """
+        out = self._broadcast(self.set_amplitude, channels, amps)
+        if send: self.direct_spi_batch(out)
+        return(out)
+
+    def set_phases(self, channels, phases, send=False):
+        """Generate the spi code to change the phase of several channels at once (one IO_update)
+        channels: channels to be changed
+        phases: phase in degree, the same for all the channels or one per channel
+        send: if true send directly the command to the ESP32 and will be executed directly
+              if not true is not sending.
+        """
+        out = self._broadcast(self.set_phase, channels, phases)
+        if send: self.direct_spi_batch(out)
+        return(out)
+
+    def ramp_frequencies(self, channels, r_time, f_init, f_final, send=False):
+        """Generate the spi code to set linear sweeps of frequency on several channels at once (see ramp_frequency),
+        r_time, f_init and f_final the same for all the channels or one per channel."""
+        out = self._broadcast(self.ramp_frequency, channels, r_time, f_init, f_final)
+        if send: self.direct_spi_batch(out)
+        return(out)
+
+    def ramp_amplitudes(self, channels, r_time, a_init, a_final, send=False):
+        """Generate the spi code to set linear sweeps of amplitude on several channels at once (see ramp_amplitude),
+        r_time, a_init and a_final the same for all the channels or one per channel."""
+        out = self._broadcast(self.ramp_amplitude, channels, r_time, a_init, a_final)
+        if send: self.direct_spi_batch(out)
+        return(out)
+
+    def ramp_phases(self, channels, r_time, p_init, p_final, send=False):
+        """Generate the spi code to set linear sweeps of phase on several channels at once (see ramp_phase),
+        r_time, p_init and p_final the same for all the channels or one per channel."""
+        out = self._broadcast(self.ramp_phase, channels, r_time, p_init, p_final)
+        if send: self.direct_spi_batch(out)
         return(out)
      
 
@@ -1001,6 +1420,10 @@ class DDS_ESP32():
 # example get a sequencial list of commands in hexadecimal string form
 # [hex(DDS_0.set_amplitude(0,j, send=True)) for i,j in enumerate(range(0,1023,500))]
 
+# # same list of commands computed at once as an array (uint64), can be stored directly in the ESP32 memory
+# table = DDS_0.set_amplitude_array(0, np.arange(0, 1023, 10))
+# DDS_0.memory_storage(table)
+
 # # Modulations
 
 # # example 2-level frequency modulation on channel 0 
@@ -0,0 +1,311 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# The class AsyncDDS_ESP32 is the asyncio version of DDS_ESP32, same register functions but the communications with the ucontroller
+# are coroutines, so several boards can be programmed at the same time from one event loop.
+# The protocol (framing, acknowledges, chunked upload, list mode and list bookkeeping) is the one of DDS_ESP32, only the
+# I/O is asyncio: the sequences of calls (_store_list, _list_mode...) are shared and their calls awaited here (_run).
+# arm_all/program_all initialise, upload the lists and set list mode on N boards concurrently, the total time is the one of the slowest board.
+
+# At the end are some examples of using these functions.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+# Packages importation
+import asyncio
+import inspect
+import socket
+from functools import wraps
+
+from .DDS_ESP32 import DDS_ESP32
+from .protocol import encode_memory_binary, ChunkedUpload, MEMORY_ACK
+
+
+# Async DDS Class
+class AsyncDDS_ESP32(DDS_ESP32):
+    """DDS_ESP32 with asyncio communications, always keeps one persistent connection with the ESP32.
+    The register functions (CSR_register, set_frequency, ramp_frequency...) are inherited, they only build the
+    commands (send=True raises TypeError), send them with  await dds.direct_spi_batch(commands).
+    """
+
+    def __init__(self, IP, port=80, clock=50E6, pll=10, timeout=2, binary=True, ack=False, shadow=False):
+        DDS_ESP32.__init__(self, IP, port=port, clock=clock, pll=pll, session=True, timeout=timeout, binary=binary, ack=ack,
+                           shadow=shadow)
+        self._reader = None
+        self._writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    # Communications functions with the ESP32:
+
+    async def connect(self):
+        """Open the persistent connection (reconnects if it was dropped)"""
+        if self._writer is not None and (self._writer.is_closing() or self._reader.at_eof()):
+            await self.disconnect()
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(str(self.IP), int(self.port)), self.ESP32timeout)
+            s = self._writer.get_extra_info("socket")
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    async def disconnect(self):
+        """Close the persistent connection, if any"""
+        if self._writer is not None:
+            writer = self._writer
+            self._reader, self._writer = None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    @staticmethod
+    async def _run(steps):
+        """run a sequence of calls to the ESP32 shared with DDS_ESP32 (see DDS_ESP32._run), awaiting each call"""
+        try:
+            call = next(steps)
+            while True:
+                call = steps.send(await call())
+        except StopIteration as stop:
+            return(stop.value)
+
+    async def _send(self, data):
+        """send data, the timeout covers as well the time the ESP32 may still be in list mode (see list_left)"""
+        await self.connect()
+        self._writer.write(data)
+        await asyncio.wait_for(self._writer.drain(), self._timeout())
+
+    async def _read(self, n):
+        """read exactly n bytes"""
+        return(await asyncio.wait_for(self._reader.readexactly(n), self._timeout()))
+
+    async def _receive(self, reply, seq):
+        """read the reply and/or the acknowledge of the sequence number seq of the data sent"""
+        if reply:
+            return(self._replied(await self._read(reply)))
+        if seq is not None:
+            self._replied(await self._read(5), seq)
+
+    async def _lost(self):
+        """forget the connection and the state of the ESP32 after a communication error"""
+        await self.disconnect()
+        self.invalidate_shadow()
+        self.memory_hash = None     # the ESP32 may have been reset, its memory lost
+
+    async def transfer_ESP32(self, out, reply=0, ack=None):
+        """Transfer the data to the ESP32, if the connection fails before the data is sent it is reopened once and
+        the data sent again. Once sent it is never resent (the ESP32 may have executed it), a failed reply or
+        acknowledge raises the error.
+        reply: number of bytes to read back from the ESP32 after sending, returned as bytes.
+        ack: wait till the ESP32 has executed the command (sequence number acknowledge), self.ack if None.
+        """
+        if len(out) > 0:
+            data, seq = self._frame(out, reply, ack)
+            try:
+                await self._send(data)
+            except (OSError, asyncio.TimeoutError):
+                # connection lost (ESP32 reset, WiFi drop...) before sending, reconnect and send again
+                await self._lost()
+                await self._send(data)
+            try:
+                return(await self._receive(reply, seq))
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                # no reply after sending, the connection is dropped so a late one is not read by the next command
+                await self._lost()
+                raise
+        else:
+            print("empty data input")
+
+    async def initialise(self):
+        """initilise the DDS with the default values stored in the ESP32 non-volatile memory"""
+        self.invalidate_shadow()
+        await self.transfer_ESP32("i")
+
+    async def check(self):
+        """check if the DDS its online, returns True if it is """
+        try:
+            msg = await self.transfer_ESP32("?", reply=1)
+            if msg.decode("utf-8") == "O":
+                return(True)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        print("Device %s not responding, check WiFi connections" % self.IP)
+        return(False)
+
+    async def reset(self):
+        """pulse the reset pin of the DDS, this completly reset DDS to default values"""
+        self.invalidate_shadow()
+        await self.transfer_ESP32("r")
+
+    async def syncronise(self):
+        """re-syncronise communications by pulsing the sync pin"""
+        await self.transfer_ESP32("c")
+
+    async def update(self):
+        """update the register by pulsing the IO_update pin"""
+        await self.transfer_ESP32("u")
+
+    async def direct_spi(self, spi_data):
+        """ send data to the ESP32 that will be imediatly transmited to the DDS via SPi
+            64bit MAX length.
+        """
+        if type(spi_data) is not str: spi_data = hex(spi_data)
+        if spi_data[1]=="x" : # command must be a hexadecimal string
+            spi_list = self._filter_spi([spi_data])
+            if len(spi_list) > 0: await self.transfer_ESP32("d{}\n".format(spi_list[0]))
+        else:
+            print("command must be a hexadecimal string")
+
+    async def direct_spi_batch(self, spi_list):
+        """ send a list of commands to the ESP32 in a single message, the registers are updated once at the end.
+            spi_list: list of commands, integers or hexadecimal strings, 64bit MAX length each.
+        """
+        spi_list = [i if type(i) is str else hex(i) for i in spi_list]
+        if len(spi_list) > 0 and all([i[1]=="x" for i in spi_list]): # all command must be a hexadecimal string
+            spi_list = self._filter_spi(spi_list)
+            if len(spi_list) > 0: await self.transfer_ESP32("b" + ",".join(spi_list) + "\n")
+        else:
+            print("empty list or commands not in hexadecimal format")
+
+    async def list_length(self, list_length):
+        """sets the length of the list to go through"""
+        await self._run(self._list_length(list_length))
+
+    async def list_maxtime(self, list_maxtime):
+        """sets the maximun time the ucontroller will be in list mode, in milisenconds"""
+        await self._run(self._list_maxtime(list_maxtime))
+
+    list_time = list_maxtime
+
+    async def memory_storage(self, list_spic, binary=None, progress=None, dictionary=False):
+        """ storing a list of spi commands in to the memory of the ESP32, in binary format streamed in
+            acknowledged chunks (see memory_upload), dictionary format as in DDS_ESP32.memory_storage.
+        """
+        binary = self.binary if binary is None else binary
+        self.memory_hash = None
+        if binary and self.use_dictionary(list_spic, dictionary):
+            await self.dictionary_upload(list_spic, progress=progress)
+        elif binary:
+            await self.memory_upload(list_spic, progress=progress)
+        else:
+            await self.transfer_ESP32(self.memory_message(list_spic, binary))
+
+    async def dictionary_upload(self, list_spic, progress=None):
+        """ store a list of spi commands in dictionary format, same as DDS_ESP32.dictionary_upload
+        """
+        return(await self._run(self._dictionary_upload(list_spic, progress)))
+
+    async def memory_upload(self, list_spic, chunk=512, window=4, retries=3, progress=None, encode=encode_memory_binary):
+        """ stream a list of spi commands into the memory of the ESP32 in acknowledged chunks,
+            same as DDS_ESP32.memory_upload. Returns the number of commands stored.
+        """
+        upload = ChunkedUpload(list_spic, chunk, window, retries, encode)
+        while not upload.done:
+            try:
+                for message in upload.messages(): await self._send(message)
+                stored = upload.acknowledge(self._replied(await self._read(MEMORY_ACK.size)))
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                # acknowledge lost or connection broken, reconnect and resend everything in flight
+                upload.lost()
+                await self.disconnect()
+                continue
+            if stored and progress is not None: progress(upload.stored, upload.total)
+        return(upload.stored)
+
+    async def list_reset(self):
+        """ clear the list and set the variable number or list elements to zero
+        """
+        self.memory_hash = None
+        await self.transfer_ESP32("k")
+
+    async def store_list(self, memory_commands, list_maxtime=None, fresh=False):
+        """ clear the list and store a new one, skipped if the same list is already stored in the ESP32,
+            same as DDS_ESP32.store_list. Returns True if the list was stored.
+        """
+        return(await self._run(self._store_list(memory_commands, list_maxtime, fresh)))
+
+    async def list_mode(self):
+        """ sets the ESP32 in list mode, listen to the io_update pin to iterate througth the list,
+            same as DDS_ESP32.list_mode (the next command waits up to the max time in list mode).
+        """
+        await self._run(self._list_mode())
+
+    async def arm(self, start_commands=(), memory_commands=(), list_maxtime=None, PLL_div=None, fresh=False):
+        """Same sequence as the BLACS worker transition_to_buffered: re-initialise the DDS and write the start commands
+        (one batch, one IO_update), upload the memory list if it is not the one stored already (see store_list) and
+        go to list mode.
+        start_commands, memory_commands: lists of commands, integers or hexadecimal strings.
+        list_maxtime: max time in list mode in miliseconds, if None the value in the ESP32 is kept.
+        PLL_div: PLL multiplier for the initialisation, self.pll if None.
+        fresh: upload the memory list even if it is the one stored already.
+        """
+        init = self.initialise_viaSPI(PLL_div=self.pll if PLL_div is None else PLL_div)
+        await self.direct_spi_batch(list(init) + list(start_commands))
+        if len(memory_commands) > 0:
+            await self.store_list(memory_commands, list_maxtime, fresh)
+            await self.list_mode()
+
+
+def _build_only(method):
+    """register function of DDS_ESP32 that raises TypeError with send=True, the sync send path would call the
+    coroutines direct_spi/direct_spi_batch without awaiting them"""
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def build(self, *args, **kwargs):
+        if signature.bind(self, *args, **kwargs).arguments.get("send"):
+            raise TypeError("%s(send=True) is not available in AsyncDDS_ESP32, build the commands and "
+                            "await direct_spi_batch(commands)" % method.__name__)
+        return(method(self, *args, **kwargs))
+    return(build)
+
+for _name, _method in inspect.getmembers(DDS_ESP32, inspect.isfunction):
+    if "send" in inspect.signature(_method).parameters:
+        setattr(AsyncDDS_ESP32, _name, _build_only(_method))
+
+
+# Concurrent programming of several boards
+
+async def arm_all(jobs):
+    """Arm N boards at the same time on the running event loop.
+    jobs: list of (device, kwargs) with device an AsyncDDS_ESP32 and kwargs the arguments of AsyncDDS_ESP32.arm
+    Returns the list of exceptions (None where the board was armed correctly), one per job, in the same order.
+    """
+    results = await asyncio.gather(*[device.arm(**kwargs) for device, kwargs in jobs], return_exceptions=True)
+    return([r if isinstance(r, BaseException) else None for r in results])
+
+def program_all(jobs):
+    """Blocking version of arm_all, runs its own event loop. The connections are closed at the end, they belong to
+    that event loop (a new one is used on every call)."""
+    async def run():
+        try:
+            return(await arm_all(jobs))
+        finally:
+            await asyncio.gather(*[device.disconnect() for device, kwargs in jobs])
+    return(asyncio.run(run()))
+
+
+# Examples
+
+# DDS_0 = AsyncDDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# DDS_1 = AsyncDDS_ESP32("192.168.20.105", 80, clock=50E6, pll=10)
+
+# # list of commands for each board
+# start_0 = [DDS_0.set_frequency(0, 10E6), DDS_0.set_amplitude(0, 1023)]
+# list_0 = [DDS_0.set_amplitude(0, j) for j in range(0, 1023, 10)]
+# list_1 = [DDS_1.set_frequency(1, f) for f in range(int(1E6), int(20E6), int(1E6))]
+
+# # both boards armed at the same time
+# errors = program_all([(DDS_0, dict(start_commands=start_0, memory_commands=list_0, list_maxtime=30E3)),
+#                       (DDS_1, dict(memory_commands=list_1, list_maxtime=30E3))])
+# print(errors)
@@ -0,0 +1,317 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Benchmarks of the computer side, run against the emulator (no hardware needed):
+#   generation: register words generated per second (set_frequency, set_amplitude, set_phase, ramp_frequency...)
+#   encoding:   bytes on the wire per command for each message format (dictionary format for a list toggling two commands)
+#   schedule:   duration of a list triggered as fast as the scheduler allows against 20 us between triggers, and
+#               bytes of the cost model against the emulator
+#   simulator:  time to replay a shot of 10/1000/10000 memory commands with the AD9959 model
+#   upload:     time to store lists of 10/1000/10000 commands in the ESP32 memory, binary and ASCII formats
+#   worker:     full transition_to_buffered/transition_to_manual cycles of the BLACS worker (needs BLACS installed),
+#               the first one fresh and the rest with smart programming (same list, not stored again)
+# The results are printed and can be saved as JSON to track regressions:
+#   python -m user_devices.DDS_ESP32.benchmark --json results.json
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+# Packages importation
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+
+from .DDS_ESP32 import DDS_ESP32
+from .emulator import DDS_ESP32_Emulator
+from .registers import ShadowRegisters
+from .optimizer import optimize
+from .scheduler import schedule
+from .cost_model import calibrate
+from .simulator import simulate_shot
+from .protocol import encode_memory_ascii, encode_memory_binary, commands_to_array, dictionary_size, MEMORY_HEADER
+
+
+def timeit(func, number=1000, repeat=3):
+    """Best time (s) per call of func over repeat runs of number calls, the prints of func are discarded"""
+    best = float("inf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            best = min(best, (time.perf_counter() - start)/number)
+    return(best)
+
+def _rate(seconds, words=1):
+    return({"us_per_call": 1E6*seconds, "calls_per_s": 1/seconds, "words_per_s": words/seconds})
+
+def memory_list(DDS, size):
+    """A list of size commands of the kind used in a sequence (frequency, amplitude and phase of the 4 channels)"""
+    generators = [lambda i: DDS.set_frequency(i % 4, 1E6 + 1E3*i),
+                  lambda i: DDS.set_amplitude(i % 4, i % 1024),
+                  lambda i: DDS.set_phase(i % 4, (0.1*i) % 360)]
+    return([generators[i % 3](i) for i in range(size)])
+
+
+# Benchmarks
+
+def bench_generation(DDS, number=2000):
+    """Register words generation throughput"""
+    out = {}
+    out["set_frequency"] = _rate(timeit(lambda: DDS.set_frequency(1, 12.345E6), number))
+    uncached = DDS_ESP32(DDS.IP, DDS.port, clock=DDS.clock, pll=DDS.pll, cache_size=0)
+    out["set_frequency_uncached"] = _rate(timeit(lambda: uncached.set_frequency(1, 12.345E6), number))
+    out["set_amplitude"] = _rate(timeit(lambda: DDS.set_amplitude(1, 512), number))
+    out["set_phase"] = _rate(timeit(lambda: DDS.set_phase(1, 90.5), number))
+    out["set_2mod_frequency"] = _rate(timeit(lambda: DDS.set_2mod_frequency(1, 20E6), number), 3)
+    out["initialise_viaSPI"] = _rate(timeit(lambda: DDS.initialise_viaSPI(PLL_div=DDS.pll), number), 4)
+    out["ramp_frequency"] = _rate(timeit(lambda: DDS.ramp_frequency(1, 1E-3, 10E6, 20E6), number//10), 7)
+    out["ramp_amplitude"] = _rate(timeit(lambda: DDS.ramp_amplitude(1, 1E-3, 0, 1023), number//10), 7)
+    freqs, amps, phases = np.linspace(1E6, 20E6, 10000), np.arange(10000) % 1024, np.linspace(0, 360, 10000)
+    out["set_frequency_array"] = _rate(timeit(lambda: DDS.set_frequency_array(1, freqs), 100), len(freqs))
+    out["set_amplitude_array"] = _rate(timeit(lambda: DDS.set_amplitude_array(1, amps), 100), len(amps))
+    out["set_phase_array"] = _rate(timeit(lambda: DDS.set_phase_array(1, phases), 100), len(phases))
+    return(out)
+
+def bench_encoding(DDS, size=1000):
+    """Bytes on the wire per command for each message format"""
+    commands = memory_list(DDS, size)
+    direct = sum([len("d{}\n".format(hex(c))) for c in commands])
+    batch = len("b" + ",".join([hex(c) for c in commands]) + "\n")
+    ascii = len(encode_memory_ascii(commands))
+    binary = len(encode_memory_binary(commands))
+    toggling = [DDS.set_amplitude(0, 1023*(i % 2)) for i in range(size)]
+    dictionary = dictionary_size(toggling)[0]
+    return({"commands": size,
+            "direct_spi": direct/size,
+            "direct_spi_batch": batch/size,
+            "memory_ascii": ascii/size,
+            "memory_binary": binary/size,
+            "memory_dictionary_toggling": dictionary/size,
+            "memory_binary_header": MEMORY_HEADER.size})
+
+def bench_shadow(DDS, size=1000):
+    """Register writes and SPI bytes removed by the shadow registers, for an amplitude scan on one channel
+    (as in DDS_AD9959_test.py) and for the mixed list of memory_list, both after the initialisation"""
+    out = {}
+    sequences = {"scan": [DDS.set_amplitude(0, j % 1024) for j in range(size)], "mixed": memory_list(DDS, size)}
+    for name, commands in sequences.items():
+        shadow = ShadowRegisters()
+        shadow.apply(DDS.initialise_viaSPI(PLL_div=DDS.pll))
+        start = time.perf_counter()
+        filtered = shadow.filter(commands, keep_empty=True)
+        seconds = time.perf_counter() - start
+        nbytes = lambda c: (int(c).bit_length() + 7)//8
+        out[name] = {"writes_in": shadow.writes_in, "writes_out": shadow.writes_out,
+                     "bytes_in": sum([nbytes(c) for c in commands]), "bytes_out": sum([nbytes(c) for c in filtered]),
+                     "seconds": seconds}
+    return(out)
+
+def bench_optimizer(DDS, size=1000):
+    """Commands, register writes and SPI bytes before -> after the optimizer, for start commands setting the 4 channels
+    to the same values and the list of memory_list"""
+    start = ([DDS.set_amplitude(ch, 1023) for ch in range(4)] + [DDS.set_frequency(ch, 10E6) for ch in range(4)]
+             + [DDS.set_phase(ch, 0) for ch in range(4)])
+    begin = time.perf_counter()
+    _, _, report = optimize(start, memory_list(DDS, size), initial=DDS.initialise_viaSPI(PLL_div=DDS.pll))
+    report = {name: {"before": before, "after": after} for name, (before, after) in report.items()}
+    report["seconds"] = time.perf_counter() - begin
+    return(report)
+
+def bench_schedule(DDS, size=1000, spacing=20E-6):
+    """Duration (s) of the list of memory_list with the triggers of the scheduler against a fixed spacing, time
+    to schedule it and largest error of the bytes of the cost model (calibrate)"""
+    memory = memory_list(DDS, size)
+    begin = time.perf_counter()
+    _, triggers = schedule(memory)
+    seconds = time.perf_counter() - begin
+    return({"commands": size, "fixed_spacing": spacing*(size - 1), "scheduled": triggers[-1] - triggers[0],
+            "seconds": seconds, "bytes_error": calibrate(memory)["bytes_error"]})
+
+def bench_simulator(DDS, sizes=(10, 1000, 10000), repeat=3):
+    """Time to replay a shot (initialisation and memory_list, one trigger every 10 us) with the AD9959 model"""
+    results = {}
+    init = DDS.initialise_viaSPI(PLL_div=DDS.pll)
+    for size in sizes:
+        memory = memory_list(DDS, size)
+        triggers = 10E-6*np.arange(1, size + 1)
+        best = min([timeit(lambda: simulate_shot((), memory, triggers, initial=init, clock=DDS.clock, pll=DDS.pll),
+                           number=1) for i in range(repeat)])
+        results[size] = {"seconds": best}
+    return(results)
+
+def bench_upload(sizes=(10, 1000, 10000), latency=0, bandwidth=None, repeat=3):
+    """Time to store lists of commands in the ESP32 memory (list_reset + list_length + memory_storage) on the emulator"""
+    out = {}
+    with DDS_ESP32_Emulator(latency=latency, bandwidth=bandwidth) as emulator:
+        DDS = DDS_ESP32(emulator.host, emulator.port, session=True, ack=True)
+        for binary in (True, False):
+            fmt = "binary" if binary else "ascii"
+            out[fmt] = {}
+            for size in sizes:
+                commands = memory_list(DDS, size)
+                best = float("inf")
+                for _ in range(repeat):
+                    emulator.clear_log()
+                    start = time.perf_counter()
+                    DDS.list_reset()
+                    DDS.list_length(size)
+                    DDS.memory_storage(commands, binary=binary)
+                    best = min(best, time.perf_counter() - start)
+                if not np.array_equal(emulator.spi_memory[:size], np.array(commands, dtype=np.uint64)):
+                    raise RuntimeError("memory list stored in the emulator differs from the one sent (%s, %d)" % (fmt, size))
+                out[fmt][str(size)] = {"seconds": best, "commands_per_s": size/best,
+                                       "bytes": emulator.bytes_received, "bytes_per_command": emulator.bytes_received/size}
+        DDS.disconnect()
+    return(out)
+
+def write_shot(path, device_name, start_commands, memory_commands, stop_time=1.0, legacy=False, compression=None):
+    """Write a shot file with the same layout as the one generated by labscript for this device.
+    legacy: commands as hexadecimal strings, the format of the shot files before the uint64 datasets.
+    """
+    import h5py
+    with h5py.File(path, "w") as f:
+        group = f.create_group("devices/%s" % device_name)
+        for name, commands in (("start_commands", start_commands), ("memory_commands", memory_commands)):
+            if legacy:
+                group.create_dataset(name, data=np.array([hex(c).encode() for c in commands], dtype=h5py.special_dtype(vlen=bytes)))
+            else:
+                data = np.array(commands, dtype=np.uint64)
+                group.create_dataset(name, data=data, chunks=(min(len(data), 4096),), compression=compression)
+        f.create_group("devices/pulseblaster_0").attrs["stop_time"] = stop_time
+
+def bench_shot_file(sizes=(10, 1000, 10000), repeat=3):
+    """Time to write and read back the commands of a shot file and size of the file, for each storage format"""
+    import h5py
+    out = {}
+    DDS = DDS_ESP32("127.0.0.1", 0)
+    with tempfile.TemporaryDirectory() as folder:
+        for fmt, kwargs in (("hex", {"legacy": True}), ("uint64", {}), ("uint64_gzip", {"compression": "gzip"})):
+            out[fmt] = {}
+            for size in sizes:
+                commands = memory_list(DDS, size)
+                path = os.path.join(folder, "%s_%d.h5" % (fmt, size))
+                write = timeit(lambda: write_shot(path, "dds", commands[:4], commands, **kwargs), 1, repeat)
+                def read():
+                    with h5py.File(path, "r") as f:
+                        return(commands_to_array(f["devices/dds/memory_commands"][:]))
+                read_time = timeit(read, 1, repeat)
+                if not np.array_equal(read(), np.array(commands, dtype=np.uint64)):
+                    raise RuntimeError("commands read from the shot file differ from the ones written (%s, %d)" % (fmt, size))
+                out[fmt][str(size)] = {"write": write, "read": read_time, "bytes": os.path.getsize(path)}
+    return(out)
+
+def bench_worker(sizes=(10, 1000, 10000), cycles=5, latency=0, bandwidth=None):
+    """Time of full transition_to_buffered/transition_to_manual cycles of the BLACS worker on the emulator, the first
+    one fresh (list stored) and the rest with smart programming (same shot, list not stored again)"""
+    try:
+        from .blacs_workers import DDS_ESP32Worker
+    except ImportError as e:
+        return({"skipped": str(e)})
+    out = {}
+    panel = {"channel %d" % i: {"freq": 10.0 + i, "amp": 512, "phase": 0.0} for i in range(4)}
+    with DDS_ESP32_Emulator(latency=latency, bandwidth=bandwidth) as emulator, tempfile.TemporaryDirectory() as folder:
+        # worker built without a BLACS process, the attributes are the ones BLACS passes to it
+        worker = DDS_ESP32Worker.__new__(DDS_ESP32Worker)
+        worker.IP, worker.port, worker.clock, worker.pll = emulator.host, emulator.port, 50E6, 10
+        worker.device_name = "dds_esp32"
+        with contextlib.redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(panel)
+            for size in sizes:
+                commands = memory_list(worker.DDS_AD9959, size)
+                path = os.path.join(folder, "shot_%d.h5" % size)
+                write_shot(path, worker.device_name, commands[:4], commands)
+                buffered, manual = [], []
+                for cycle in range(cycles):
+                    start = time.perf_counter()
+                    worker.transition_to_buffered(worker.device_name, path, panel, cycle == 0)
+                    emulator.wait_list_mode()
+                    buffered.append(time.perf_counter() - start)
+                    emulator.run_list()
+                    start = time.perf_counter()
+                    worker.transition_to_manual()
+                    worker.DDS_AD9959.check()
+                    manual.append(time.perf_counter() - start)
+                smart = min(buffered[1:]) if cycles > 1 else buffered[0]
+                out[str(size)] = {"transition_to_buffered_fresh": buffered[0], "transition_to_buffered": smart,
+                                  "transition_to_manual": min(manual), "cycle": smart + min(manual)}
+            worker.shutdown()
+    return(out)
+
+def run(sizes=(10, 1000, 10000), latency=0, bandwidth=None, number=2000, cycles=5):
+    """Run all the benchmarks, returns a dictionary with the results"""
+    DDS = DDS_ESP32("127.0.0.1", 0, clock=50E6, pll=10)
+    return({"info": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                     "numpy": np.__version__, "machine": platform.machine(),
+                     "latency": latency, "bandwidth": bandwidth},
+            "generation": bench_generation(DDS, number),
+            "encoding": bench_encoding(DDS),
+            "shadow": bench_shadow(DDS),
+            "optimizer": bench_optimizer(DDS),
+            "schedule": bench_schedule(DDS),
+            "simulator": bench_simulator(DDS, sizes),
+            "upload": bench_upload(sizes, latency, bandwidth),
+            "shot_file": bench_shot_file(sizes),
+            "worker": bench_worker(sizes, cycles, latency, bandwidth)})
+
+def report(results):
+    """Print the results as a table"""
+    print("generation (us per call)")
+    for name, r in results["generation"].items():
+        print("  %-24s %10.2f" % (name, r["us_per_call"]))
+    print("encoding (bytes per command)")
+    for name, r in results["encoding"].items():
+        if name != "commands": print("  %-24s %10.2f" % (name, r))
+    print("shadow registers (writes in -> out, SPI bytes in -> out)")
+    for name, r in results["shadow"].items():
+        print("  %-8s %d -> %d, %d -> %d" % (name, r["writes_in"], r["writes_out"], r["bytes_in"], r["bytes_out"]))
+    print("optimizer (before -> after)")
+    for name, r in results["optimizer"].items():
+        if name != "seconds": print("  %-16s %d -> %d" % (name, r["before"], r["after"]))
+    r = results["schedule"]
+    print("schedule (ms for %d commands)" % r["commands"])
+    print("  fixed spacing: %.2f  scheduled: %.2f  bytes error: %d" % (1E3*r["fixed_spacing"], 1E3*r["scheduled"],
+                                                                     r["bytes_error"]))
+    print("simulator (ms)")
+    print("  " + "  ".join(["%s: %.2f" % (size, 1E3*v["seconds"]) for size, v in results["simulator"].items()]))
+    print("upload (ms)")
+    for fmt, r in results["upload"].items():
+        print("  %-8s " % fmt + "  ".join(["%s: %.2f" % (size, 1E3*v["seconds"]) for size, v in r.items()]))
+    print("shot file (ms write / ms read / kB)")
+    for fmt, r in results["shot_file"].items():
+        print("  %-12s " % fmt + "  ".join(["%s: %.2f/%.2f/%.1f" % (size, 1E3*v["write"], 1E3*v["read"], v["bytes"]/1E3)
+                                             for size, v in r.items()]))
+    print("worker cycle (ms)")
+    if "skipped" in results["worker"]:
+        print("  skipped: %s" % results["worker"]["skipped"])
+    for size, r in results["worker"].items():
+        if size != "skipped":
+            print("  %-8s buffered: %.2f (fresh %.2f)  manual: %.2f" % (size, 1E3*r["transition_to_buffered"],
+                                                                     1E3*r["transition_to_buffered_fresh"],
+                                                                     1E3*r["transition_to_manual"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DDS_ESP32 benchmarks against the emulator")
+    parser.add_argument("--json", help="file to save the results")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="list lengths")
+    parser.add_argument("--latency", type=float, default=0, help="round trip time of the emulated link (s)")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second of the emulated link")
+    parser.add_argument("--number", type=int, default=2000, help="calls per generation benchmark")
+    parser.add_argument("--cycles", type=int, default=5, help="worker cycles per list length")
+    args = parser.parse_args()
+    results = run(args.sizes, args.latency, args.bandwidth, args.number, args.cycles)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -57,4 +57,4 @@ class DDS_ESP32Tab(DeviceTab):
         self.primary_worker = 'main_worker'
 
         self.supports_remote_value_check(False)
-        self.supports_smart_programming(False) 
+        self.supports_smart_programming(True)
@@ -15,7 +15,8 @@ from blacs.tab_base_classes import Worker
 import socket
 import labscript_utils.h5_lock
 import h5py
-import time
+
+from .protocol import commands_to_array
 
 
 class DDS_ESP32Worker(Worker):
@@ -27,7 +28,10 @@ class DDS_ESP32Worker(Worker):
         Checks if the ESP32 is responding correctly
         """
         from .DDS_ESP32 import DDS_ESP32
-        self.DDS_AD9959 = DDS_ESP32(self.IP, port=self.port, clock=self.clock, pll=self.pll)
+        # one persistent connection for the whole life of the worker, avoids a TCP handshake per command,
+        # each command acknowledged by the ESP32 once done, so no need to wait between commands,
+        # shadow registers so the writes that would not change the DDS (re-initialisations, CSR...) are not sent
+        self.DDS_AD9959 = DDS_ESP32(self.IP, port=self.port, clock=self.clock, pll=self.pll, session=True, ack=True, shadow=True)
         
         self.ESP32timeout = 3
         self.shot_file = None
@@ -37,50 +41,38 @@ class DDS_ESP32Worker(Worker):
         
 
     def transition_to_buffered(self, device_name, h5_file, panel_values, refresh):
-        """Reading DDS commands in the shot file and send to the ESP32"""
-        
-        self.DDS_AD9959.initialise_viaSPI(PLL_div=self.pll, send=True) # re-initialise the DDS (cautional)
-        time.sleep(0.05)
-        
-        self.DDS_AD9959.list_reset() # Clear the list and set the variable number or list elements to zero
-        time.sleep(0.05)
+        """Reading DDS commands in the shot file and send to the ESP32.
+        Smart programming: the memory list is only stored if it is not the one the ESP32 already has (same hash,
+        see DDS_ESP32.store_list), unless refresh. The start commands are always written, the front panel
+        values were written to the DDS after the last shot."""
 
         self.shot_file  = h5_file
         with h5py.File(self.shot_file, "r") as f:
             group = f[f"devices/{self.device_name}"]
 
             if "start_commands" in group:
-                # print("start")
-                dds_commands_list = group["start_commands"][:]
-                for command in dds_commands_list:
-                    command = command.decode("UTF-8")
-                    self.DDS_AD9959.direct_spi(command) 
-                    time.sleep(0.01) # cautional                   
-            else: dds_commands_list = None
-            
+                # uint64 dataset read at once (older shot files have hexadecimal strings, converted as well)
+                dds_commands_list = commands_to_array(group["start_commands"][:])
+            else: dds_commands_list = []
+            # re-initialise the DDS (cautional) and all the start commands in one message, registers updated once at the end
+            self.DDS_AD9959.direct_spi_batch(list(self.DDS_AD9959.initialise_viaSPI(PLL_div=self.pll)) + list(dds_commands_list))
+
             if "memory_commands" in group:
-                # print("memory")
-                dds_memory_list = group["memory_commands"][:]
-                # print(dds_memory_list[-1])
+                dds_memory_list = commands_to_array(group["memory_commands"][:])
                 # set the maximun time allow the ESP32 be in list mode,
                 # the stop time from the hdf file is use for this 
                 stop_time = int(1E3*f["devices/pulseblaster_0"].attrs["stop_time"])
-                self.DDS_AD9959.list_time(stop_time)
-                # print(stop_time)
-                # set the dimension of the array to going through
-                self.DDS_AD9959.list_length(len(dds_memory_list)) 
-                
-                # storing in the ESP32 memory
-                self.DDS_AD9959.memory_storage(list(dds_memory_list))
-                time.sleep(0.01) # cautional
-                
-                self.DDS_AD9959.list_mode()                   
+                # storing in the ESP32 memory (dictionary format if the list repeats commands enough to be smaller),
+                # skipped if the ESP32 has it already
+                if not self.DDS_AD9959.store_list(dds_memory_list, list_maxtime=stop_time, fresh=refresh):
+                    print("memory list unchanged, not stored again")
+
+                self.DDS_AD9959.list_mode()
             else: dds_memory_list = None
 
         return {}
 
     def transition_to_manual(self):
-        time.sleep(0.01) # cautional                   
         self.DDS_AD9959.initialise_viaSPI(PLL_div=self.pll, send=True) # re-initialise the DDS (cautional)
 
         for i in range(4):
@@ -100,7 +92,6 @@ class DDS_ESP32Worker(Worker):
         # change values in the front panel
         global old_panel_values
         self.DDS_AD9959.initialise_viaSPI(PLL_div=self.pll, send=True) # re-initialise the DDS (cautional)
-        time.sleep(0.05) # cautional
 
         if not len(old_panel_values) == 0:
             for i in range(4):
@@ -127,6 +118,11 @@ class DDS_ESP32Worker(Worker):
 
     def abort_buffered(self):
         print('abort_buffered: ...')
+        # the ESP32 reads no command in list mode, it leaves it once the stop time of the shot (list_maxtime) has
+        # passed, the next command waits for it (see DDS_ESP32.list_left)
+        left = self.DDS_AD9959.list_left()
+        if left > 0:
+            print("ESP32 in list mode for up to {:.1f} s more, the front panel is updated after it".format(left))
         return self.abort()
 
     def abort_transition_to_buffered(self):
@@ -135,4 +131,5 @@ class DDS_ESP32Worker(Worker):
         return self.abort()
 
     def shutdown(self):
+        self.DDS_AD9959.disconnect()
         return True
@@ -0,0 +1,129 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Timing model of the list mode of the ESP32. After each trigger the isr() takes the next element of the list
+# (list_command) and writes it with memory_spi, that skips the leading zero bytes and sends the rest with one
+# hspi->transfer per byte. A register write is 2 (CSR), 3 (FR2, CPOW, LSRR), 4 (FR1, CFR, ACR) or 5 bytes (CFTW, RDW,
+# FDW, CW), a memory command up to 8. The time of an element is modelled as:
+#   isr_overhead + bytes*(8/spi_clock + byte_overhead)
+#   isr_overhead:  interrupt latency, list_command, the CS and the loop over the 8 bytes of memory_spi
+#   byte_overhead: time of hspi->transfer on top of the 8 clock periods of the byte
+# The trigger of an element can not come before the previous one plus the trigger width (the isr() runs on the
+# falling edge) and the time of the element (spacing).
+# calibrate() writes the commands as the isr() does on the emulator, that follows memory_spi and takes its own isr and
+# per byte overheads, checks the bytes and fits both overheads (fit) to the time taken. The default overheads
+# (ISR_OVERHEAD, BYTE_OVERHEAD, also the ones of the emulator) are uncalibrated estimates, not measured on an ESP32:
+# measure them on the hardware (CS on a scope) and fit them with fit() before relying on the tightest trigger spacing.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+SPI_CLOCK = 20E6        # Hz, hspi of the firmware
+ISR_OVERHEAD = 3E-6     # s per element, uncalibrated estimate
+BYTE_OVERHEAD = 1E-6    # s per byte, uncalibrated estimate
+SHIFTS = np.arange(56, -8, -8, dtype=np.uint64)     # bytes of a command, most significant first as memory_spi
+
+
+def spi_bytes(commands):
+    """bytes sent by memory_spi for each command, array. The transfer starts at the first byte that is a register
+    address (below 0x19) or the 0x20 flag of the CSR, the ones before are skipped."""
+    commands = np.asarray(commands, dtype=np.uint64).reshape(-1)
+    data = (commands[:, None] >> SHIFTS) & np.uint64(0xFF)
+    first = (data > 0) & ((data < 0x19) | (data == 0x20))
+    return(np.where(first.any(axis=1), len(SHIFTS) - np.argmax(first, axis=1), 0))
+
+
+class CostModel():
+    """Time of the elements of the list mode (see the top of the file).
+    spi_clock: SPI clock (Hz)
+    isr_overhead: time (s) of the isr() besides the bytes
+    byte_overhead: time (s) of each byte besides its 8 clock periods
+    """
+
+    def __init__(self, spi_clock=SPI_CLOCK, isr_overhead=ISR_OVERHEAD, byte_overhead=BYTE_OVERHEAD):
+        self.spi_clock = spi_clock
+        self.isr_overhead = isr_overhead
+        self.byte_overhead = byte_overhead
+
+    def __repr__(self):
+        return("CostModel(spi_clock=%g, isr_overhead=%g, byte_overhead=%g)" % (self.spi_clock, self.isr_overhead,
+                                                                                self.byte_overhead))
+
+    @property
+    def byte_time(self):
+        """time (s) of a byte"""
+        return(8/self.spi_clock + self.byte_overhead)
+
+    def estimate(self, commands):
+        """time (s) of the isr() writing each command, array"""
+        return(self.isr_overhead + spi_bytes(commands)*self.byte_time)
+
+    def spacing(self, commands, trigger_width=0.0):
+        """minimum time (s) from the previous trigger to the trigger of each command of a list, array.
+        The first one is 0, it is written when the list mode starts."""
+        out = trigger_width + self.estimate(commands)
+        if len(out):
+            out[0] = 0.0
+        return(out)
+
+    def list_time(self, commands, trigger_width=0.0):
+        """shortest time (s) from the first trigger to the last one of a list"""
+        return(float(self.spacing(commands, trigger_width).sum()))
+
+    @classmethod
+    def fit(cls, commands, durations, spi_clock=SPI_CLOCK):
+        """Model fitted (least squares) to durations (s) measured for commands, the SPI clock is not fitted
+        (only the time per byte), the byte_overhead is the time per byte left"""
+        n = spi_bytes(commands).astype(np.float64)
+        A = np.stack([np.ones(len(n)), n], axis=1)
+        (isr_overhead, byte_time), *_ = np.linalg.lstsq(A, np.asarray(durations, dtype=np.float64), rcond=None)
+        return(cls(spi_clock, float(isr_overhead), float(byte_time - 8/spi_clock)))
+
+
+def calibrate(commands, emulator=None):
+    """Fit the model to the emulator: each command is written as the isr() does, the bytes logged are compared with
+    spi_bytes and both overheads fitted (fit) to the virtual time taken, with the SPI clock of the emulator.
+    commands: commands of different lengths (bytes), so the isr and per byte overheads can be told apart.
+    Returns a dictionary: bytes_error (largest difference of bytes), model (fitted CostModel) and time_error
+    (largest difference (s) between the fitted model and the times taken)."""
+    if emulator is None:
+        from .emulator import DDS_ESP32_Emulator     # only needed here, not to schedule the triggers
+        emulator = DDS_ESP32_Emulator()
+    sent, durations = [], []
+    for command in commands:
+        begin, logged = emulator.time, len(emulator.log)
+        emulator.memory_spi(command)
+        sent.append(sum([len(data) for _, kind, data in emulator.log[logged:] if kind == "spi"]))
+        durations.append(emulator.time - begin)
+    sent, durations = np.array(sent), np.array(durations)
+    model = CostModel.fit(commands, durations, spi_clock=emulator.spi_clock)
+    return({"bytes_error": int(np.abs(sent - spi_bytes(commands)).max()) if len(sent) else 0, "model": model,
+            "time_error": float(np.abs(model.estimate(commands) - durations).max()) if len(sent) else 0.0})
+
+DEFAULT_MODEL = CostModel()
+
+def estimate(commands, model=None):
+    """time (s) of the isr() writing each command with the model (default: DEFAULT_MODEL), array"""
+    return((DEFAULT_MODEL if model is None else model).estimate(commands))
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+# DDS_0 = DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# # 2, 3, 4 and 5 bytes register writes: CSR, CPOW, ACR and CFTW (with and without the CSR of the set_ commands)
+# commands = [DDS_0.CSR_register(1, 0, 0, 0), DDS_0.CPOW_register(90), DDS_0.ACR_register(amplitude=512),
+#             DDS_0.CFTW_register(10E6), DDS_0.set_frequency(0, 10E6)]
+# print(spi_bytes(commands), 1E6*estimate(commands))
+# # fitted to the emulator (here with the overheads measured on a board) and the shortest list time of 1000 amplitudes
+# # (2 us trigger pulses)
+# from .emulator import DDS_ESP32_Emulator
+# print(calibrate(commands, DDS_ESP32_Emulator(isr_overhead=4E-6, byte_overhead=0.8E-6)))
+# print(DEFAULT_MODEL.list_time(DDS_0.set_amplitude_array(0, np.linspace(0, 1023, 1000)), trigger_width=2E-6))
+# # overheads measured on the hardware (s per command)
+# model = CostModel.fit(commands, [5.1E-6, 6.3E-6, 7.0E-6, 7.9E-6, 11.2E-6])
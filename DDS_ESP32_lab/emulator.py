@@ -0,0 +1,445 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# The class DDS_ESP32_Emulator is a stand-in of the ESP32 for testing and benchmarking without hardware. It listens on localhost
+# and speaks the same protocol as DDS_ESP32.ino (opcodes i ? r c u d b n t m M D k l q), with the 10000 elements memory list,
+# the index list of the dictionary format and the list mode, where the triggers (falling edges on the INT pin) are simulated by calling trigger().
+# Nothing is sent to a real AD9959, the SPI transfers and IO_updates are recorded in a log instead.
+# A virtual clock counts the time the ESP32 would spend (SPI transfers, delays, list mode) and the link latency and
+# bandwidth can be set to mimic the WiFi. The SPI transfers take the isr and per byte overheads of the cost model
+# (cost_model.py), set them to the ones measured on the hardware to emulate a given board.
+
+# It can run alone, to point a DDS_ESP32 or BLACS to it, as a module of the package (it uses relative imports):
+#   python -m user_devices.DDS_ESP32.emulator --port 8080 --latency 2E-3
+
+# At the end are some examples of using it.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+# Packages importation
+import socket
+import threading
+import time
+import numpy as np
+
+from .protocol import (decode_memory_ascii, decode_memory_header, encode_memory_ack, MEMORY_HEADER, MEMORY_RECORD,
+                       MEMORY_FLAG_ACK, INDEX_RECORD, INDEX_DIM, LIST_MAXTIME)
+from .cost_model import SPI_CLOCK, ISR_OVERHEAD, BYTE_OVERHEAD
+
+
+class _Stream():
+    """Blocking reads from the client socket (same helpers as the firmware: byte, line, exact number of bytes).
+    The received data is throttled to the bandwidth of the emulated link."""
+
+    def __init__(self, conn, emulator):
+        self.conn = conn
+        self.emulator = emulator
+        self.buffer = b""
+
+    def _fill(self):
+        data = self.conn.recv(65536)
+        if not data:
+            raise EOFError("client disconnected")
+        self.emulator.bytes_received += len(data)
+        if self.emulator.bandwidth:
+            time.sleep(len(data)/self.emulator.bandwidth)
+        self.buffer += data
+
+    def read(self, n=1):
+        while len(self.buffer) < n:
+            self._fill()
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return(data)
+
+    def read_line(self):
+        while b"\n" not in self.buffer:
+            self._fill()
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return(line.decode("utf-8"))
+
+
+# Emulator Class
+class DDS_ESP32_Emulator():
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, bandwidth=None, spi_clock=SPI_CLOCK, listdim=10000, indexdim=INDEX_DIM,
+                 isr_overhead=ISR_OVERHEAD, byte_overhead=BYTE_OVERHEAD):
+        """
+        host, port: address to listen on, port 0 picks a free one (see self.port once started).
+        latency: round trip time (s) of the link, added before each reply of the ESP32.
+        bandwidth: bytes per second of the link (None, no limit).
+        spi_clock: SPI clock (Hz) of the ESP32, used for the virtual clock.
+        listdim: max number of elements in the memory list.
+        indexdim: max number of elements in the index list (dictionary format).
+        isr_overhead: time (s) of the isr() writing an element of the list besides its bytes (memory_spi).
+        byte_overhead: time (s) of each byte transfered via SPI besides its 8 clock periods.
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.spi_clock = spi_clock
+        self.isr_overhead = isr_overhead
+        self.byte_overhead = byte_overhead
+        self.listdim = listdim
+        self.indexdim = indexdim
+
+        self.spi_memory = np.zeros(listdim, dtype=np.uint64)  # memory list of the ESP32
+        self.spi_index = np.zeros(indexdim, dtype=np.uint16)  # index list, dictionary format
+        self.dict_mode = False                                 # list mode goes through the index list
+        self.n_items = 0                                       # number of items to iterate through
+        self.maxcycletime = LIST_MAXTIME                       # max time in list mode (ms)
+        self.list_ele = 0                                      # list iteration variable
+        self.list_active = False                               # True while in list mode
+        self.list_start = 0.0                                  # virtual time the list mode started
+        self.time = 0.0                                        # virtual clock of the ESP32 (s)
+        self.log = []                                          # (virtual time, "spi"/"update"/"init"/"reset"/"sync", bytes)
+        self.opcodes = {}                                      # number of messages received per opcode
+        self.bytes_received = 0
+        self.clients = 0                                       # number of connections served
+
+        self._cond = threading.Condition()
+        self._server = None
+        self._thread = None
+        self._conn = None
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Server
+
+    def start(self):
+        """Start listening, the clients are served one at a time like in the ESP32"""
+        self._server = socket.create_server((self.host, self.port))
+        self.port = self._server.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="DDS_ESP32_Emulator", daemon=True)
+        self._thread.start()
+        return(self.host, self.port)
+
+    def stop(self):
+        """Stop the server, leaves list mode if the ESP32 was on it"""
+        self._running = False
+        with self._cond:
+            self._end_list()
+        if self._conn is not None:
+            try:
+                self._conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join(2)
+            self._thread = None
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break
+            self.clients += 1
+            self._conn = conn
+            with conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self._client(_Stream(conn, self))
+                except (EOFError, OSError):
+                    pass
+            self._conn = None
+
+    def _reply(self, conn, data):
+        if self.latency:
+            time.sleep(self.latency)
+        conn.sendall(data)
+
+    def _client(self, stream):
+        """Same loop as the one in DDS_ESP32.ino"""
+        while self._running:
+            with self._cond:
+                # the ESP32 does not read the client while it is in list mode
+                while self.list_active and self._running:
+                    self._cond.wait()
+            ch = stream.read(1).decode("utf-8", "replace")
+            self.opcodes[ch] = self.opcodes.get(ch, 0) + 1
+            if ch == "i":
+                self.init_DDS()
+            elif ch == "?":
+                self._reply(stream.conn, b"O")
+            elif ch == "q":
+                line = stream.read_line()
+                self._reply(stream.conn, bytes("a" + line, "utf-8"))
+            elif ch == "r":
+                self.reset_DDS()
+            elif ch == "c":
+                self.reset_comm()
+            elif ch == "u":
+                self.IO_update()
+            elif ch == "b":
+                line = stream.read_line()
+                if len(line) > 0:
+                    for command in line.split(","):
+                        if command: self.spi_write(command)
+                    self.IO_update()
+            elif ch == "d":
+                line = stream.read_line()
+                if len(line) > 0:
+                    self.spi_write(line)
+                    self.IO_update()
+            elif ch == "n":
+                self.n_items = self._to_int(stream.read_line())
+            elif ch == "t":
+                self.maxcycletime = self._to_int(stream.read_line())
+            elif ch == "m":
+                for index, command in decode_memory_ascii(stream.read_line()):
+                    if 0 <= index < self.listdim:
+                        self.spi_memory[index] = command
+            elif ch == "M":
+                self._memory_binary(stream)
+            elif ch == "D":
+                self._memory_index(stream)
+            elif ch == "k":
+                self.spi_memory[:] = 0
+                self.spi_index[:] = 0
+                self.dict_mode = False
+                self.n_items = 0
+            elif ch == "l":
+                self._start_list()
+
+    def _memory_binary(self, stream):
+        header = b"M" + stream.read(MEMORY_HEADER.size - 1)
+        _, version, flags, start, count = MEMORY_HEADER.unpack(header)
+        body = stream.read(count*MEMORY_RECORD.itemsize)
+        try:
+            decode_memory_header(header)
+            ok = start <= self.listdim and count <= self.listdim - start
+        except ValueError:
+            ok = False
+        if ok:
+            self.spi_memory[start:start + count] = np.frombuffer(body, dtype=MEMORY_RECORD)
+        if flags & MEMORY_FLAG_ACK:
+            self._reply(stream.conn, encode_memory_ack(start, ok))
+
+    def _memory_index(self, stream):
+        header = b"D" + stream.read(MEMORY_HEADER.size - 1)
+        _, version, flags, start, count = MEMORY_HEADER.unpack(header)
+        body = stream.read(count*INDEX_RECORD.itemsize)
+        try:
+            decode_memory_header(header, b"D")
+            ok = start <= self.indexdim and count <= self.indexdim - start
+        except ValueError:
+            ok = False
+        if ok:
+            self.spi_index[start:start + count] = np.frombuffer(body, dtype=INDEX_RECORD)
+            self.dict_mode = True
+        if flags & MEMORY_FLAG_ACK:
+            self._reply(stream.conn, encode_memory_ack(start, ok))
+
+    def list_command(self, i):
+        """command of the element i of the list, through the index list in dictionary format (list_command() in the firmware)"""
+        if self.dict_mode:
+            if i >= self.n_items or i >= self.indexdim or self.spi_index[i] >= self.listdim:
+                return(0)       # nothing past the list
+            return(self.spi_memory[self.spi_index[i]])
+        return(self.spi_memory[i] if i < self.listdim else 0)
+
+    @staticmethod
+    def _to_int(line):
+        """String.toInt() of Arduino, 0 if it is not a number"""
+        try:
+            return(int(line))
+        except ValueError:
+            return(0)
+
+    # Emulated hardware functions of the firmware
+
+    def _spi(self, data):
+        self.time += len(data)*(8/self.spi_clock + self.byte_overhead)
+        self.log.append((self.time, "spi", bytes(data)))
+
+    def IO_update(self):
+        self.log.append((self.time, "update", b""))
+
+    def reset_DDS(self):
+        self.time += 10E-3
+        self.log.append((self.time, "reset", b""))
+
+    def reset_comm(self):
+        self.log.append((self.time, "sync", b""))
+
+    def init_DDS(self):
+        """hard coded initialisation of the firmware, reset + FR1, FR2, CFR"""
+        self.time += 1E-3
+        self.reset_DDS()
+        self.time += 1E-3
+        self.reset_comm()
+        self.time += 1E-3
+        self.log.append((self.time, "init", b""))
+        self._spi(bytes([0x01, 0b11010011, 0x00, 0x00]))
+        self.time += 500E-6
+        self._spi(bytes([0x02, 0x00, 0x00]))
+        self.time += 500E-6
+        self._spi(bytes([0x03, 0x00, 0x03, 0x14]))
+        self.IO_update()
+
+    def spi_write(self, command):
+        """transfer a hexadecimal string via SPI, same parsing as spi_write() in the firmware"""
+        l = len(command)
+        value = int(command, 0) & 0xFFFFFFFFFFFFFFFF
+        l = 4*(l - 2) - 8 if l % 2 == 0 else 4*(l - 1) - 8
+        out = []
+        for i in range(l, -1, -8):
+            spi_out = (value >> i) & 0xFF
+            if i == l and spi_out > 0x18: spi_out = 0x00
+            out.append(spi_out)
+        self._spi(bytes(out))
+
+    def memory_spi(self, command):
+        """transfer a command of the memory list via SPI, same as memory_spi() in the firmware,
+        leading zero bytes skipped and the 0x20 flag sent as the CSR address"""
+        self.time += self.isr_overhead
+        out = []
+        flag = True
+        for i in range(56, -8, -8):
+            spi_out = (int(command) >> i) & 0xFF
+            if flag and spi_out > 0x00:
+                if spi_out < 0x19:
+                    out.append(spi_out)
+                    flag = False
+                elif spi_out == 0x20:
+                    out.append(0x00)
+                    flag = False
+            elif not flag:
+                out.append(spi_out)
+        self._spi(bytes(out))
+
+    # List mode
+
+    def _start_list(self):
+        with self._cond:
+            self.list_ele = 0
+            self.list_active = True
+            self.list_start = self.time
+            self.memory_spi(self.list_command(self.list_ele))
+            self._cond.notify_all()
+            self._check_list()
+
+    def _end_list(self):
+        if self.list_active:
+            self.list_active = False
+            self.list_ele = 0
+            self._cond.notify_all()
+
+    def _check_list(self):
+        """conditions of the firmware to leave list mode"""
+        if self.list_ele + 1 > self.n_items or 1E3*(self.time - self.list_start) > self.maxcycletime:
+            self._end_list()
+
+    @property
+    def in_list_mode(self):
+        return(self.list_active)
+
+    def wait_list_mode(self, timeout=2):
+        """wait till the ESP32 goes to list mode, returns True if it did before the timeout"""
+        end = time.monotonic() + timeout
+        with self._cond:
+            while not self.list_active:
+                left = end - time.monotonic()
+                if left <= 0:
+                    return(False)
+                self._cond.wait(min(left, 0.01))
+        return(True)
+
+    def trigger(self, n=1, dt=0):
+        """simulate n falling edges on the INT pin, each one updates the registers (the trigger drives the
+        IO_update pin in list mode) and writes the next element of the list.
+        dt: virtual time (s) between the triggers, the list mode ends if maxcycletime is passed.
+        Returns the number of triggers received in list mode."""
+        done = 0
+        with self._cond:
+            for _ in range(n):
+                self.time += dt
+                self._check_list()
+                if not self.list_active:
+                    break
+                self.IO_update()
+                self.list_ele += 1
+                self.memory_spi(self.list_command(self.list_ele))
+                done += 1
+                self._check_list()
+        return(done)
+
+    def run_list(self, dt=0):
+        """trigger till the end of the list"""
+        return(self.trigger(max(self.n_items - self.list_ele, 0), dt))
+
+    def advance(self, dt):
+        """advance the virtual clock, the list mode ends if maxcycletime is passed"""
+        with self._cond:
+            self.time += dt
+            if self.list_active:
+                self._check_list()
+
+    # Log
+
+    def spi_writes(self):
+        """list of the bytes transfered via SPI"""
+        return([data for _, kind, data in self.log if kind == "spi"])
+
+    def updates(self):
+        """number of IO_updates"""
+        return(len([1 for _, kind, _ in self.log if kind == "update"]))
+
+    def clear_log(self):
+        """clear the log and the counters, the memory list is kept"""
+        with self._cond:
+            self.log = []
+            self.opcodes = {}
+            self.bytes_received = 0
+
+
+# Running the emulator alone, to point a DDS_ESP32 or BLACS to it: python -m user_devices.DDS_ESP32.emulator
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="ESP32/AD9959 emulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="round trip time (s)")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second")
+    parser.add_argument("--isr-overhead", type=float, default=ISR_OVERHEAD, help="time (s) of the isr() besides the bytes")
+    parser.add_argument("--byte-overhead", type=float, default=BYTE_OVERHEAD, help="time (s) per byte besides its clock")
+    args = parser.parse_args()
+    with DDS_ESP32_Emulator(args.host, args.port, args.latency, args.bandwidth, isr_overhead=args.isr_overhead,
+                            byte_overhead=args.byte_overhead) as emulator:
+        print("emulator listening on %s:%d" % (emulator.host, emulator.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+
+# with DDS_ESP32_Emulator(latency=2E-3, bandwidth=1E6) as emulator:
+#     DDS = DDS_ESP32(emulator.host, emulator.port, session=True, ack=True)
+#     DDS.set_frequency(0, 10E6, send=True)
+#     DDS.list_length(3)
+#     DDS.memory_storage([DDS.set_amplitude(0, a) for a in (0, 500, 1023)])
+#     DDS.list_mode()
+#     emulator.wait_list_mode()
+#     emulator.run_list(dt=1E-3)
+#     print(emulator.spi_writes())
+#     DDS.disconnect()
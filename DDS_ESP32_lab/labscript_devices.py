@@ -16,6 +16,21 @@ import h5py
 import numpy as np
 from labscript import Device, LabscriptError, set_passed_properties
 import socket
+from bisect import bisect_left, bisect_right
+from weakref import WeakKeyDictionary
+
+from .registers import ShadowRegisters
+from .optimizer import optimize, print_report, broadcast
+from .ramp_planner import AMPLITUDE, FREQUENCY, PHASE
+from .waveform_compiler import SWEEP_TYPES
+from .scheduler import schedule
+from .DDS_ESP32 import DDS_ESP32 as DDS_ESP32Builder
+from .cost_model import DEFAULT_MODEL
+from .simulator import simulate_shot, sample
+
+# state changes (edges) the timed events put in the trigger and profile lines, shared by the windows and devices setting
+# the same state at the same time: {output: {time: [state, windows using it, instruction there before or None]}}
+_edges = WeakKeyDictionary()
 
 class DDS_ESP32(Device):
     """A labscript_device for controlling a DDS using a WiFi ESP32 uC intermediate device.
@@ -24,23 +39,67 @@ class DDS_ESP32(Device):
             com_port: tupple (HOST, PORT), IP and port of the ESP32
             clock:  (clock input frequency)
             pll:  multiplier of the clock input frequency
+        compression: compression of the command datasets in the shot file (None, "gzip", "lzf")
+        shadow: if true the register writes that would not change the DDS are removed at compile time, off by
+                default: a memory command left empty is stored as 0 and the ESP32 writes nothing at its trigger
+        optimize: if true the commands are optimized at compile time (see optimizer.py), merging the writes of
+                  several channels and dropping the ones overwritten before the IO_update, checked against the
+                  original ones on the AD9959 model (see check_optimized), off by default
+        report: if true the before/after counts of the optimizer are printed at compile time
+        trigger_line: output (e.g. DigitalOut) triggering the list mode of the ESP32, its rising edges are stored
+                      in the shot file (trigger_times) so runviewer can place the memory commands in time
+        profile_lines: outputs (e.g. DigitalOut) driving the profile pins P0-P3, needed by the ramps of the channels
+        trigger_width: width of the trigger pulses (s) for the timed events
+        trigger_spacing: minimum time between the trigger pulses (s), None for the earliest legal one of each memory
+                         command (its SPI bytes and the isr() overhead, see scheduler.py)
+        cost_model: timing model of the ESP32 used to schedule the triggers (cost_model.CostModel), None for the default
+
+        Timed events: DDS_0.ch[n].setfreq(t, f), .setamp(t, a), .setphase(t, p), .ramp(t, duration, start, stop) and
+        DDS_0.add_commands(t, commands) are compiled when they are made (see add_event), their trigger pulses and
+        profile pin changes added to the outputs and the memory commands stored in generate_code, no to_memory nor
+        pulses by hand. The lines can be shared (e.g. one trigger line for several boards) as long as the other
+        instructions do not set them to a different state at the same times (see add_edge).
     """
     description = 'AD9959_DDS via ESP32 WiFi communication'
 
     @set_passed_properties(
         property_names = {
-            'connection_table_properties': ['IP', 'port', 'clock', 'pll']})
+            'connection_table_properties': ['IP', 'port', 'clock', 'pll'],
+            'device_properties': ['compression', 'shadow', 'optimize', 'trigger_width', 'trigger_spacing']})
 
-    def __init__(self, name, IP="192.168.20.103", port=80, clock=50E6, pll=10, **kwargs):
+    def __init__(self, name, IP="192.168.20.103", port=80, clock=50E6, pll=10, compression=None, shadow=False,
+                 optimize=False, report=False, trigger_line=None, profile_lines=None, trigger_width=2E-6, trigger_spacing=None,
+                 cost_model=None, **kwargs):
 
         Device.__init__(self, name, None, IP, **kwargs)
+        # the outputs and the cost model are not serialisable, their names and constants are stored instead
+        self.set_property('trigger_line', None if trigger_line is None else trigger_line.name, 'device_properties')
+        self.set_property('profile_lines', None if profile_lines is None else [line.name for line in profile_lines],
+                          'device_properties')
+        self.set_property('cost_model', repr(DEFAULT_MODEL if cost_model is None else cost_model), 'device_properties')
         self.name = name
         self.BLACS_connection = IP
         self.port = port
         self.clock = clock
         self.pll = pll
+        # register builder of the driver (DDS_ESP32.py), never connected (send=False), the register functions added
+        # to the driver are not copied here but called on it
+        self.builder = DDS_ESP32Builder(IP, port, clock=clock, pll=pll)
         self.start_commands = []
         self.memory_commands = []
+        self.compression = compression # compression of the command datasets in the shot file (None, "gzip", "lzf")
+        self.shadow = shadow
+        self.optimize = optimize
+        self.report = report
+        self.trigger_line = trigger_line
+        self.profile_lines = profile_lines
+        self.trigger_width = trigger_width
+        self.trigger_spacing = trigger_spacing
+        self.cost_model = cost_model
+        self.events = []        # timed events (t, ch, AFP_select, value, ramp or commands), see add_event
+        self.windows = {}       # compiled IO_update window of each time, see compile_window
+        self.channel_windows = [[] for ch in range(4)]  # times of the windows with events of each channel, sorted
+        self.ch = [DDS_ESP32Channel(self, ch) for ch in range(4)]
         self.ESP32timeout = 5000
 
     global AFP_select
@@ -179,9 +238,10 @@ class DDS_ESP32(Device):
         out_CSR = CSR | ch_3 | ch_2 | ch_1 | ch_0 | Open |singlebit_2wire | MSB   
         return(out_CSR)
 
-    def FR1_register(self, PLL_div, Mod_level=0b00):
+    def FR1_register(self, PLL_div, Mod_level=0b00, PPC=0b000):
         """Return a number to write into the Function Register 1 (FR1) register.
         Three bytes are assigned to this register. FR1 is used to control the mode of operation of the chip.
+        Mod_level: 2, 4, 8 or 16 levels modulation (0b00 to 0b11), PPC: profile pin configuration (see modulation.py).
         
         """
         
@@ -195,10 +255,10 @@ class DDS_ESP32(Device):
         Pump_125uA = 0b10 << 16              # 10 (default) = the charge pump current is 125 μA
         Pump_150uA = 0b11 << 16              # 11 (default) = the charge pump current is 150 μA
         Open1 = 0b0 << 15                    # open
-        PPC_conf = 0b000  << 12              # The profile pin configuration bits control the configuration of the data and SDIO_x pins for the
+        PPC_conf = (PPC & 0b111) << 12       # The profile pin configuration bits control the configuration of the data and SDIO_x pins for the
                                              # different modulation modes. 
         RU_RD = 0b00 << 10                   # The RU/RD bits control the amplitude ramp-up/ramp-down time of a channel.
-        Mod_level = (Mod_level & 0b00) << 8  # 00 = 2-level modulation
+        Mod_level = (Mod_level & 0b11) << 8  # 00 = 2-level modulation
                                              # 01 = 4-level modulation
                                              # 10 = 8-level modulation
                                              # 11 = 16-level modulation
@@ -546,7 +606,7 @@ class DDS_ESP32(Device):
         """
         # composition of the command.
         CSR_spi = self.CSR_register(1, 1, 1, 1) 
-        FR1_spi = self.FR1_register(PLL_div) 
+        FR1_spi = self.FR1_register(PLL_div, Mod_level) 
         FR2_spi = self.FR2_register() 
         CFR_spi = self.CFR_register(AFP_select)
         out = [CSR_spi ,FR1_spi ,FR2_spi ,CFR_spi ]
@@ -606,6 +666,20 @@ class DDS_ESP32(Device):
         if send: self.direct_spi(hex(set_phase))
         return(set_phase)
     
+    # Vectorised channel setting functions, array in, array out (uint64), bit-exact with set_frequency/set_amplitude/set_phase
+
+    def set_frequency_array(self, ch, freqs):
+        """Return the commands (uint64 array) to set the frequency of a channel to each value of freqs (Hz)"""
+        return(self.builder.set_frequency_array(ch, freqs))
+
+    def set_amplitude_array(self, ch, amps):
+        """Return the commands (uint64 array) to set the amplitude of a channel to each value of amps (max 1023)"""
+        return(self.builder.set_amplitude_array(ch, amps))
+
+    def set_phase_array(self, ch, phases):
+        """Return the commands (uint64 array) to set the phase of a channel to each value of phases (degree)"""
+        return(self.builder.set_phase_array(ch, phases))
+
     # Modulation and ramps functions
     
     def set_2mod_frequency(self, ch, freq_2nd, send=False):
@@ -686,12 +760,54 @@ class DDS_ESP32(Device):
             for i in out: self.direct_spi(hex(i))     
         return(out)
 
+    def set_mod(self, ch, AFP_select, levels, PPC=None, send=False):
+        """Generate the spi code (built by the driver, see builder) to set a channel into a 2, 4, 8 or 16-level
+        modulation (see modulation.py):
+        FR1 with the number of levels and the profile pin configuration, channel selection, CFR, the level 0 in the
+        channel register (CFTW0, ACR or CPOW0) and the levels 1 to n-1 in CW1 to CW(n-1).
+        ch: channel to be changed
+        AFP_select: AMPLITUDE, FREQUENCY or PHASE
+        levels: values of the levels (Hz, amplitude or degree), 2, 4, 8 or 16 of them
+        PPC: profile pin configuration, if None the first one modulating the channel
+        send: if true send directly the command to the ESP32 and will be executed directly
+              if not true is not sending.
+        """
+        return(self._send(self.builder.set_mod(ch, AFP_select, levels, PPC), send))
+
+    def set_mod_frequency(self, ch, freqs, PPC=None, send=False):
+        """set_mod of frequency, freqs: 2, 4, 8 or 16 frequencies in Hz"""
+        return(self.set_mod(ch, FREQUENCY, freqs, PPC, send))
+
+    def set_mod_amplitude(self, ch, amps, PPC=None, send=False):
+        """set_mod of amplitude, amps: 2, 4, 8 or 16 amplitudes, max 1023"""
+        return(self.set_mod(ch, AMPLITUDE, amps, PPC, send))
+
+    def set_mod_phase(self, ch, phases, PPC=None, send=False):
+        """set_mod of phase, phases: 2, 4, 8 or 16 phases in degree"""
+        return(self.set_mod(ch, PHASE, phases, PPC, send))
+
+    def _send(self, out, send):
+        """send one by one the commands built by the driver (see builder) if send, returns them"""
+        if send:
+            for i in out: self.direct_spi(hex(i))
+        return(out)
+
+    def _ramp(self, ch, sweep_type, r_time, start, stop, send):
+        """commands of a linear sweep built by the driver (see builder), raises ValueError if it can not be done.
+        The modulation selected (AFP_select) is the one of the sweep, as after the other modulation functions."""
+        global AFP_select
+        ramps = {FREQUENCY: self.builder.ramp_frequency, AMPLITUDE: self.builder.ramp_amplitude,
+                 PHASE: self.builder.ramp_phase}
+        out = ramps[sweep_type](ch, r_time, start, stop)
+        AFP_select = sweep_type
+        return(self._send(out, send))
+
     def ramp_frequency(self, ch, r_time, f_init, f_final, send=False):
         """"
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
+        (sweep ramp rate word) at each step, chosen by the ramp planner of the driver (see DDS_ESP32.ramp_plan).
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
         f_init: start of the ramp, frequency in Hz, max=clock x PLL, min = (clock x PLL)/ (2^32)
@@ -699,78 +815,14 @@ class DDS_ESP32(Device):
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_f_min = core_clock/(2**32)
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_fmin = int(abs(f_final-f_init)/delta_f_min)
-        
-        try:
-            if  f_init > f_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  f_init > core_clock or f_final > core_clock:
-                print("Max freq value %s"%core_clock)
-                raise ValueError
-            if  abs(f_final-f_init) < delta_f_min:
-                print("Ramp too short, min step: ",delta_f_min, " Hz" )
-                raise ValueError
-            if (r_time)/n_points_fmin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_fmin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(f_final-f_init)/n_points_tmin < delta_f_min and (r_time)/n_points_fmin > t_RR_min:
-                    delta_f = delta_f_min
-                    t_RR = r_time/n_points_fmin
-                    n_points = n_points_fmin
-                if (r_time)/n_points_fmin < t_RR_min and abs(f_final-f_init)/n_points_tmin > delta_f_min:
-                    delta_f = abs(f_final-f_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_f)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_f )
-                
-                # select frequency modulation.
-                AFP_select = 0b10
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta freq for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_f)
-                RDW_spi = self.RDW_register(delta_f)
-                # set frequency modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of frequency into the memory register number 0
-                CFTW_spi = self.CFTW_register(frequency=f_init)
-                # save the 2nd value of frequency into the memory register number 1
-                CW_spi = self.CW_register(1, f_final)
-
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CFTW_spi,  CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
-        return(out)
+        return(self._ramp(ch, FREQUENCY, r_time, f_init, f_final, send))
     
     def ramp_amplitude(self, ch, r_time, a_init, a_final, send=False):
         """"
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
+        (sweep ramp rate word) at each step, chosen by the ramp planner of the driver (see DDS_ESP32.ramp_plan).
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
         a_init: start of the ramp, amplitude,  max 1023, 10bit word
@@ -778,77 +830,14 @@ class DDS_ESP32(Device):
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_a_min = 1
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_amin = int(abs(a_final-a_init)/delta_a_min)
-        
-        try:
-            if  a_init > a_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  a_init > core_clock or a_final > core_clock:
-                print("Max amplitude value 1023" )
-                raise ValueError
-            if  abs(a_final-a_init) < delta_a_min:
-                print("Ramp too short, min step: ",delta_a_min, "" )
-                raise ValueError
-            if (r_time)/n_points_amin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_amin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(a_final-a_init)/n_points_tmin < delta_a_min and (r_time)/n_points_amin > t_RR_min:
-                    delta_a = delta_a_min
-                    t_RR = r_time/n_points_amin
-                    n_points = n_points_amin
-                if (r_time)/n_points_amin < t_RR_min and abs(a_final-a_init)/n_points_tmin > delta_a_min:
-                    delta_a = abs(a_final-a_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_a)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_a)
-                
-                # select amplitude modulation.
-                AFP_select = 0b01
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta amplitude for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_a)
-                RDW_spi = self.RDW_register(delta_a)
-                # set amplitude modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of amplitude into the memory register number 0
-                ACR_spi = self.ACR_register(Mul_enable=0b0, amplitude=a_init)
-                # save the 2nd value of amplitude into the memory register number 1
-                CW_spi = self.CW_register(1, a_final)
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, RDW_spi, FDW_spi, CFR_spi, ACR_spi, CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
-        return(out)
+        return(self._ramp(ch, AMPLITUDE, r_time, a_init, a_final, send))
     
     def ramp_phase(self, ch, r_time, p_init, p_final, send=False):
         """"
         Setting the Slope of the Linear Sweep
         The slope of the linear sweep is set by the intermediate step size
         (delta-tuning word) between S0 (memory 0 or actual value) and E0 (memory 1 see CW_register) and the time spent
-        (sweep ramp rate word) at each step.
+        (sweep ramp rate word) at each step, chosen by the ramp planner of the driver (see DDS_ESP32.ramp_plan).
        
         ch: channel to be changed
         r_time: ramp time in sec (max time step: 2.048 \u03BCs,  min time step: 8 ns )
@@ -857,86 +846,310 @@ class DDS_ESP32(Device):
         send: if true send directly the command to the ESP32 and will be executed directly
               if not true is not sending. 
         """
-        
-        global AFP_select    
-        t_RR_max = 2.048E-6
-        t_RR_min = 8E-9
-        core_clock = self.pll*self.clock
-        delta_p_min = (360)/ (2**14)
-        n_points_tmin = int(r_time/t_RR_min)
-        n_points_pmin = int(abs(p_final-p_init)/delta_p_min)
-        
+        return(self._ramp(ch, PHASE, r_time, p_init, p_final, send))
+    # Broadcast functions, several channels changed at once (one IO_update)
+    # Built by the driver (see builder), the same writes of several channels merged under one CSR mask.
+    # The commands returned are one IO_update window: all of them in the start commands, or in the memory (one trigger)
+    # when they are a single command.
+
+    def set_frequencies(self, channels, freqs):
+        """spi code to change the frequency (Hz) of several channels at once, one value or one per channel"""
+        return(self.builder.set_frequencies(channels, freqs))
+
+    def set_amplitudes(self, channels, amps):
+        """spi code to change the amplitude (max 1023) of several channels at once, one value or one per channel"""
+        return(self.builder.set_amplitudes(channels, amps))
+
+    def set_phases(self, channels, phases):
+        """spi code to change the phase (degree) of several channels at once, one value or one per channel"""
+        return(self.builder.set_phases(channels, phases))
+
+    def ramp_frequencies(self, channels, r_time, f_init, f_final):
+        """spi code of linear sweeps of frequency on several channels at once (see ramp_frequency)"""
+        return(self.builder.ramp_frequencies(channels, r_time, f_init, f_final))
+
+    def ramp_amplitudes(self, channels, r_time, a_init, a_final):
+        """spi code of linear sweeps of amplitude on several channels at once (see ramp_amplitude)"""
+        return(self.builder.ramp_amplitudes(channels, r_time, a_init, a_final))
+
+    def ramp_phases(self, channels, r_time, p_init, p_final):
+        """spi code of linear sweeps of phase on several channels at once (see ramp_phase)"""
+        return(self.builder.ramp_phases(channels, r_time, p_init, p_final))
+
+    # Timed events, compiled window by window as they are added
+
+    def add_commands(self, t, commands):
+        """timed commands (e.g. the ones of set_2mod_amplitude), written in one IO_update window at time t"""
+        self.add_event(t, -1, 0b00, None, [int(c) for c in commands])
+
+    def add_event(self, t, ch, AFP_select, value, payload):
+        """Add a timed event (see DDS_ESP32Channel) and compile its IO_update window at once, so the trigger pulses
+        and the profile pin changes are in the trigger_line and profile_lines when the call is made, like the
+        triggers of any other labscript device.
+        ch: channel, -1 for commands (payload)
+        AFP_select: quantity of the setting or the ramp
+        value: value of a setting, None for a ramp or commands
+        payload: (duration, start, stop) of a ramp or the commands
+        The later windows of the channel are compiled again while its sweep after them changes.
+        """
+        if self.trigger_line is None:
+            raise LabscriptError("%s: timed events need a trigger_line" % self.name)
+        if ch >= 0 and payload is not None and self.profile_lines is None:
+            raise LabscriptError("%s: ramps need the profile_lines (P0-P3) to start" % self.name)
+        t = float(t)
+        event = (t, ch, AFP_select, value, payload)
+        self.events.append(event)
+        if t not in self.windows:
+            self.windows[t] = {"events": [], "commands": [], "triggers": [], "profile": [], "sweeping": {},
+                               "edges": []}
+        self.windows[t]["events"].append(event)
+        if ch >= 0:
+            times = self.channel_windows[ch]
+            i = bisect_left(times, t)
+            if i == len(times) or times[i] != t:
+                times.insert(i, t)
+        pending = [t]
+        while pending:
+            t_window = pending.pop()
+            for c in self.compile_window(t_window):
+                times = self.channel_windows[c]
+                i = bisect_right(times, t_window)
+                if i < len(times):
+                    pending.append(times[i])
+
+    def sweep(self, ch, t):
+        """sweep of a channel before the window at time t, (AFP_select, start time) or None"""
+        times = self.channel_windows[ch]
+        i = bisect_left(times, t)
+        return(self.windows[times[i - 1]]["sweeping"][ch] if i > 0 else None)
+
+    def compile_window(self, t):
+        """Compile the IO_update window at time t, its events merged in as few commands as possible (see
+        optimizer.broadcast), triggered the last one at t and the rest as late as possible before it (see
+        scheduler.schedule). A ramp drives the profile pin of the channel high at t (low trigger_width before if the
+        channel is still sweeping) and a setting of the same quantity stops the sweep (CFR without modulation,
+        profile pin low). The trigger pulses and profile pin changes of the window replace the previous ones.
+        Returns the channels whose sweep after the window changed.
+        """
+        setters = {FREQUENCY: self.set_frequency, AMPLITUDE: self.set_amplitude, PHASE: self.set_phase}
+        ramps = {FREQUENCY: self.ramp_frequency, AMPLITUDE: self.ramp_amplitude, PHASE: self.ramp_phase}
+        window = self.windows[t]
+        sweeping = {c: self.sweep(c, t) for _, c, _, _, _ in window["events"] if c >= 0}
+        commands, profile = [], []
+        for _, c, sweep_type, value, payload in window["events"]:
+            if c < 0:
+                commands += payload
+            elif payload is not None:
+                try:
+                    commands += ramps[sweep_type](c, *payload)
+                except ValueError as e:
+                    raise LabscriptError("%s: ramp of channel %d at %s s, %s" % (self.name, c, t, e))
+                if sweeping[c] is not None:
+                    # the profile pin is still high, it has to go low before the rising edge of the new sweep
+                    if t - self.trigger_width <= sweeping[c][1]:
+                        raise LabscriptError("%s: ramp of channel %d at %s s, less than trigger_width after the "
+                                             "previous one" % (self.name, c, t))
+                    profile.append((t - self.trigger_width, c, 0))
+                sweeping[c] = (sweep_type, t)
+                profile.append((t, c, 1))
+            else:
+                if sweeping[c] is not None and sweeping[c][0] == sweep_type:
+                    commands += [self.builder.CSR_channel(c), self.builder.CFR_register(AFP_select=0b00)]
+                    sweeping[c] = None
+                    profile.append((t, c, 0))
+                commands.append(setters[sweep_type](c, value))
+        if len(commands) > 1:
+            commands = broadcast(commands)
+        if len(commands) == 1 and t >= 0:
+            # one command, triggered at t (most of the events)
+            commands, triggers = [int(commands[0])], [t]
+        else:
+            try:
+                commands, triggers = schedule(commands, [t]*len(commands), trigger_width=self.trigger_width,
+                                              model=self.cost_model, min_spacing=self.trigger_spacing or 0.0,
+                                              merge=False)
+            except ValueError as e:
+                raise LabscriptError("%s: DDS events at %s s, %s" % (self.name, t, e))
+
+        self.remove_edges(window)
+        for trigger in triggers:
+            self.add_edge(window, self.trigger_line, trigger, 1)
+            self.add_edge(window, self.trigger_line, trigger + self.trigger_width, 0)
+        for t_pin, c, state in profile:
+            self.add_edge(window, self.profile_lines[c], t_pin, state)
+        changed = [c for c in sweeping if sweeping[c] != window["sweeping"].get(c)]
+        window.update(commands=commands, triggers=triggers, profile=profile, sweeping=sweeping)
+        return(changed)
+
+    def add_edge(self, window, output, t, state):
+        """Set an output (trigger line or profile pin) to state at time t for a window, recorded so it is removed
+        when the window is compiled again (see remove_edges). Shared with any other window or device setting the
+        same state at the same time, LabscriptError if another instruction sets it to a different one."""
+        key = round(t, 10)              # labscript rounds the times of the instructions to 0.1 ns
+        edges = _edges.setdefault(output, {})
+        current = output.instructions.get(key)
+        edge = edges.get(key)
+        if edge is not None and current == edge[0]:
+            if edge[0] != state:
+                raise LabscriptError("%s: %s set high and low at %s s by the DDS events" % (self.name, output.name, key))
+            edge[1] += 1
+        else:
+            if current is not None and current != state:
+                raise LabscriptError("%s: %s already set to %s at %s s, the DDS events need it %s"
+                                     % (self.name, output.name, current, key, "high" if state else "low"))
+            if state: output.go_high(t)
+            else: output.go_low(t)
+            edge = edges[key] = [state, 1, current]
+        window["edges"].append((output, key, edge))
+
+    def remove_edges(self, window):
+        """Remove the trigger pulses and profile pin changes of a compiled window from the outputs, only the ones
+        no other window or device uses and no other instruction has replaced since (see add_edge)"""
+        for output, key, edge in window["edges"]:
+            edge[1] -= 1
+            if edge[1] > 0 or _edges[output].get(key) is not edge:
+                continue
+            del _edges[output][key]
+            if output.instructions.get(key) == edge[0]:
+                if edge[2] is None: del output.instructions[key]
+                else: output.instructions[key] = edge[2]
+        window["edges"] = []
+
+    def compile_events(self):
+        """Memory commands of the compiled windows in time order, checked against each other: each trigger after the
+        previous one plus the time of the isr() writing its command (see scheduler.schedule).
+        Returns (memory commands, trigger times, profile pin changes [(t, ch, state)]).
+        """
+        times = sorted(self.windows)
+        commands = [command for t in times for command in self.windows[t]["commands"]]
+        window_t = [t for t in times for _ in self.windows[t]["commands"]]
         try:
-            if  p_init > p_final:
-                print("initial value has to be larger than the second")
-                raise ValueError
-            if  p_init > 360 or p_final > 360:
-                print("Max phase value 360 degree" )
-                raise ValueError
-            if  abs(p_final-p_init) < delta_p_min:
-                print("Ramp too short, min step: ",delta_p_min, " degree" )
-                raise ValueError
-            if (r_time)/n_points_pmin > t_RR_max:
-                print("Ramp time too long, max time step: 2.048 \u03BCs and the max n of steps is: ", int(n_points_pmin) )
-                raise ValueError
-            if  r_time < t_RR_min:
-                print("Ramp time too short, min time step: 8 ns" )
-                raise ValueError     
-
-            else:    
-                if abs(p_final-p_init)/n_points_tmin < delta_p_min and (r_time)/n_points_pmin > t_RR_min:
-                    delta_p = delta_p_min
-                    t_RR = r_time/n_points_pmin
-                    n_points = n_points_pmin
-                if (r_time)/n_points_pmin < t_RR_min and abs(p_final-p_init)/n_points_tmin > delta_p_min:
-                    delta_p = abs(p_final-p_init)/n_points_tmin
-                    t_RR= t_RR_min
-                    n_points = n_points_tmin
-
-                print("ramp time rate: ",t_RR, "  ramp value rate: ", delta_p)
-                print("number of points: ",n_points, "  total time: ",n_points*t_RR, "  total change: ",n_points*delta_p)
-                
-                # select phase modulation.
-                AFP_select = 0b11
-                #channel selection
-                CSR_spi = self.CSR_register((ch==0b00) & 1, (ch==0b01) & 1, (ch==0b10) & 1,(ch==0b11) & 1)
-                # set the delta time and delta phase for the ramp
-                LSRR_spi = self.LSRR_register(t_RR, t_RR)
-                FDW_spi = self.FDW_register(delta_p)
-                RDW_spi = self.RDW_register(delta_p)
-                # set phase modulation.
-                CFR_spi = self.CFR_register(AFP_select=AFP_select, Sweep_nodwell=0b0, Sweep_enable=0b1, SRR_IOupdate=0b0)
-                #set 1st value of phase into the memory register number 0
-                CPOW_spi = self.CPOW_register(phase=p_init)
-                # save the 2nd value of phase into the memory register number 1
-                CW_spi = self.CW_register(1, p_final)
-
-
-            # composition of the command.
-            out = [CSR_spi, LSRR_spi, FDW_spi, RDW_spi, CFR_spi, CPOW_spi, CW_spi]
-
-        except ValueError:
-            out = []
-            raise
-            
-        if send: 
-            for i in out: self.direct_spi(hex(i))     
-        return(out)
+            commands, triggers = schedule(commands, window_t, trigger_width=self.trigger_width,
+                                          model=self.cost_model, min_spacing=self.trigger_spacing or 0.0, merge=False)
+        except ValueError as e:
+            raise LabscriptError("%s: DDS events too close, %s" % (self.name, e))
+        return(commands, triggers, sorted([change for t in times for change in self.windows[t]["profile"]]))
+
+    def program_events(self):
+        """Set the memory commands of the timed events, their trigger pulses and profile pin changes are already
+        in the outputs (see add_event)"""
+        if self.memory_commands:
+            raise LabscriptError("%s: timed events and to_memory can not be used together, see add_commands" % self.name)
+        self.memory_commands, _, _ = self.compile_events()
 
     def to_start(self, command):
-        self.start_commands.append(hex(command))
+        self.start_commands.append(int(command))
 
     def to_memory(self, command):
-        self.memory_commands.append(hex(command))
+        self.memory_commands.append(int(command))
+
+    def shadow_filter(self, start_commands, memory_commands):
+        """Return the start and memory commands without the register writes that would not change the DDS.
+        The shot starts from the state left by the worker, that initialises the DDS before the start commands.
+        The memory commands left empty are kept as 0 (nothing written), so each one still matches its trigger.
+        """
+        shadow = ShadowRegisters()
+        shadow.apply(self.initialise_viaSPI(PLL_div=self.pll))
+        start_commands = shadow.filter(start_commands)
+        memory_commands = shadow.filter(memory_commands, keep_empty=True)
+        return(start_commands, memory_commands)
+
+    def check_optimized(self, start_commands, memory_commands):
+        """Raise LabscriptError if the optimized start and memory commands do not give the same outputs as the
+        original ones on the AD9959 model (simulator.py). The memory commands are latched by the triggers of the
+        timed events, or 1 ms apart without them, with the profile pin changes of the ramps."""
+        initial = self.initialise_viaSPI(PLL_div=self.pll)
+        if self.windows:
+            triggers = [trigger for t in sorted(self.windows) for trigger in self.windows[t]["triggers"]]
+            profile = sorted([change for window in self.windows.values() for change in window["profile"]])
+        else:
+            triggers, profile = 1E-3*np.arange(1, len(self.memory_commands) + 1), []
+        t_end = max([0.0] + list(triggers) + [t for t, _, _ in profile]) + 1E-3
+        try:
+            before, after = [simulate_shot(start, memory, triggers, initial, profile, self.clock, self.pll, t_end)
+                             for start, memory in ((self.start_commands, self.memory_commands),
+                                                   (start_commands, memory_commands))]
+        except ValueError as e:
+            print("%s: optimized commands not checked, %s" % (self.name, e))
+            return
+        for ch in range(4):
+            times = np.union1d(before[ch]["time"], after[ch]["time"])
+            for quantity in ("frequency", "amplitude", "phase"):
+                if not np.allclose(sample(before[ch], times, quantity), sample(after[ch], times, quantity)):
+                    raise LabscriptError("%s: the optimized commands change the %s of channel %d, set optimize=False"
+                                         % (self.name, quantity, ch))
+
+    def compile_commands(self):
+        """Return the start and memory commands to store in the shot file, optimized and filtered if enabled"""
+        start_commands, memory_commands = self.start_commands, self.memory_commands
+        if self.optimize:
+            start_commands, memory_commands, report = optimize(start_commands, memory_commands,
+                                                               initial=self.initialise_viaSPI(PLL_div=self.pll))
+            self.check_optimized(start_commands, memory_commands)
+            if self.report:
+                print("%s commands optimized" % self.name)
+                print_report(report)
+        if self.shadow:
+            start_commands, memory_commands = self.shadow_filter(start_commands, memory_commands)
+        return(start_commands, memory_commands)
+
+    def trigger_times(self, threshold=0.5):
+        """Rising edges (above threshold) of the trigger_line, from its instructions"""
+        level = getattr(self.trigger_line, "default_value", 0) > threshold
+        times = []
+        for t in sorted(self.trigger_line.instructions):
+            value = self.trigger_line.instructions[t]
+            if isinstance(value, dict):
+                print("%s: ramps in the trigger line %s are not followed" % (self.name, self.trigger_line.name))
+                continue
+            if value > threshold and not level:
+                times.append(t)
+            level = value > threshold
+        return(times)
 
     def generate_code(self, hdf5_file):
-        #dt = np.dtype((str, 16))
-        # start_commands_list = np.array(self.start_commands_list, dtype= "S32")
-        vlenbytes = h5py.special_dtype(vlen=bytes)
-        start_commands = np.array(self.start_commands, dtype= vlenbytes)
-        memory_commands = np.array(self.memory_commands, dtype= vlenbytes)
+        # commands stored as uint64 datasets (8 bytes per command), chunked so they can be compressed
         group = self.init_device_group(hdf5_file)
-        if self.start_commands:
-            group.create_dataset("start_commands", data = start_commands)
-        if self.memory_commands:
-            group.create_dataset("memory_commands", data = memory_commands)
\ No newline at end of file
+        if self.events:
+            self.program_events()
+        start_commands, memory_commands = self.compile_commands()
+        group.attrs["commands_before"] = len(self.start_commands) + len(self.memory_commands)
+        group.attrs["commands_after"] = len(start_commands) + len([c for c in memory_commands if c])
+        for name, commands in (("start_commands", start_commands), ("memory_commands", memory_commands)):
+            if commands:
+                data = np.array(commands, dtype=np.uint64)
+                group.create_dataset(name, data=data, chunks=(min(len(data), 4096),), compression=self.compression)
+        if self.trigger_line is not None:
+            # used by the runviewer parser only, the ESP32 follows the real edges
+            trigger_times = self.trigger_times()
+            if len(trigger_times) < len(memory_commands):
+                print("%s: %d memory commands but %d triggers" % (self.name, len(memory_commands), len(trigger_times)))
+            group.attrs["trigger_line"] = self.trigger_line.name
+            group.create_dataset("trigger_times", data=np.array(trigger_times, dtype=np.float64))
+
+
+class DDS_ESP32Channel(object):
+    """Timed output of a channel of a DDS_ESP32 (DDS_0.ch[0]). Each event is compiled by the device when it is made,
+    into memory commands, trigger pulses and profile pin changes (see DDS_ESP32.add_event)."""
+
+    def __init__(self, device, ch):
+        self.device = device
+        self.ch = ch
+
+    def setfreq(self, t, freq):
+        """frequency (Hz) of the channel from time t"""
+        self.device.add_event(t, self.ch, FREQUENCY, freq, None)
+
+    def setamp(self, t, amp):
+        """amplitude (max 1023) of the channel from time t"""
+        self.device.add_event(t, self.ch, AMPLITUDE, amp, None)
+
+    def setphase(self, t, phase):
+        """phase (degree) of the channel from time t"""
+        self.device.add_event(t, self.ch, PHASE, phase, None)
+
+    def ramp(self, t, duration, start, stop, quantity="frequency"):
+        """linear sweep from start to stop in duration (s), of "frequency" (Hz), "amplitude" or "phase" (degree),
+        started at time t by the profile pin of the channel (profile_lines of the device). The channel is at start
+        from the trigger of the sweep settings, a setting of the same quantity afterwards stops the sweep."""
+        self.device.add_event(t, self.ch, SWEEP_TYPES[quantity], None, (duration, start, stop))
@@ -0,0 +1,92 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Multi-level (2/4/8/16) modulation by profile pins. The level of a channel is chosen by the profile pins P0-P3, the
+# level 0 is the channel register (CFTW0, ACR or CPOW0) and the levels 1 to 15 the channel words CW1 to CW15.
+# FR1 sets the number of levels (Mod_level) and which pins go to which channel (PPC, profile pin configuration):
+#   2 levels:  Pn to channel n (ch0->P0, ch1->P1, ch2->P2, ch3->P3), PPC not used.
+#   4 levels:  two channels modulated, one by P0/P1 and the other one by P2/P3, chosen by PPC (FOUR_LEVEL_PPC).
+#   8 levels:  one channel (PPC = channel) by P0/P1/P2.
+#   16 levels: one channel (PPC = channel) by P0/P1/P2/P3.
+# The first pin of a channel is the least significant bit of the level.
+# The profile pins are not driven by the ESP32 but by outputs of the experiment (e.g. labscript DigitalOuts), so
+# switching levels takes no SPI transfer at all. profile_toggles turns a sequence of levels into the pin changes
+# to program at compile time, level_events into the profile events of the AD9959 model (simulator.py).
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+MOD_LEVELS = {2: 0b00, 4: 0b01, 8: 0b10, 16: 0b11}      # Mod_level of FR1 for each number of levels
+FOUR_LEVEL_PPC = {0b000: (0, 1), 0b001: (0, 2), 0b010: (0, 3),   # PPC: (channel on P0/P1, channel on P2/P3)
+                  0b011: (1, 2), 0b100: (1, 3), 0b101: (2, 3)}
+
+
+def mod_level(n_levels):
+    """Mod_level bits of FR1 for 2, 4, 8 or 16 levels"""
+    if n_levels not in MOD_LEVELS:
+        raise ValueError("%d levels, the modulation has 2, 4, 8 or 16 levels" % n_levels)
+    return(MOD_LEVELS[n_levels])
+
+def default_PPC(ch, n_levels):
+    """profile pin configuration modulating the channel ch, for 4 levels the first one of FOUR_LEVEL_PPC with it"""
+    if n_levels == 4:
+        return(min([PPC for PPC, channels in FOUR_LEVEL_PPC.items() if ch in channels]))
+    if n_levels in (8, 16):
+        return(ch)
+    return(0b000)
+
+def profile_pins(ch, n_levels, PPC=None):
+    """profile pins (numbers, least significant bit first) selecting the level of the channel ch,
+    raises ValueError if the channel is not modulated with that PPC"""
+    mod_level(n_levels)
+    PPC = default_PPC(ch, n_levels) if PPC is None else PPC
+    if n_levels == 2:
+        return((ch,))
+    if n_levels == 4:
+        channels = FOUR_LEVEL_PPC.get(PPC, ())
+        if ch not in channels:
+            raise ValueError("channel %d not modulated with 4 levels and PPC %s" % (ch, bin(PPC)))
+        return((0, 1) if channels[0] == ch else (2, 3))
+    if PPC & 0b11 != ch:
+        raise ValueError("channel %d not modulated with %d levels and PPC %s" % (ch, n_levels, bin(PPC)))
+    return(tuple(range(n_levels.bit_length() - 1)))
+
+def profile_toggles(times, levels, ch, n_levels, PPC=None, initial=0):
+    """Profile pin changes that set the channel ch to levels[i] at times[i].
+    initial: level before the first time (pins low by default).
+    Returns a list of (time, pin, state) sorted in time, only the pins that change."""
+    pins = profile_pins(ch, n_levels, PPC)
+    levels = np.concatenate([[initial], np.asarray(levels, dtype=np.int64)])
+    if np.any((levels < 0) | (levels >= n_levels)):
+        raise ValueError("levels between 0 and %d" % (n_levels - 1))
+    bits = (levels[:, None] >> np.arange(len(pins))) & 1        # (levels, pins)
+    changes = np.diff(bits, axis=0)
+    out = []
+    for i, k in zip(*np.nonzero(changes)):
+        out.append((float(times[i]), pins[k], int(bits[i + 1, k])))
+    return(out)
+
+def level_events(times, levels, ch, initial=0):
+    """Profile events (time, ch, level) of the AD9959 model (simulator.py) for a sequence of levels, only the changes"""
+    out = []
+    for t, level in zip(times, levels):
+        if level != initial:
+            out.append((t, ch, int(level)))
+            initial = level
+    return(out)
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+# DDS_0 = DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# # 16 frequencies on channel 0, one batch and one IO_update
+# DDS_0.set_mod_frequency(0, np.linspace(10E6, 25E6, 16), send=True)
+# # pin changes to go through the levels 0, 5, 15, 3 every 10 us (P0-P3 driven by DigitalOuts in labscript)
+# for t, pin, state in profile_toggles([0, 10E-6, 20E-6, 30E-6], [0, 5, 15, 3], ch=0, n_levels=16):
+#     print(t, "P%d" % pin, "high" if state else "low")
@@ -0,0 +1,168 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Optimizer of the lists of commands (start_commands, memory_commands) before they are sent to the ESP32.
+# The AD9959 latches the registers on the IO_update, so between two IO_updates (a window) only the last value written
+# in each register of each channel matters, and the order of the writes does not matter (the CSR, channel selection,
+# is the only register active straight away). For each window the optimizer:
+#   drops the writes overwritten before the IO_update,
+#   merges the same write on several channels in one CSR with all of them selected plus one data write,
+#   groups the writes by channel selection to switch the CSR as few times as possible,
+#   packs the writes in commands of up to 64 bits.
+# broadcast() does the same for the commands of several channels built at once (set_frequencies, ramp_frequencies...).
+# The start commands are one window (one batch, one IO_update at the end). Each memory command is its own window
+# (one trigger each), so they are never merged; a memory command is only replaced if the optimized one fits in 64 bits
+# and leaves the CSR as the original does.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+from .registers import split_command, join_writes, selected_channels, CSR, GLOBAL_REGISTERS, REGISTER_LENGTHS
+
+MAX_COMMAND_BYTES = 8   # 64 bits per command in the memory of the ESP32
+
+
+def _window_state(writes, csr):
+    """Last value of each register in a window, returns (globals {address: value}, channels {(ch, address): value},
+    final csr) or None if a channel register is written while the selected channels are unknown"""
+    globals_, channels = {}, {}
+    for address, value in writes:
+        if address == CSR:
+            csr = value
+        elif address in GLOBAL_REGISTERS:
+            globals_[address] = value
+        elif csr is None:
+            return(None)
+        else:
+            for ch in selected_channels(csr):
+                channels[(ch, address)] = value
+    return(globals_, channels, csr)
+
+def optimize_window(commands, csr=None):
+    """Optimize the commands of one IO_update window.
+    csr: value of the CSR before the window (None if unknown).
+    Returns (list of register writes, CSR after the window), or None if the window can not be optimized.
+    """
+    writes = []
+    for command in commands:
+        split = split_command(command)
+        if split is None:
+            return(None)
+        writes += split
+    state = _window_state(writes, csr)
+    if state is None:
+        return(None)
+    globals_, channels, final_csr = state
+    # channels with the same final value of a register written at once
+    masks = {}
+    for (ch, address), value in channels.items():
+        masks[(address, value)] = masks.get((address, value), 0) | (1 << ch)
+    groups = {}
+    for (address, value), mask in masks.items():
+        groups.setdefault(mask, []).append((address, value))
+    # current selection first and the one of the original end of the window last, each selection once
+    low = (final_csr if final_csr is not None else 0) & 0x0F   # serial mode bits of the CSR kept
+    current = None if csr is None else csr >> 4
+    final = None if final_csr is None else final_csr >> 4
+    order = sorted(groups, key=lambda mask: (mask != current, mask == final, mask))
+    out = [(address, globals_[address]) for address in sorted(globals_)]
+    for mask in order:
+        if mask != current:
+            out.append((CSR, (mask << 4) | low))
+            current = mask
+        out += sorted(groups[mask])
+    if final_csr is not None and current != final:
+        out.append((CSR, final_csr))
+    return(out, final_csr)
+
+def pack_writes(writes, max_bytes=MAX_COMMAND_BYTES):
+    """Pack a list of register writes in as few commands as possible, keeping the order, up to max_bytes each"""
+    out = []
+    current, size = [], 0
+    for address, value in writes:
+        length = 1 + REGISTER_LENGTHS[address]
+        if current and size + length > max_bytes:
+            out.append(join_writes(current))
+            current, size = [], 0
+        current.append((address, value))
+        size += length
+    if current:
+        out.append(join_writes(current))
+    return(out)
+
+def broadcast(commands, max_bytes=MAX_COMMAND_BYTES):
+    """Commands of one IO_update window (e.g. the same setting on several channels) with the same writes of several
+    channels merged under one CSR mask, packed in commands of up to max_bytes. The CSR is left at the last mask written
+    (not restored to the last selection of the commands). Returned as they are if they can not be optimized."""
+    optimized = optimize_window(commands)
+    if optimized is None:
+        return(list(commands))
+    writes = optimized[0]
+    if len(writes) > 1 and writes[-1][0] == CSR:
+        writes = writes[:-1]
+    return(pack_writes(writes, max_bytes))
+
+def _final_csr(commands, csr):
+    """CSR after a list of commands, None if unknown"""
+    for command in commands:
+        writes = split_command(command)
+        if writes is None:
+            return(None)
+        for address, value in writes:
+            if address == CSR: csr = value
+    return(csr)
+
+def _command_bytes(command):
+    return((int(command).bit_length() + 7)//8)
+
+def _count_writes(commands):
+    split = [split_command(command) for command in commands]
+    return(sum([len(writes) for writes in split if writes is not None]))
+
+def optimize(start_commands=(), memory_commands=(), initial=()):
+    """Optimize the start and memory commands of a shot.
+    initial: commands sent before the start commands (e.g. initialise_viaSPI), used to know the channels selected.
+    Returns (start_commands, memory_commands, report), report has the commands, register writes and SPI bytes
+    before and after. The memory list keeps its length, one command per trigger.
+    """
+    csr = _final_csr(initial, None)
+
+    start = list(start_commands)
+    if start:
+        result = optimize_window(start, csr)
+        if result is None:
+            csr = _final_csr(start, csr)
+        else:
+            writes, csr = result
+            start = pack_writes(writes)
+
+    memory = []
+    for command in memory_commands:
+        result = optimize_window([command], csr)
+        if result is None:
+            memory.append(command)
+            csr = _final_csr([command], csr)
+            continue
+        writes, csr = result
+        packed = pack_writes(writes, max_bytes=MAX_COMMAND_BYTES)
+        if len(packed) == 0:
+            memory.append(0)
+        elif len(packed) == 1 and _command_bytes(packed[0]) <= _command_bytes(command):
+            memory.append(packed[0])
+        else:
+            memory.append(command)
+
+    report = {"start_commands": (len(start_commands), len(start)),
+              "memory_commands": (len([c for c in memory_commands if c]), len([c for c in memory if c])),
+              "writes": (_count_writes(list(start_commands) + list(memory_commands)), _count_writes(start + memory)),
+              "bytes": (sum([_command_bytes(c) for c in list(start_commands) + list(memory_commands)]),
+                        sum([_command_bytes(c) for c in start + memory]))}
+    return(start, memory, report)
+
+def print_report(report):
+    """print the before/after counts of optimize"""
+    for name, (before, after) in report.items():
+        print("%s: %d -> %d" % (name, before, after))
@@ -0,0 +1,220 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Wire formats used to send the list of commands (memory list) to the ucontroller, encoders for the computer side
+# and decoders for the emulator/tests side. Same formats as the ones parsed in DDS_ESP32.ino.
+
+# ASCII format (original one), opcode 'm':
+#   "m" + "<index>n<hexadecimal command>w" for each command + "\n"
+# Binary format, opcode 'M', versioned:
+#   12 bytes header, little-endian: 'M', version (uint8), flags (uint8), pad, start index (uint32), number of records (uint32)
+#   followed by the records, one little-endian uint64 per command.
+#   If flags has MEMORY_FLAG_ACK the ucontroller replies 5 bytes once the records are stored:
+#   'A' (stored) or 'E' (rejected) followed by the start index (uint32), used for the chunked upload.
+# Dictionary format, opcode 'D', for lists repeating the same few commands:
+#   the unique commands (table) are stored in the memory list with 'M' messages, and the list itself as indices
+#   of the table, 'D' messages: same 12 bytes header as 'M' (opcode 'D') followed by one little-endian uint16 per
+#   element, stored in the index list of the ucontroller (INDEX_DIM elements). Once a 'D' message is received the
+#   list mode goes through the index list, till the list is cleared ('k'). Same acknowledge as 'M'.
+# table_hash identifies a list stored in the ucontroller, so it is not sent again if it did not change (smart programming).
+# ChunkedUpload is the chunked upload of 'M'/'D' messages without the I/O (window, acknowledges and retries), the same
+# for the blocking and the asyncio drivers.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import hashlib
+import struct
+from collections import deque
+import numpy as np
+
+MEMORY_VERSION = 1                              # version of the binary memory format
+MEMORY_HEADER = struct.Struct("<cBBxII")        # opcode, version, flags, pad, start index, number of records
+MEMORY_RECORD = np.dtype("<u8")                 # one command per record
+MEMORY_FLAG_ACK = 0x01                          # ask the ucontroller to acknowledge the message
+MEMORY_ACK = struct.Struct("<cI")               # 'A'/'E', start index
+INDEX_RECORD = np.dtype("<u2")                  # one index of the table per element, dictionary format
+LIST_DIM = 10000                                # elements of the memory list of the ucontroller
+INDEX_DIM = 32768                               # elements of the index list of the ucontroller
+LIST_MAXTIME = 120000                           # default max time in list mode of the ucontroller (ms)
+
+
+def command_to_int(command):
+    """Return a command as an integer, commands can be integers or hexadecimal strings/bytes ("0x...")"""
+    if isinstance(command, bytes):
+        command = command.decode("utf-8")
+    if isinstance(command, str):
+        return(int(command, 16))
+    return(int(command))
+
+def commands_to_array(commands):
+    """Return a list of commands as an array of uint64"""
+    if isinstance(commands, np.ndarray) and commands.dtype.kind in "ui":
+        return(commands.astype(np.uint64))
+    return(np.array([command_to_int(c) for c in commands], dtype=np.uint64))
+
+
+# ASCII memory format
+
+def encode_memory_ascii(commands, start=0):
+    """Return the ASCII message ('m' opcode) to store a list of commands from the memory index start"""
+    items = ["{}n{}w".format(i, hex(c)) for i, c in enumerate(commands_to_array(commands).tolist(), start)]
+    return("m" + "".join(items) + "\n")
+
+def decode_memory_ascii(line):
+    """Decode the body of an 'm' message (without the opcode and end of line), returns a list of (index, command)"""
+    out = []
+    index = 0
+    item = ""
+    for ch in line:
+        if ch == "n":
+            index = int(item)
+            item = ""
+        elif ch == "w":
+            out.append((index, int(item, 16)))
+            item = ""
+        else:
+            item += ch
+    return(out)
+
+
+# Binary memory format
+
+def encode_memory_binary(commands, start=0, flags=0):
+    """Return the binary message ('M' opcode) to store a list of commands from the memory index start"""
+    records = commands_to_array(commands).astype(MEMORY_RECORD)
+    header = MEMORY_HEADER.pack(b"M", MEMORY_VERSION, flags, start, len(records))
+    return(header + records.tobytes())
+
+def decode_memory_header(header, opcode=b"M"):
+    """Decode the header of an 'M' (or 'D') message, returns (version, flags, start, count)"""
+    received, version, flags, start, count = MEMORY_HEADER.unpack(header)
+    if received != opcode:
+        raise ValueError("not a binary memory message")
+    if version != MEMORY_VERSION:
+        raise ValueError("unsupported binary memory version %d" % version)
+    return(version, flags, start, count)
+
+def decode_memory_binary(data):
+    """Decode a full 'M' message, returns (start, commands as a uint64 array, flags)"""
+    version, flags, start, count = decode_memory_header(data[:MEMORY_HEADER.size])
+    body = data[MEMORY_HEADER.size:MEMORY_HEADER.size + count*MEMORY_RECORD.itemsize]
+    if len(body) != count*MEMORY_RECORD.itemsize:
+        raise ValueError("binary memory message truncated")
+    return(start, np.frombuffer(body, dtype=MEMORY_RECORD).astype(np.uint64), flags)
+
+
+# Dictionary memory format
+
+def dictionary_encode(commands):
+    """Split a list of commands in the table of unique commands (uint64 array, at most LIST_DIM) and the
+    indices of each command in the table (uint16 array)"""
+    table, indices = np.unique(commands_to_array(commands), return_inverse=True)
+    if len(table) > LIST_DIM:
+        raise ValueError("%d different commands, the table holds %d" % (len(table), LIST_DIM))
+    return(table, indices.astype(np.uint16).ravel())
+
+def dictionary_size(commands):
+    """Bytes of the records of a list of commands in the dictionary format (table + indices) and in the 'M' format"""
+    unique = len(np.unique(commands_to_array(commands)))
+    return(unique*MEMORY_RECORD.itemsize + len(commands)*INDEX_RECORD.itemsize, len(commands)*MEMORY_RECORD.itemsize)
+
+def encode_memory_index(indices, start=0, flags=0):
+    """Return the dictionary message ('D' opcode) to store a list of indices from the index list position start"""
+    records = np.asarray(indices).astype(INDEX_RECORD)
+    header = MEMORY_HEADER.pack(b"D", MEMORY_VERSION, flags, start, len(records))
+    return(header + records.tobytes())
+
+def decode_memory_index(data):
+    """Decode a full 'D' message, returns (start, indices as a uint16 array, flags)"""
+    version, flags, start, count = decode_memory_header(data[:MEMORY_HEADER.size], b"D")
+    body = data[MEMORY_HEADER.size:MEMORY_HEADER.size + count*INDEX_RECORD.itemsize]
+    if len(body) != count*INDEX_RECORD.itemsize:
+        raise ValueError("dictionary memory message truncated")
+    return(start, np.frombuffer(body, dtype=INDEX_RECORD).astype(np.uint16), flags)
+
+def table_hash(*tables):
+    """Return a hash (hexadecimal string) of lists of commands, the same whatever their type (integers, hexadecimal
+    strings, arrays)"""
+    digest = hashlib.sha1()
+    for table in tables:
+        records = commands_to_array(table).astype(MEMORY_RECORD)
+        digest.update(struct.pack("<Q", len(records)))
+        digest.update(records.tobytes())
+    return(digest.hexdigest())
+
+def split_chunks(commands, chunk=512):
+    """Split a list of commands in consecutive chunks, returns a list of (start index, uint64 array)"""
+    records = commands_to_array(commands)
+    return([(start, records[start:start + chunk]) for start in range(0, len(records), chunk)])
+
+def encode_memory_ack(start, ok=True):
+    """Return the acknowledge of a binary memory message (emulator side)"""
+    return(MEMORY_ACK.pack(b"A" if ok else b"E", start))
+
+def decode_memory_ack(data):
+    """Decode an acknowledge, returns (ok, start index)"""
+    status, start = MEMORY_ACK.unpack(data)
+    if status not in (b"A", b"E"):
+        raise ValueError("not a memory acknowledge")
+    return(status == b"A", start)
+
+
+class ChunkedUpload():
+    """Upload of a list in acknowledged chunks, the protocol without the I/O. The driver sends messages(), reads
+    MEMORY_ACK.size bytes and passes them to acknowledge(), till done. If the connection breaks (or the reply is not
+    an acknowledge) it calls lost(), reconnects and carries on: the chunks in flight are sent again.
+    Up to window chunks are in flight, a rejected or lost chunk is sent again up to retries times (ConnectionError).
+    encode: encoder of the chunks, encode_memory_binary ('M') or encode_memory_index ('D').
+    """
+
+    def __init__(self, commands, chunk=512, window=4, retries=3, encode=encode_memory_binary):
+        self.chunks = dict(split_chunks(commands, chunk))
+        self.total = sum([len(records) for records in self.chunks.values()])
+        self.window = window
+        self.retries = retries
+        self.encode = encode
+        self.todo = deque(self.chunks)                      # start index of the chunks to send
+        self.in_flight = deque()                            # start index of the chunks waiting for acknowledge
+        self.attempts = dict.fromkeys(self.chunks, 0)
+        self.stored = 0                                     # commands stored
+
+    @property
+    def done(self):
+        """True once all the chunks are acknowledged"""
+        return(not self.todo and not self.in_flight)
+
+    def messages(self):
+        """messages of the chunks to send now (till window chunks are in flight)"""
+        out = []
+        while self.todo and len(self.in_flight) < self.window:
+            start = self.todo.popleft()
+            out.append(self.encode(self.chunks[start], start, MEMORY_FLAG_ACK))
+            self.in_flight.append(start)
+        return(out)
+
+    def _resend(self, start):
+        self.attempts[start] += 1
+        if self.attempts[start] > self.retries:
+            raise ConnectionError("memory chunk starting at %d not stored after %d attempts" % (start, self.retries))
+        self.todo.append(start)
+
+    def acknowledge(self, data):
+        """process an acknowledge (ValueError if it is not one), returns True if a chunk was stored"""
+        ok, start = decode_memory_ack(data)
+        if start not in self.in_flight:
+            return(False)
+        self.in_flight.remove(start)
+        if not ok:
+            self._resend(start)
+            return(False)
+        self.stored += len(self.chunks[start])
+        return(True)
+
+    def lost(self):
+        """the connection broke, the chunks in flight are sent again"""
+        for start in list(self.in_flight): self._resend(start)
+        self.in_flight.clear()
@@ -0,0 +1,140 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Planner of the linear sweeps of the AD9959 (ramp_frequency, ramp_amplitude, ramp_phase).
+# A sweep goes from S0 to E0 in steps of the delta word (RDW/FDW) every rate (LSRR, 1 to 255) SYNC_CLK periods
+# (4/core clock), the last step is clamped at E0. So the duration is ceil(span/delta)*rate*4/core_clock,
+# with span = E0 - S0 in words. For each ramp the planner tries all the rates at once and, for each one, the delta
+# words around span/(steps wanted). Of the pairs within tolerance (relative to r_time) of the smallest duration error
+# it keeps the one with the finest steps (smallest delta, then smallest rate).
+# The end points are exact up to the resolution of the words (start_error, stop_error).
+# Everything is done with numpy arrays of (r_time, start, stop), so thousands of ramps are planned at once.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+from .registers import LSRR, RDW, FDW
+
+AMPLITUDE, FREQUENCY, PHASE = 0b01, 0b10, 0b11     # AFP_select of each sweep type
+WORD_MASK = {AMPLITUDE: 0x3FF, FREQUENCY: 0xFFFFFFFF, PHASE: 0x3FFF}
+WORD_SHIFT = {AMPLITUDE: 22, FREQUENCY: 0, PHASE: 18}   # alignment of the words in CW, RDW and FDW
+RATE_MAX = 0xFF
+CHUNK = 1024            # ramps planned at once, limits the memory used (ramps x rates arrays)
+TOLERANCE = 1E-3        # duration error accepted (relative to r_time) to get finer steps
+
+# status of a plan
+OK, DESCENDING, OUT_OF_RANGE, SPAN_TOO_SHORT, TIME_TOO_LONG, TIME_TOO_SHORT = range(6)
+STATUS_MESSAGES = {OK: "ok",
+                   DESCENDING: "initial value has to be smaller than the final one",
+                   OUT_OF_RANGE: "value out of range",
+                   SPAN_TOO_SHORT: "Ramp too short, the change is smaller than the resolution",
+                   TIME_TOO_LONG: "Ramp time too long, max time step: 2.048 μs per resolution step",
+                   TIME_TOO_SHORT: "Ramp time too short, min time step: 4/core clock"}
+
+
+def word_scale(AFP_select, core_clock):
+    """words per unit (Hz, amplitude, degree) of a sweep type"""
+    return({AMPLITUDE: 1.0, FREQUENCY: 2**32/core_clock, PHASE: 2**14/360}[AFP_select])
+
+def to_words(AFP_select, values, core_clock):
+    """values to words, truncated as the registers do (not masked, so out of range values are larger than the mask)"""
+    return(np.trunc(np.asarray(values, dtype=np.float64)*word_scale(AFP_select, core_clock)).astype(np.int64))
+
+def to_values(AFP_select, words, core_clock):
+    """words to values (Hz, amplitude, degree)"""
+    return(np.asarray(words, dtype=np.float64)/word_scale(AFP_select, core_clock))
+
+def _plan_chunk(span, r_time, step_time, tolerance):
+    """best (rate, delta) for each ramp, span in words (>= 1) and r_time in s"""
+    rates = np.arange(1, RATE_MAX + 1, dtype=np.float64)
+    steps_wanted = np.maximum(r_time[:, None]/(rates*step_time), 1.0)      # (ramps, rates)
+    delta = span[:, None]/steps_wanted
+    candidates = np.stack([np.floor(delta), np.ceil(delta)], axis=-1)      # (ramps, rates, 2)
+    candidates = np.clip(candidates, 1, span[:, None, None])
+    steps = np.ceil(span[:, None, None]/candidates)
+    error = np.abs(steps*rates[None, :, None]*step_time - r_time[:, None, None])
+    error = error.reshape(len(span), -1)
+    accepted = error <= np.maximum(error.min(axis=1), tolerance*r_time)[:, None]
+    best = np.argmin(np.where(accepted, candidates.reshape(len(span), -1), np.inf), axis=1)   # first: smallest rate
+    rows = np.arange(len(span))
+    rate = best//2 + 1
+    delta = candidates.reshape(len(span), -1)[rows, best]
+    steps = steps.reshape(len(span), -1)[rows, best]
+    return(rate.astype(np.int64), delta.astype(np.int64), steps.astype(np.int64))
+
+def plan_ramps(AFP_select, r_time, start, stop, core_clock, tolerance=TOLERANCE):
+    """Plan linear sweeps of one type (AFP_select: AMPLITUDE, FREQUENCY or PHASE).
+    r_time, start, stop: arrays (or scalars) of ramp times (s) and start/stop values (Hz, amplitude or degree).
+    tolerance: duration error (relative to r_time) accepted to use finer steps, 0 for the smallest error.
+    Returns a dictionary of arrays: status (OK or the reason the ramp can not be done, see STATUS_MESSAGES),
+    rate (LSRR, SYNC_CLK periods per step), delta (RDW/FDW word), steps, duration (s), duration_error (s),
+    start_word, stop_word (S0, E0), start_error and stop_error (quantisation of the end points, in the units of the values).
+    """
+    r_time, start, stop = np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=np.float64)) for x in (r_time, start, stop)])
+    step_time = 4/core_clock
+    start_word = to_words(AFP_select, start, core_clock)
+    stop_word = to_words(AFP_select, stop, core_clock)
+    span = stop_word - start_word
+
+    status = np.full(len(span), OK)
+    status[r_time*(1 + 1E-9) < step_time] = TIME_TOO_SHORT
+    status[r_time > np.maximum(span, 0)*RATE_MAX*step_time*(1 + 1E-9)] = TIME_TOO_LONG
+    status[span < 1] = SPAN_TOO_SHORT
+    status[(start_word < 0) | (stop_word > WORD_MASK[AFP_select])] = OUT_OF_RANGE
+    status[start > stop] = DESCENDING
+
+    rate = np.zeros(len(span), dtype=np.int64)
+    delta = np.zeros(len(span), dtype=np.int64)
+    steps = np.zeros(len(span), dtype=np.int64)
+    ok = np.flatnonzero(status == OK)
+    for i in range(0, len(ok), CHUNK):
+        index = ok[i:i + CHUNK]
+        rate[index], delta[index], steps[index] = _plan_chunk(span[index].astype(np.float64), r_time[index], step_time,
+                                                                tolerance)
+    duration = steps*rate*step_time
+
+    return({"status": status, "rate": rate, "delta": delta, "steps": steps,
+            "duration": duration, "duration_error": np.where(status == OK, duration - r_time, np.nan),
+            "start_word": start_word, "stop_word": stop_word,
+            "start_error": to_values(AFP_select, start_word, core_clock) - start,
+            "stop_error": to_values(AFP_select, stop_word, core_clock) - stop})
+
+def plan_ramp(AFP_select, r_time, start, stop, core_clock, tolerance=TOLERANCE):
+    """Plan of a single ramp, a dictionary of python scalars (see plan_ramps)"""
+    plan = plan_ramps(AFP_select, r_time, start, stop, core_clock, tolerance)
+    return({name: value[0].item() for name, value in plan.items()})
+
+def plan_slope(AFP_select, slope, core_clock, tolerance=TOLERANCE):
+    """(rate, delta) of a sweep with the closest slope to the one given (units per second, > 0), for sweeps ended by
+    the next IO_update instead of E0/S0. Of the rates within tolerance (relative) of the best slope error it keeps the
+    finest steps. Returns (rate, delta, achieved slope), delta 0 if the slope is below half a word per 255 steps."""
+    step_time = 4/core_clock
+    rates = np.arange(1, RATE_MAX + 1, dtype=np.float64)
+    words = slope*word_scale(AFP_select, core_clock)*rates*step_time         # words per step for each rate
+    delta = np.clip(np.round(words), 0, WORD_MASK[AFP_select])
+    error = np.abs(delta - words)/(rates*step_time)                             # slope error, words per second
+    accepted = error <= max(error.min(), tolerance*slope*word_scale(AFP_select, core_clock))
+    best = np.argmin(np.where(accepted, delta, np.inf))
+    achieved = delta[best]/(rates[best]*step_time)/word_scale(AFP_select, core_clock)
+    return(int(rates[best]), int(delta[best]), achieved)
+
+def word_command(address, AFP_select, word):
+    """command writing a word of a sweep type (CW, RDW, FDW) aligned as the register expects"""
+    return((address << 32) | ((int(word) & WORD_MASK[AFP_select]) << WORD_SHIFT[AFP_select]))
+
+def sweep_commands(AFP_select, rate, delta):
+    """LSRR, RDW and FDW commands of a planned sweep, same rate and delta rising and falling"""
+    LSRR_spi = (LSRR << 16) | (int(rate) << 8) | int(rate)
+    return(LSRR_spi, word_command(RDW, AFP_select, delta), word_command(FDW, AFP_select, delta))
+
+
+# Examples
+
+# # 1000 frequency ramps of 100 us to 1 ms from 1 MHz to 2 MHz, core clock 500 MHz
+# plan = plan_ramps(FREQUENCY, np.linspace(100E-6, 1E-3, 1000), 1E6, 2E6, 500E6)
+# print(plan["rate"], plan["delta"], np.abs(plan["duration_error"]).max())
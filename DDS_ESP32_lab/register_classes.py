@@ -16,5 +16,5 @@ from labscript_devices import register_classes
 register_classes(
     'DDS_ESP32',
     BLACS_tab='user_devices.DDS_ESP32.blacs_tabs.DDS_ESP32Tab',
-    runviewer_parser=None
+    runviewer_parser='user_devices.DDS_ESP32.runviewer_parsers.DDS_ESP32Parser'
 )
@@ -0,0 +1,136 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Register map of the AD9959 and a shadow copy of the register file of the device.
+# A command (one SPI word of up to 64 bits, as the ones of DDS_ESP32) is a sequence of register writes: address byte + value,
+# the number of bytes of each value is fixed by the register. The first address 0x00 (CSR) is flagged as 0x20, as in the firmware.
+# The shadow registers follow the writes sent to the device and drop the ones that would not change it:
+# the CSR if the same channels are already selected, FR1/FR2 if they have the same value and the channel registers
+# (CFR, CFTW, CPOW, ACR, LSRR, RDW, FDW, CW) if all the selected channels already have the same value.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+# Register addresses and their length in bytes
+CSR  = 0x00
+FR1  = 0x01
+FR2  = 0x02
+CFR  = 0x03
+CFTW = 0x04
+CPOW = 0x05
+ACR  = 0x06
+LSRR = 0x07
+RDW  = 0x08
+FDW  = 0x09
+CW   = 0x0A     # CW1, channel words 1 to 15 are 0x0A to 0x18
+
+REGISTER_LENGTHS = {CSR: 1, FR1: 3, FR2: 2, CFR: 3, CFTW: 4, CPOW: 2, ACR: 3, LSRR: 2, RDW: 4, FDW: 4}
+REGISTER_LENGTHS.update({address: 4 for address in range(CW, 0x19)})
+GLOBAL_REGISTERS = (CSR, FR1, FR2)  # the rest are channel registers, written in the channels selected in the CSR
+CSR_FLAG = 0x20                     # CSR address as sent by DDS_ESP32 in the first byte of a command
+
+
+def split_command(command):
+    """Split a command in its register writes, returns a list of (address, value) or None if it is not a valid
+    sequence of writes (unknown address or wrong length). The command 0 writes nothing."""
+    command = int(command)
+    if command == 0:
+        return([])
+    data = command.to_bytes(max((command.bit_length() + 7)//8, 1), "big")
+    writes = []
+    i = 0
+    while i < len(data):
+        address = data[i]
+        if i == 0 and address == CSR_FLAG:
+            address = CSR
+        length = REGISTER_LENGTHS.get(address)
+        if length is None or i + 1 + length > len(data):
+            return(None)
+        writes.append((address, int.from_bytes(data[i + 1:i + 1 + length], "big")))
+        i += 1 + length
+    return(writes)
+
+def join_writes(writes):
+    """Compose a command from a list of (address, value), 0 if the list is empty"""
+    command = 0
+    for i, (address, value) in enumerate(writes):
+        length = REGISTER_LENGTHS[address]
+        if i == 0 and address == CSR:
+            address = CSR_FLAG
+        command = (command << 8*(length + 1)) | (address << 8*length) | value
+    return(command)
+
+def selected_channels(csr):
+    """Channels enabled in a CSR value"""
+    return([ch for ch in range(4) if csr >> (4 + ch) & 1])
+
+
+# Shadow Class
+class ShadowRegisters():
+    """Copy of the register file of the AD9959 built from the writes sent to it.
+    A register is unknown (None) till it is written, after a reset or initialisation of the device call invalidate().
+    """
+
+    def __init__(self):
+        self.writes_in = 0          # register writes received
+        self.writes_out = 0         # register writes that changed the device (not dropped)
+        self.invalidate()
+
+    def invalidate(self):
+        """forget the state of the device, all the registers unknown"""
+        self.globals = {}                       # address: value of CSR, FR1, FR2
+        self.channels = [{} for ch in range(4)] # address: value of the channel registers for each channel
+
+    def write(self, address, value):
+        """Record a write, returns True if it changes the device, False if it is redundant"""
+        if address in GLOBAL_REGISTERS:
+            changed = self.globals.get(address) != value
+            self.globals[address] = value
+            return(changed)
+        csr = self.globals.get(CSR)
+        if csr is None:
+            # unknown selected channels, the register is unknown in all of them
+            for registers in self.channels: registers.pop(address, None)
+            return(True)
+        channels = selected_channels(csr)
+        changed = len(channels) == 0 or any([self.channels[ch].get(address) != value for ch in channels])
+        for ch in channels: self.channels[ch][address] = value
+        return(changed)
+
+    def filter_command(self, command):
+        """Record the writes of a command and return it without the redundant ones, 0 if all of them are redundant.
+        Commands that can not be split in register writes are returned unchanged and the shadow invalidated."""
+        command = int(command)
+        writes = split_command(command)
+        if writes is None:
+            self.invalidate()
+            return(command)
+        kept = [(address, value) for address, value in writes if self.write(address, value)]
+        self.writes_in += len(writes)
+        self.writes_out += len(kept)
+        if len(kept) == len(writes):
+            return(command)
+        return(join_writes(kept))
+
+    def filter(self, commands, keep_empty=False):
+        """Filter a list of commands (see filter_command), returns a list of integers.
+        keep_empty: keep the commands left empty as 0 (memory lists, each element is a trigger), otherwise dropped.
+        """
+        out = [self.filter_command(command) for command in commands]
+        return(out if keep_empty else [command for command in out if command != 0])
+
+    def apply(self, commands):
+        """Record the writes of a list of commands without filtering them (e.g. the initialisation done by the worker)"""
+        for command in commands:
+            writes = split_command(command)
+            if writes is None:
+                self.invalidate()
+                continue
+            for address, value in writes: self.write(address, value)
+
+    def stats(self):
+        """register writes received and kept"""
+        return({"writes_in": self.writes_in, "writes_out": self.writes_out})
@@ -0,0 +1,112 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+# In particula this gives funcionality to the runviewer part
+
+# runviewer parser, shows the frequency, amplitude and phase of the 4 channels of the DDS next to the other devices.
+# The output is reconstructed with the AD9959 model (simulator.py) from the start_commands and memory_commands of the
+# shot file: the start commands at the beginning of the shot and each memory command at its trigger (trigger_times,
+# the rising edges of the trigger_line of the labscript device). Without trigger_times only the start commands are shown.
+# The traces are built the first time runviewer asks for them, and decimated to max_points per trace for display
+# (sweeps sampled, min and max of each bucket kept), so a shot with thousands of DDS events opens straight away.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import labscript_utils.h5_lock
+import h5py
+import numpy as np
+from labscript_utils import properties
+
+from .DDS_ESP32 import DDS_ESP32
+from .protocol import commands_to_array
+from .simulator import simulate_shot
+
+QUANTITIES = (("freq", "frequency"), ("amp", "amplitude"), ("phase", "phase"))
+
+
+def expand_ramps(t, values, ramp_points=32):
+    """Step trace (value held till the next time, as runviewer shows them) from breakpoints linear in between,
+    each segment changing in time (a sweep) sampled with ramp_points points"""
+    ramps = np.flatnonzero((np.diff(t) > 0) & (np.diff(values) != 0))
+    if len(ramps) == 0:
+        return(t, values)
+    steps = np.arange(1, ramp_points)/ramp_points
+    t_ramp = (t[ramps, None] + steps*(t[ramps + 1] - t[ramps])[:, None]).ravel()
+    v_ramp = (values[ramps, None] + steps*(values[ramps + 1] - values[ramps])[:, None]).ravel()
+    order = np.argsort(np.concatenate([t, t_ramp]), kind="stable")
+    return(np.concatenate([t, t_ramp])[order], np.concatenate([values, v_ramp])[order])
+
+def drop_repeated(t, values):
+    """Remove the points equal to both neighbours (the ones left by changes in the other quantities)"""
+    keep = np.ones(len(t), dtype=bool)
+    keep[1:-1] = (values[1:-1] != values[:-2]) | (values[1:-1] != values[2:])
+    return(t[keep], values[keep])
+
+def decimate(t, values, max_points=10000):
+    """Reduce a step trace to about max_points points keeping the first, last, minimum and maximum (earliest ones)
+    of each bucket, so the envelope (and the narrow pulses) are still visible"""
+    if len(t) <= max_points:
+        return(t, values)
+    buckets = max(max_points//4, 1)
+    index = np.arange(len(t))
+    bucket = (index*buckets)//len(t)            # sorted, as the points
+    edges = np.searchsorted(bucket, np.arange(buckets + 1))
+    first, last = edges[:-1], edges[1:] - 1
+    keep = np.zeros(len(t), dtype=bool)
+    keep[first] = True
+    keep[last] = True
+    keep[np.lexsort((index, values, bucket))[first]] = True     # minimum of each bucket
+    keep[np.lexsort((-index, values, bucket))[last]] = True     # maximum of each bucket
+    return(t[keep], values[keep])
+
+def stop_time(f):
+    """stop time of the shot, the largest one of the devices"""
+    times = [group.attrs["stop_time"] for group in f["devices"].values() if "stop_time" in group.attrs]
+    return(max(times) if times else None)
+
+
+class DDS_ESP32Parser(object):
+
+    def __init__(self, path, device):
+        self.path = path
+        self.name = device.name
+        self.device = device
+        self.max_points = 10000     # points per trace
+        self.ramp_points = 32       # points per sweep
+        self._outputs = None
+
+    def outputs(self):
+        """Output of the 4 channels (see simulator.py), computed once"""
+        if self._outputs is None:
+            with h5py.File(self.path, "r") as f:
+                connection_table_properties = properties.get(f, self.name, "connection_table_properties")
+                group = f["devices/%s" % self.name]
+                start = commands_to_array(group["start_commands"][:]) if "start_commands" in group else []
+                memory = commands_to_array(group["memory_commands"][:]) if "memory_commands" in group else []
+                triggers = group["trigger_times"][:] if "trigger_times" in group else []
+                t_end = stop_time(f)
+            clock = connection_table_properties.get("clock", 50E6)
+            pll = connection_table_properties.get("pll", 10)
+            if len(memory) and not len(triggers):
+                print("%s: no trigger_times in the shot file, memory commands not shown" % self.name)
+            if len(triggers) < len(memory):
+                memory = memory[:len(triggers)]
+            if t_end is None:
+                t_end = triggers[-1] if len(triggers) else 0.0
+            # the worker initialises the DDS before the start commands
+            initial = DDS_ESP32("127.0.0.1", clock=clock, pll=pll).initialise_viaSPI(PLL_div=pll)
+            self._outputs = simulate_shot(start, memory, triggers, initial=initial, clock=clock, pll=pll, t_end=t_end)
+        return(self._outputs)
+
+    def get_traces(self, add_trace, clock=None):
+        for ch, output in enumerate(self.outputs()):
+            connection = "channel %d" % ch
+            for suffix, quantity in QUANTITIES:
+                t, values = drop_repeated(output["time"], output[quantity])
+                t, values = expand_ramps(t, values, self.ramp_points)
+                t, values = decimate(t, values, self.max_points)
+                add_trace("%s_ch%d_%s" % (self.name, ch, suffix), (t, values), self.name, connection)
+        return({})
@@ -0,0 +1,114 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Scheduler of the triggers of the list mode, at compile time. In list mode memory[0] is written when the list mode
+# starts and each trigger updates the registers (IO_update) with the command written, then the isr() of the ESP32
+# (falling edge of the trigger) writes the next one with memory_spi, that skips the leading zero bytes. So the
+# trigger of the memory command k can not come before the one of k-1 plus the trigger width and the time of the
+# isr() writing k, predicted by the cost model (cost_model.py) from the bytes actually sent.
+# The commands with the same requested time are one IO_update window, merged (optimizer.broadcast) in as few commands
+# as possible. A window of several commands is triggered at its time and its first commands as late as possible
+# before it. The commands without time (NaN) are triggered as soon as possible.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+from .optimizer import broadcast
+from .cost_model import DEFAULT_MODEL, spi_bytes
+
+TRIGGER_WIDTH = 2E-6    # s, width of the trigger pulses (the isr() runs on the falling edge)
+TIME_TOLERANCE = 1E-10  # s, rounding of the times
+
+
+def windows(times):
+    """IO_update window of each entry, the consecutive entries with the same time (the ones without time, NaN, alone)"""
+    times = np.asarray(times, dtype=np.float64)
+    new = np.ones(len(times), dtype=bool)
+    new[1:] = times[1:] != times[:-1]                   # NaN != NaN
+    return(np.cumsum(new) - 1)
+
+def merge_windows(commands, times):
+    """Commands of each IO_update window (see windows) merged in as few commands as possible (optimizer.broadcast).
+    Returns (commands, times, window) arrays, window: index of the window of each command."""
+    commands = [int(c) for c in commands]
+    times = np.asarray(times, dtype=np.float64)
+    window = windows(times)
+    starts = np.flatnonzero(np.diff(window, prepend=-1))
+    ends = np.append(starts[1:], len(times))
+    out_commands, out_times, window = [], [], []
+    for w, (i, j) in enumerate(zip(starts, ends)):
+        merged = broadcast(commands[i:j]) if j - i > 1 else commands[i:j]
+        out_commands += merged
+        out_times += [times[i]]*len(merged)
+        window += [w]*len(merged)
+    return(np.array(out_commands, dtype=np.uint64), np.array(out_times, dtype=np.float64),
+           np.array(window, dtype=np.int64))
+
+def schedule(commands, times=None, start=0.0, trigger_width=TRIGGER_WIDTH, model=None, min_spacing=0.0, merge=True):
+    """Earliest legal trigger times of a list of memory commands.
+    commands: memory commands in the order of the list
+    times: requested time (s) of each command, the time of its IO_update, NaN (or None for all) as soon as possible.
+           The requested times have to be in order.
+    start: time (s) of the first trigger allowed, memory[0] is written when the list mode starts
+    trigger_width: width of the trigger pulses (s)
+    model: cost model of the isr() (cost_model.CostModel), default cost_model.DEFAULT_MODEL
+    min_spacing: minimum time between triggers (s)
+    merge: merge the commands of each window (see merge_windows), otherwise they are triggered one by one ending
+           at the time of the window
+    Returns (commands, trigger times) as lists, raises ValueError if a requested time can not be met.
+    """
+    times = np.full(len(commands), np.nan) if times is None else np.asarray(times, dtype=np.float64)
+    if len(times) != len(commands):
+        raise ValueError("%d commands but %d times" % (len(commands), len(times)))
+    timed = times[~np.isnan(times)]
+    if np.any(np.diff(timed) < 0):
+        i = np.flatnonzero(np.diff(timed) < 0)[0]
+        raise ValueError("requested times not in order, %s s after %s s" % (timed[i + 1], timed[i]))
+    if merge:
+        commands, times, window = merge_windows(commands, times)
+    else:
+        commands = np.array([int(c) for c in commands], dtype=np.uint64)
+        window = windows(times)
+    if len(commands) == 0:
+        return([], [])
+
+    # time before the trigger of each command, memory[0] is written before the first trigger
+    gap = np.maximum((DEFAULT_MODEL if model is None else model).spacing(commands, trigger_width), min_spacing)
+    gap[0] = 0.0
+    total = np.cumsum(gap)
+    # latest trigger of the commands with a time: the last one of a window at its time, the rest before it
+    last = np.flatnonzero(np.append(window[1:] != window[:-1], True))
+    latest = times - (total[last][window] - total)
+    # earliest trigger: after the previous one plus its gap, and not before the latest one of the timed commands
+    bound = np.where(np.isnan(latest), -np.inf, latest)
+    bound[0] = max(bound[0], start)
+    earliest = total + np.maximum.accumulate(bound - total)
+
+    late = np.flatnonzero(earliest > latest + TIME_TOLERANCE)
+    if len(late):
+        i = late[0]
+        if latest[i] < start:
+            raise ValueError("memory command %d requested at %.9g s, before the first trigger allowed at %.9g s"
+                             % (i, times[i], start))
+        raise ValueError("memory command %d requested at %.9g s can not be triggered till %.9g s: %d bytes, %.3g s after "
+                         "the trigger at %.9g s (window of %d commands)"
+                         % (i, times[i], times[i] + earliest[i] - latest[i], spi_bytes(commands[i])[0], gap[i],
+                            earliest[i - 1], np.sum(window == window[i])))
+    triggers = np.where(np.isnan(latest), earliest, latest)
+    return([int(c) for c in commands], triggers.tolist())
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+# DDS_0 = DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# # 1000 amplitudes as fast as possible
+# commands, triggers = schedule(DDS_0.set_amplitude_array(0, np.linspace(0, 1023, 1000)))
+# print(np.diff(triggers).min())
+# # the same frequency on the 4 channels at 1 ms, one trigger
+# commands, triggers = schedule([DDS_0.set_frequency(ch, 10E6) for ch in range(4)], [1E-3]*4)
@@ -0,0 +1,278 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Register level model of the AD9959, to know what the DDS outputs for a list of commands without a scope.
+# It consumes the same commands (register words) sent to the device and the IO_update and profile pin events:
+#   CSR channel selection (active straight away), the rest of the registers buffered till the IO_update,
+#   FR1 PLL multiplier and modulation levels, CFTW/CPOW/ACR, CW1-15, CFR modulation (AFP select),
+#   linear sweeps (LSRR/RDW/FDW, CFR sweep enable and no-dwell) driven by the profile pins.
+# The model is event driven, the state of each channel only changes on an event (a sweep is a line between two events),
+# so a shot of 10000 commands is replayed in a fraction of a second. The output of each channel is returned as
+# breakpoints (time, frequency, phase, amplitude), linear between consecutive points, steps are two points at the same time.
+# The sweeps are modelled as straight lines, the real ones are staircases of RDW/FDW steps every RSRR/FSRR SYNC_CLK cycles.
+# Profile pin events give the modulation level of a channel (0 to 15), for 2-level modulation 0 = pin low and 1 = pin high,
+# for 4/8/16 levels the level resolved from the pins with the PPC configuration of FR1.
+
+# At the end are some examples of using it.
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+from .registers import split_command, GLOBAL_REGISTERS, CSR, FR1, CFR, CFTW, CPOW, ACR, LSRR, RDW, FDW, CW
+
+
+class AD9959_Simulator():
+
+    def __init__(self, clock=50E6, pll=10):
+        """
+        clock: reference clock of the DDS (Hz).
+        pll: PLL multiplier, used till FR1 is written (then the one in FR1).
+        """
+        self.clock = clock
+        self.pll = pll
+        self.reset()
+
+    def reset(self, t=0):
+        """reset the DDS, registers to their default values (all channels selected, no modulation, 0 Hz,
+        amplitude multiplier bypassed, full scale)"""
+        self.csr = 0xF0
+        self.globals = {FR1: None}
+        self.buffer = [{} for ch in range(4)]          # registers written, waiting for the IO_update
+        self.active = [{} for ch in range(4)]          # registers in use
+        self.global_buffer = {}
+        self.level = [0]*4                             # modulation level (profile pins) of each channel
+        self.dirty = set()                             # channels with registers waiting for the IO_update
+        self.points = [[] for ch in range(4)]          # breakpoints (t, frequency, phase, amplitude)
+        self.ramp = [None]*4                           # sweep in progress of each channel
+        self.sweep = [None]*4                          # (quantity index, S0) of the sweep mode of each channel
+        self.t = t
+        for ch in range(4):
+            self._set_state(ch, t)
+
+    # Register level
+
+    @property
+    def core_clock(self):
+        """system clock of the DDS, reference clock times the PLL multiplier of FR1 (if between 4 and 20)"""
+        fr1 = self.globals.get(FR1)
+        pll = self.pll if fr1 is None else (fr1 >> 18) & 0x1F
+        return(self.clock*pll if 4 <= pll <= 20 else self.clock)
+
+    def write(self, command):
+        """write a command (register word) via SPI"""
+        writes = split_command(command)
+        if writes is None:
+            raise ValueError("command %s is not a valid sequence of register writes" % hex(int(command)))
+        for address, value in writes:
+            if address == CSR:
+                self.csr = value                       # active straight away
+            elif address in GLOBAL_REGISTERS:
+                self.global_buffer[address] = value
+            else:
+                for ch in range(4):
+                    if self.csr >> (4 + ch) & 1:
+                        self.buffer[ch][address] = value
+                        self.dirty.add(ch)
+
+    def update(self, t):
+        """IO_update, the buffered registers are transferred to the active ones"""
+        if self.global_buffer:
+            self.globals.update(self.global_buffer)
+            self.global_buffer = {}
+            self.dirty = set(range(4))                 # the core clock or modulation levels may have changed
+        for ch in sorted(self.dirty):
+            self.active[ch].update(self.buffer[ch])
+            self._set_state(ch, t)
+        self.dirty = set()
+
+    def profile(self, t, ch, level):
+        """change the modulation level (profile pins) of a channel"""
+        if self.level[ch] != level:
+            self.level[ch] = level
+            self._set_state(ch, t)
+
+    # Channel output
+
+    def _mode(self, ch):
+        """modulation of a channel from its CFR: (AFP select, sweep enable, no-dwell)"""
+        registers = self.active[ch]
+        cfr = registers.get(CFR, 0)
+        return(((cfr >> 22) & 0b11, (cfr >> 14) & 1, (cfr >> 15) & 1))
+
+    def _value(self, afp, word):
+        """value of a word (CW, RDW, FDW) of the modulated quantity in its units"""
+        if afp == 1: return(float((word >> 22) & 0x3FF))
+        if afp == 2: return((word & 0xFFFFFFFF)*self.core_clock/2**32)
+        return(((word >> 18) & 0x3FFF)*360/2**14)
+
+    def _base(self, ch):
+        """frequency, phase and amplitude given by CFTW0, CPOW0 and ACR"""
+        registers = self.active[ch]
+        acr = registers.get(ACR, 0)
+        frequency = (registers.get(CFTW, 0) & 0xFFFFFFFF)*self.core_clock/2**32
+        phase = (registers.get(CPOW, 0) & 0x3FFF)*360/2**14
+        amplitude = float(acr & 0x3FF) if acr >> 12 & 1 else 1023.0
+        return([frequency, phase, amplitude])
+
+    def _s0(self, ch, afp):
+        """start point S0 of the modulation, in the units of the quantity"""
+        registers = self.active[ch]
+        if afp == 1: return(float(registers.get(ACR, 0) & 0x3FF))
+        return(self._base(ch)[0 if afp == 2 else 1])
+
+    def _evaluate(self, ch, t):
+        """frequency, phase and amplitude of a channel at time t (after the last point)"""
+        values = list(self.points[ch][-1][1:])
+        ramp = self.ramp[ch]
+        if ramp is not None:
+            t0, v0, rate, t_end, v_end, after, index = ramp
+            values[index] = v0 + rate*(t - t0) if t < t_end else after
+        return(values)
+
+    def _close_ramp(self, ch, t):
+        """add the end point of the sweep in progress if it ended before t"""
+        ramp = self.ramp[ch]
+        if ramp is not None:
+            t0, v0, rate, t_end, v_end, after, index = ramp
+            if t_end < t:
+                values = list(self.points[ch][-1][1:])
+                values[index] = v_end
+                self.points[ch].append((t_end, *values))
+                if after != v_end:
+                    values[index] = after
+                    self.points[ch].append((t_end, *values))
+                self.ramp[ch] = (t_end, after, 0.0, t_end, after, after, index)
+
+    def _set_state(self, ch, t):
+        """new state of a channel after an event at time t"""
+        if self.points[ch]:
+            self._close_ramp(ch, t)
+            current = self._evaluate(ch, t)
+            self.points[ch].append((t, *current))
+        else:
+            current = None
+        afp, sweep, nodwell = self._mode(ch)
+        values = self._base(ch)
+        self.ramp[ch] = None
+        if not (afp != 0 and sweep):
+            self.sweep[ch] = None
+        if afp != 0:
+            index = {1: 2, 2: 0, 3: 1}[afp]
+            registers = self.active[ch]
+            fr1 = self.globals.get(FR1) or 0
+            max_level = (2 << ((fr1 >> 8) & 0b11)) - 1  # 2, 4, 8 or 16 levels
+            level = min(self.level[ch], max_level)
+            s0 = self._s0(ch, afp)
+            if not sweep:
+                values[index] = s0 if level == 0 else self._value(afp, registers.get(CW + level - 1, 0))
+            else:
+                e0 = self._value(afp, registers.get(CW, 0))
+                # the sweep accumulator (output - S0) is kept, from 0 if the sweep was not running
+                accumulator = 0.0
+                if current is not None and self.sweep[ch] is not None and self.sweep[ch][0] == index:
+                    accumulator = current[index] - self.sweep[ch][1]
+                start = s0 + min(max(accumulator, 0.0), max(e0 - s0, 0.0))
+                self.sweep[ch] = (index, s0)
+                lsrr = registers.get(LSRR, 0)
+                step_time = 4/self.core_clock
+                if level > 0:   # rising sweep to E0
+                    target, delta, rr = e0, self._value(afp, registers.get(RDW, 0)), lsrr & 0xFF
+                else:           # falling sweep to S0
+                    target, delta, rr = s0, self._value(afp, registers.get(FDW, 0)), (lsrr >> 8) & 0xFF
+                values[index] = start
+                if delta > 0 and rr > 0 and start != target:
+                    rate = np.sign(target - start)*delta/(rr*step_time)
+                    t_end = t + (target - start)/rate
+                    after = s0 if (nodwell and level > 0) else target
+                    self.ramp[ch] = (t, start, rate, t_end, target, after, index)
+                elif delta > 0 and rr > 0 and nodwell and level > 0:
+                    values[index] = s0
+        self.points[ch].append((t, *values))
+
+    # Simulation
+
+    def run(self, events, t_end=None):
+        """Run a list of events, sorted in time:
+        (t, "write", command), (t, "update"), (t, "profile", ch, level), (t, "reset")
+        Returns the output of each channel (see result)."""
+        for event in events:
+            t, kind = event[0], event[1]
+            if kind == "write": self.write(event[2])
+            elif kind == "update": self.update(t)
+            elif kind == "profile": self.profile(t, event[2], event[3])
+            elif kind == "reset": self.reset(t)
+            else: raise ValueError("unknown event %s" % kind)
+            self.t = t
+        return(self.result(self.t if t_end is None else t_end))
+
+    def result(self, t_end):
+        """Output of the channels till t_end, a list (one per channel) of dictionaries with the numpy arrays
+        "time", "frequency" (Hz), "phase" (degree) and "amplitude" (0-1023), breakpoints linear in between"""
+        out = []
+        for ch in range(4):
+            self._close_ramp(ch, t_end)
+            points = np.array(self.points[ch] + [(t_end, *self._evaluate(ch, t_end))], dtype=np.float64)
+            # points equal to both neighbours carry no information
+            values = points[:, 1:]
+            keep = np.ones(len(points), dtype=bool)
+            keep[1:-1] = ~(np.all(values[1:-1] == values[:-2], axis=1) & np.all(values[1:-1] == values[2:], axis=1))
+            points = points[keep]
+            out.append({"time": points[:, 0], "frequency": points[:, 1], "phase": points[:, 2], "amplitude": points[:, 3]})
+        return(out)
+
+
+def sample(channel, times, quantity="frequency"):
+    """Value of a quantity of a channel output (one element of the result of AD9959_Simulator.run) at the given times"""
+    t, values = channel["time"], channel[quantity]
+    times = np.asarray(times, dtype=np.float64)
+    i = np.clip(np.searchsorted(t, times, side="right") - 1, 0, len(t) - 1)
+    j = np.minimum(i + 1, len(t) - 1)
+    dt = t[j] - t[i]
+    frac = np.where(dt > 0, (times - t[i])/np.where(dt > 0, dt, 1), 0)
+    return(values[i] + np.clip(frac, 0, 1)*(values[j] - values[i]))
+
+def shot_events(start_commands=(), memory_commands=(), trigger_times=(), initial=(), profile_events=()):
+    """Events of a shot as run by the ESP32: the initial commands (e.g. initialise_viaSPI) and the start commands
+    in one batch at t=0, then the list mode: each memory command is written after the previous trigger and
+    latched by the next one. The memory commands beyond the triggers are never latched.
+    profile_events: list of (t, ch, level)."""
+    events = [(0.0, "write", command) for command in list(initial) + list(start_commands)]
+    events.append((0.0, "update"))
+    written = 0.0
+    for command, trigger in zip(memory_commands, trigger_times):
+        events.append((written, "write", command))
+        events.append((trigger, "update"))
+        written = trigger
+    events += [(t, "profile", ch, level) for t, ch, level in profile_events]
+    events.sort(key=lambda event: event[0])     # stable, same time keeps the order
+    return(events)
+
+def simulate_shot(start_commands=(), memory_commands=(), trigger_times=(), initial=(), profile_events=(),
+                  clock=50E6, pll=10, t_end=None):
+    """Output of the 4 channels for a shot, see shot_events and AD9959_Simulator.result"""
+    events = shot_events(start_commands, memory_commands, trigger_times, initial, profile_events)
+    if t_end is None:
+        t_end = max([event[0] for event in events])
+    return(AD9959_Simulator(clock, pll).run(events, t_end))
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+# DDS_0 = DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# init = DDS_0.initialise_viaSPI(PLL_div=20)
+# start = [DDS_0.set_frequency(0, 10E6), DDS_0.set_amplitude(0, 1023)]
+# memory = list(DDS_0.set_amplitude_array(0, np.arange(0, 1023, 10)))
+# triggers = 1E-3*np.arange(1, len(memory) + 1)
+# out = simulate_shot(start, memory, triggers, initial=init, clock=25E6, pll=20)
+# print(out[0]["time"], out[0]["amplitude"])
+
+# # linear sweep of frequency on channel 0, started by the profile pin P0
+# ramp = DDS_0.ramp_frequency(ch=0, r_time=400E-6, f_init=0.1E6, f_final=0.5E6)
+# out = simulate_shot(init + ramp, profile_events=[(1E-3, 0, 1), (2E-3, 0, 0)], clock=25E6, pll=20, t_end=3E-3)
+# print(sample(out[0], [1.2E-3, 1.4E-3], "frequency"))
@@ -0,0 +1,211 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Compiler of arbitrary frequency/amplitude/phase profiles (exponential evaporation ramps, Blackman pulses...) onto
+# the linear sweeps of the AD9959, instead of one memory command (and one trigger) per point.
+# The profile is cut greedily in straight segments within the tolerance (each segment is extended while a line from
+# the end of the previous one can pass within the tolerance of all its samples, not always the fewest segments),
+# then each segment is a sweep at its slope:
+#   start commands: channel selection, CFR with linear sweep (ramp rate timer loaded on IO_update),
+#                   S0 = minimum of the profile, E0 (CW1) = maximum of the profile, LSRR/RDW of the lead-in.
+#   memory commands: one per segment (LSRR + RDW for rising segments or FDW for falling ones, 64 bits), latched by a
+#                    trigger at the start of the segment. The segment ends at the next trigger. The last command stops the sweep.
+#   profile events: the profile pin of the channel (driven by a labscript DigitalOut, not by the ESP32) high for the
+#                   rising segments and low for the falling ones. If the profile does not start at its minimum, a
+#                   lead-in segment from S0 runs before it (lead_time).
+# The S0 and E0 bounds are the same for the whole profile, so the sweep accumulator carries on from one segment to the next.
+# Each slope is planned from the value actually reached by the previous segment, so the quantisation errors do not add up.
+# The worst-case error is measured by replaying the commands with the AD9959 model (simulator.py). The slopes are
+# quantised (slow amplitude sweeps above all), so the segments out of tolerance are cut in two and the profile compiled
+# again, ValueError if it is still out of tolerance when the segments can not be cut (min_duration).
+
+# Bear in mind that this is a project on development, bugs may appear.
+
+import numpy as np
+
+from .registers import join_writes, LSRR, RDW, FDW, CW
+from .ramp_planner import plan_slope, word_command, to_words, to_values, WORD_MASK, AMPLITUDE, FREQUENCY, PHASE
+from .simulator import simulate_shot, sample
+
+SWEEP_TYPES = {"amplitude": AMPLITUDE, "frequency": FREQUENCY, "phase": PHASE}
+
+
+def segment(t, y, tolerance, min_duration=0):
+    """Straight segments (continuous) within tolerance of the samples (t, y), cut greedily: each segment is
+    extended as far as the tolerance allows, which is not always the fewest segments.
+    min_duration: shortest segment (s), a segment is not ended before it even if the tolerance is exceeded,
+                  it then ends on the sample value and only its own samples are out of tolerance.
+    Returns the breakpoints (times, values), one more than the segments, values within the range of the samples."""
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    times, values = [t[0]], [y[0]]
+    t_a, y_a = t[0], y[0]                       # anchor, end of the previous segment
+    lo, hi = -np.inf, np.inf                    # slopes from the anchor within tolerance of the samples so far
+    forced = False                              # segment kept past the tolerance by min_duration
+    k = 1
+    while k < len(t):
+        dt = t[k] - t_a
+        new_lo, new_hi = max(lo, (y[k] - tolerance - y_a)/dt), min(hi, (y[k] + tolerance - y_a)/dt)
+        if new_lo <= new_hi and not forced:
+            lo, hi = new_lo, new_hi
+            k += 1
+            continue
+        if t[k - 1] - t_a < min_duration:
+            forced = True                       # too short to end here, out of tolerance
+            k += 1
+            continue
+        # end of the segment at the previous sample, on the sample if the bounds were lost,
+        # else with the slope towards it within the bounds
+        dt = t[k - 1] - t_a
+        y_a = y[k - 1] if forced else y_a + min(max((y[k - 1] - y_a)/dt, lo), hi)*dt
+        t_a = t[k - 1]
+        times.append(t_a)
+        values.append(y_a)
+        lo, hi = -np.inf, np.inf
+        forced = False
+    if t[-1] > t_a:
+        dt = t[-1] - t_a
+        times.append(t[-1])
+        values.append(y[-1] if forced else y_a + min(max((y[-1] - y_a)/dt, lo), hi)*dt)
+    return(np.array(times), np.clip(values, y.min(), y.max()))
+
+def _s0_command(DDS, sweep_type, value):
+    """command of the register holding S0 of a sweep type"""
+    if sweep_type == AMPLITUDE: return(DDS.ACR_register(Mul_enable=0b0, amplitude=value))
+    if sweep_type == FREQUENCY: return(DDS.CFTW_register(frequency=value))
+    return(DDS.CPOW_register(phase=value))
+
+def _sweep_command(sweep_type, level, rate, delta):
+    """memory command of a segment: LSRR and the delta word of the direction (RDW rising, FDW falling), 64 bits"""
+    delta_spi = word_command(RDW if level else FDW, sweep_type, delta)
+    return(join_writes([(LSRR, (rate << 8) | rate), (RDW if level else FDW, delta_spi & 0xFFFFFFFF)]))
+
+def _build(DDS, ch, sweep_type, times, values, y, lead_time):
+    """start commands, memory commands and profile events of the segments (times in the shot, values)"""
+    core_clock = DDS.pll*DDS.clock
+    # bounds of the sweep, S0 and E0 as quantised by the registers
+    bounds = np.clip(to_words(sweep_type, [min(values.min(), y.min()), max(values.max(), y.max())], core_clock),
+                     0, WORD_MASK[sweep_type])
+    s0, e0 = to_values(sweep_type, bounds, core_clock)
+    resolution = to_values(sweep_type, 1, core_clock)
+    values = np.clip(values, s0, e0)
+
+    start = [DDS.CSR_channel(ch), DDS.templates["CFR"][(sweep_type, 0b0, 0b1, 0b1)], _s0_command(DDS, sweep_type, s0),
+             word_command(CW, sweep_type, bounds[1])]
+    profile_events = []
+    level = 0                                   # profile pin low before the profile, output at S0
+    current = s0
+    if values[0] - s0 >= resolution:
+        # lead-in, rising sweep from S0 to the start of the profile
+        if times[0] - lead_time < 0:
+            raise ValueError("The profile does not start at its minimum, t_start has to leave room for the "
+                             "lead-in segment (lead_time = %g s)" % lead_time)
+        rate, delta, slope = plan_slope(sweep_type, (values[0] - s0)/lead_time, core_clock)
+        start.append(_sweep_command(sweep_type, 1, rate, delta))
+        profile_events.append((times[0] - lead_time, ch, 1))
+        level = 1
+        current = min(s0 + slope*lead_time, e0)
+    else:
+        start.append(_sweep_command(sweep_type, 1, 1, 0))
+    start.append(word_command(FDW, sweep_type, 0))
+
+    memory = []
+    for i in range(len(times) - 1):
+        dt = times[i + 1] - times[i]
+        change = values[i + 1] - current
+        if abs(change) >= resolution/2:
+            new_level = int(change > 0)
+            rate, delta, slope = plan_slope(sweep_type, abs(change)/dt, core_clock)
+        else:
+            new_level, rate, delta, slope = level, 1, 0, 0.0
+        if new_level != level:
+            profile_events.append((times[i], ch, new_level))
+            level = new_level
+        memory.append(_sweep_command(sweep_type, level, rate, delta))
+        current = min(max(current + (slope if level else -slope)*dt, s0), e0)
+    # end of the profile, the sweep stopped
+    memory.append(_sweep_command(sweep_type, level, 1, 0))
+    return(start, memory, profile_events)
+
+def _split(t, y, times, values, bad, min_duration):
+    """breakpoints with the segments holding samples out of tolerance (bad) cut at their middle sample (on the
+    sample value), if both halves are at least min_duration. Returns None when no segment can be cut."""
+    idx = np.searchsorted(t, times)
+    new_times, new_values = [times[0]], [values[0]]
+    for i in range(len(times) - 1):
+        m = (idx[i] + idx[i + 1])//2
+        if bad[idx[i]:idx[i + 1] + 1].any() and min(t[m] - times[i], times[i + 1] - t[m]) >= min_duration:
+            new_times.append(t[m])
+            new_values.append(y[m])
+        new_times.append(times[i + 1])
+        new_values.append(values[i + 1])
+    if len(new_times) == len(times):
+        return(None)
+    return(np.array(new_times), np.array(new_values))
+
+def compile_waveform(DDS, ch, quantity, profile, tolerance, t=None, duration=None, samples=1001, t_start=0.0,
+                     min_duration=10E-6, lead_time=10E-6, check=True, refine=10):
+    """Compile a profile onto linear sweeps of one channel.
+    DDS: DDS_ESP32 instance (clock and pll, register helpers)
+    ch: channel
+    quantity: "frequency" (Hz), "amplitude" (0-1023) or "phase" (degree)
+    profile: function of the time from the start of the profile (s) or array of values
+    tolerance: largest error allowed, in the units of the quantity
+    t: times of the samples of profile (s from its start), or duration and samples to sample a function
+    t_start: time of the start of the profile in the shot (s)
+    min_duration: shortest segment (s), the ESP32 needs some time to write the next command after each trigger
+    lead_time: duration of the lead-in segment (s) when the profile does not start at its minimum,
+               it starts at t_start - lead_time, so t_start has to leave room for it
+    check: replay the commands with the AD9959 model to measure the worst-case error. The quantised slopes
+           (slow amplitude sweeps above all) can be further than tolerance from the straight segments, those
+           segments are cut in two and the profile compiled again, up to refine times. ValueError if the
+           error is still above tolerance.
+    Returns a dictionary: start_commands, memory_commands, trigger_times, profile_events [(t, ch, level)],
+    breakpoints (times, values) and report (segments, memory_commands, max_error, samples).
+    """
+    sweep_type = SWEEP_TYPES[quantity]
+    if t is None:
+        t = np.linspace(0, duration, samples)
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(profile(t) if callable(profile) else profile, dtype=np.float64)
+    times, values = segment(t, y, tolerance, min_duration)
+
+    max_error = None
+    for attempt in range(refine + 1):
+        start, memory, profile_events = _build(DDS, ch, sweep_type, times + t_start, values, y, lead_time)
+        if not check:
+            break
+        out = simulate_shot(start, memory, list(times + t_start), initial=DDS.initialise_viaSPI(PLL_div=DDS.pll),
+                            profile_events=profile_events, clock=DDS.clock, pll=DDS.pll, t_end=times[-1] + t_start)
+        error = np.abs(sample(out[ch], t + t_start, quantity) - y)
+        max_error = float(error.max())
+        if max_error <= tolerance:
+            break
+        refined = _split(t, y, times, values, error > tolerance, min_duration) if attempt < refine else None
+        if refined is None:
+            raise ValueError("Profile not within tolerance (%g) after %i refinements, max error %g: "
+                             "shorter segments (min_duration) or a larger tolerance needed"
+                             % (tolerance, attempt, max_error))
+        times, values = refined
+
+    times = times + t_start
+    report = {"segments": len(times) - 1, "memory_commands": len(memory), "samples": len(t), "max_error": max_error}
+    return({"start_commands": start, "memory_commands": memory, "trigger_times": list(times),
+            "profile_events": profile_events, "breakpoints": (times, values), "report": report})
+
+
+# Examples
+
+# from .DDS_ESP32 import DDS_ESP32
+# DDS_0 = DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20)
+# # exponential evaporation ramp from 20 MHz to 1 MHz in 2 s, within 5 kHz
+# wave = compile_waveform(DDS_0, 0, "frequency", lambda t: 1E6 + 19E6*np.exp(-t/0.5), tolerance=5E3, duration=2, samples=20001,
+#                         t_start=1E-3)
+# print(wave["report"])
+# # Blackman amplitude pulse of 500 us, within 5 steps of amplitude
+# pulse = compile_waveform(DDS_0, 1, "amplitude", 1023*np.blackman(2001), tolerance=5, t=np.linspace(0, 500E-6, 2001), t_start=1E-3)
+# print(pulse["report"], pulse["profile_events"])
@@ -0,0 +1,52 @@
+# DDS AD9959 ESP32 WiFi control
+
+# Swinburne University of Technology
+
+
+# This document form part of a system to control a AD9959 (eval_board) with Python and/or Labscript using a ESP32 microcontroller via WiFi.
+
+# Tests of the waveform compiler: the documented examples have to be within their tolerance once replayed with the
+# AD9959 model. Run from the root of the repository: python -m pytest tests
+
+import numpy as np
+import pytest
+
+from DDS_ESP32_lab.DDS_ESP32 import DDS_ESP32
+from DDS_ESP32_lab.waveform_compiler import segment, compile_waveform
+
+
+@pytest.fixture
+def DDS():
+    return(DDS_ESP32("192.168.20.103", 80, clock=25E6, pll=20))
+
+EXAMPLES = {
+    "exponential": (0, "frequency", lambda t: 1E6 + 19E6*np.exp(-t/0.5), 5E3,
+                    dict(duration=2, samples=20001, t_start=1E-3)),
+    "blackman": (1, "amplitude", 1023*np.blackman(2001), 5, dict(t=np.linspace(0, 500E-6, 2001), t_start=1E-3)),
+    "sin2": (1, "amplitude", lambda t: 1023*np.sin(np.pi*t/1E-3)**2, 5, dict(duration=1E-3, samples=2001)),
+}
+
+@pytest.mark.parametrize("name", EXAMPLES)
+def test_examples_within_tolerance(DDS, name):
+    ch, quantity, profile, tolerance, kwargs = EXAMPLES[name]
+    wave = compile_waveform(DDS, ch, quantity, profile, tolerance=tolerance, **kwargs)
+    assert wave["report"]["max_error"] <= tolerance
+    assert len(wave["trigger_times"]) == len(wave["memory_commands"])
+
+def test_segment_forced_by_min_duration():
+    # 200 us Blackman pulse, segments of 10 us can not follow it within 2: the breakpoints stay on the samples
+    t = np.linspace(0, 200E-6, 2001)
+    y = 1023*np.blackman(2001)
+    times, values = segment(t, y, 2, min_duration=10E-6)
+    assert values.min() >= y.min() and values.max() <= y.max()
+    assert np.abs(values - np.interp(times, t, y)).max() <= 2
+
+def test_out_of_tolerance_raises(DDS):
+    with pytest.raises(ValueError):
+        compile_waveform(DDS, 1, "amplitude", 1023*np.blackman(2001), tolerance=2, t=np.linspace(0, 200E-6, 2001),
+                         t_start=1E-3)
+
+def test_lead_in_needs_room(DDS):
+    with pytest.raises(ValueError):
+        compile_waveform(DDS, 0, "frequency", lambda t: 1E6 + 19E6*np.exp(-t/0.5), tolerance=5E3, duration=2,
+                         samples=2001)